@@ -0,0 +1,870 @@
+# ========== Shelf Track Benchmarks ==========
+"""
+This module measures the performance of the Shelf Track inventory system.
+
+Each benchmark builds its own throwaway database in a temporary directory,
+so the real "ebookstore.db" is never touched.
+
+Usage:
+    python benchmarks.py concurrent-reads [--seconds N] [--readers N]
+    python benchmarks.py startup [--runs N]
+    python benchmarks.py import-time [--runs N]
+    python benchmarks.py snapshot [--books N]
+    python benchmarks.py reorder-report [--books N] [--runs N]
+    python benchmarks.py backup-search [--books N] [--seconds N]
+    python benchmarks.py suite [--sizes 10k 1m 10m] [--iterations N]
+                               [--output results.json]
+    python benchmarks.py compare baseline.json results.json [--threshold P]
+"""
+
+# ========== Importing External Modules ==========
+import argparse
+import json
+import os
+import platform
+import random
+import shutil
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+
+import shelf_track
+
+
+# ========== Helper Functions ==========
+
+def build_catalogue(path, books=10_000, authors=1_000):
+    """
+    This function creates a synthetic catalogue in a new database file.
+
+    Parameters:
+        path (str): The path of the database file to create.
+        books (int): The number of books to insert.
+        authors (int): The number of authors to insert.
+    """
+    with sqlite3.connect(path) as conn:
+        conn.execute('''
+            CREATE TABLE book (
+                id INTEGER PRIMARY KEY,
+                title TEXT NOT NULL,
+                authorID INTEGER NOT NULL,
+                qty INTEGER NOT NULL
+            )
+        ''')
+        conn.execute('''
+            CREATE TABLE author (
+                id INTEGER PRIMARY KEY,
+                name TEXT NOT NULL,
+                country TEXT NOT NULL
+            )
+        ''')
+        conn.executemany(
+            'INSERT INTO author (id, name, country) VALUES (?, ?, ?)',
+            ((1000 + i, f"Author {i}", "England") for i in range(authors))
+        )
+        conn.executemany(
+            'INSERT INTO book (id, title, authorID, qty) VALUES (?, ?, ?, ?)',
+            (
+                (1000 + i, f"Title {i}", 1000 + i % authors, 10)
+                for i in range(books)
+            )
+        )
+
+
+def use_database(path, profile):
+    """
+    This function points shelf_track at a benchmark database and selects the
+    storage profile for the connections it opens.
+
+    Parameters:
+        path (str): The path of the database file.
+        profile (str): The name of a profile in shelf_track.STORAGE_PROFILES.
+    """
+    shelf_track.close_connections()
+    shelf_track.DB_NAME = path
+    shelf_track.configure_storage(profile)
+
+
+# ========== Benchmarks ==========
+
+def bench_concurrent_reads(profile, seconds=3.0, readers=4, books=10_000):
+    """
+    This function measures point-lookup throughput while a writer thread
+    keeps committing quantity updates.
+
+    Parameters:
+        profile (str): The storage profile to measure.
+        seconds (float): How long the readers and the writer run for.
+        readers (int): The number of reader threads.
+        books (int): The number of books in the catalogue.
+
+    Returns:
+        dict: The number of reads, writes and errors, and reads per second.
+    """
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, 'bench.db')
+        build_catalogue(path, books=books)
+        use_database(path, profile)
+
+        stop = threading.Event()
+        counts = {'reads': 0, 'writes': 0, 'errors': 0}
+        lock = threading.Lock()
+
+        def reader():
+            reads = errors = 0
+            conn = shelf_track.get_connection()
+
+            while not stop.is_set():
+                book_id = random.randint(1000, 999 + books)
+                try:
+                    conn.execute(
+                        'SELECT * FROM book WHERE id = ?', (book_id,)
+                    ).fetchone()
+                    reads += 1
+                except sqlite3.OperationalError:
+                    errors += 1
+
+            with lock:
+                counts['reads'] += reads
+                counts['errors'] += errors
+
+        def writer():
+            writes = errors = 0
+
+            while not stop.is_set():
+                book_id = random.randint(1000, 999 + books)
+                try:
+                    conn = shelf_track.get_connection()
+                    conn.execute(
+                        'UPDATE book SET qty = qty + 1 WHERE id = ?',
+                        (book_id,)
+                    )
+                    conn.commit()
+                    writes += 1
+                except sqlite3.OperationalError:
+                    conn.rollback()
+                    errors += 1
+
+            with lock:
+                counts['writes'] += writes
+                counts['errors'] += errors
+
+        threads = [threading.Thread(target=reader) for _ in range(readers)]
+        threads.append(threading.Thread(target=writer))
+
+        for thread in threads:
+            thread.start()
+
+        time.sleep(seconds)
+        stop.set()
+
+        for thread in threads:
+            thread.join()
+
+        shelf_track.close_connections()
+
+    counts['reads_per_second'] = round(counts['reads'] / seconds)
+
+    return counts
+
+
+def bench_startup(runs=200):
+    """
+    This function measures how long it takes to open the database and get it
+    ready for use, once it has already been set up.
+
+    Parameters:
+        runs (int): The number of startups to time.
+
+    Returns:
+        dict: The mean and worst startup time, in milliseconds.
+    """
+    with tempfile.TemporaryDirectory() as directory:
+        use_database(os.path.join(directory, 'bench.db'), 'concurrent')
+        shelf_track.prepare_database()
+
+        timings = []
+
+        for _ in range(runs):
+            shelf_track.close_connections()
+
+            start = time.perf_counter()
+            shelf_track.prepare_database()
+            timings.append(time.perf_counter() - start)
+
+        shelf_track.close_connections()
+
+    return {
+        'runs': runs,
+        'mean_ms': round(1000 * sum(timings) / runs, 3),
+        'max_ms': round(1000 * max(timings), 3),
+    }
+
+
+def bench_import_time(runs=20):
+    """
+    This function measures how long a fresh interpreter takes to import
+    shelf_track, and checks that importing it does not load the table
+    renderer or start the menu.
+
+    Parameters:
+        runs (int): The number of interpreters to start.
+
+    Returns:
+        dict: The mean and fastest import time in milliseconds, and whether
+              tabulate was loaded.
+    """
+    script = (
+        "import sys, time\n"
+        "start = time.perf_counter()\n"
+        "import shelf_track\n"
+        "elapsed = time.perf_counter() - start\n"
+        "print(elapsed, 'tabulate' in sys.modules)\n"
+    )
+    directory = os.path.dirname(os.path.abspath(shelf_track.__file__))
+    timings = []
+
+    for _ in range(runs):
+        output = subprocess.run(
+            [sys.executable, '-c', script], cwd=directory, check=True,
+            capture_output=True, text=True, stdin=subprocess.DEVNULL,
+        ).stdout.split()
+
+        timings.append(float(output[0]))
+        loads_tabulate = output[1] == 'True'
+
+    return {
+        'runs': runs,
+        'mean_ms': round(1000 * sum(timings) / runs, 3),
+        'min_ms': round(1000 * min(timings), 3),
+        'loads_tabulate': loads_tabulate,
+    }
+
+
+def bench_snapshot(books=200_000):
+    """
+    This function compares a "stock per author" report built from rows
+    fetched as tuples with the same report built from an InventorySnapshot,
+    both when the snapshot is first loaded and when it is refreshed after
+    100 books have changed.
+
+    Parameters:
+        books (int): The number of books in the catalogue.
+
+    Returns:
+        dict: The time taken and the peak memory allocated by each approach.
+    """
+    def measure(report):
+        tracemalloc.start()
+        start = time.perf_counter()
+        report()
+        elapsed = time.perf_counter() - start
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+
+        return {
+            'ms': round(1000 * elapsed, 1),
+            'peak_mb': round(peak / 2 ** 20, 1),
+        }
+
+    def from_tuples():
+        rows = shelf_track.get_connection().execute(
+            'SELECT id, title, authorID, qty FROM book'
+        ).fetchall()
+        totals = {}
+
+        for _, _, author_id, qty in rows:
+            totals[author_id] = totals.get(author_id, 0) + qty
+
+    snapshots = []
+
+    def from_snapshot():
+        snapshots.append(shelf_track.InventorySnapshot())
+        snapshots[0].stock_per_author()
+
+    def from_refreshed_snapshot():
+        snapshots[0].refresh()
+        snapshots[0].stock_per_author()
+
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, 'bench.db')
+        build_catalogue(path, books=books)
+        use_database(path, 'concurrent')
+        shelf_track.migrate()
+
+        result = {
+            'books': books,
+            'numpy': shelf_track._load_numpy() is not None,
+            'tuples': measure(from_tuples),
+            'snapshot': measure(from_snapshot),
+        }
+
+        inventory = shelf_track.Inventory()
+
+        with inventory.unit_of_work():
+            for book_id in random.sample(range(1000, 1000 + books), 100):
+                inventory.adjust_stock(book_id, 1)
+
+        result['refreshed_snapshot'] = measure(from_refreshed_snapshot)
+
+        shelf_track.close_connections()
+
+    return result
+
+
+def bench_reorder_report(books=1_000_000, runs=20):
+    """
+    This function measures how long the reorder report takes on a large
+    catalogue where one book in a hundred is below its reorder level.
+
+    Parameters:
+        books (int): The number of books in the catalogue.
+        runs (int): The number of reports to time.
+
+    Returns:
+        dict: The number of books reported, and the mean and worst time to
+              build the report, in milliseconds.
+    """
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, 'bench.db')
+        build_catalogue(path, books=books)
+        use_database(path, 'concurrent')
+        shelf_track.migrate()
+
+        with shelf_track.transaction() as conn:
+            conn.execute(
+                'UPDATE book SET reorder_level = 20 WHERE id % 100 = 0'
+            )
+
+        inventory = shelf_track.Inventory()
+        timings = []
+
+        for _ in range(runs):
+            start = time.perf_counter()
+            report = inventory.reorder_report()
+            timings.append(time.perf_counter() - start)
+
+        shelf_track.close_connections()
+
+    return {
+        'books': books,
+        'reported': len(report),
+        'mean_ms': round(1000 * sum(timings) / runs, 3),
+        'max_ms': round(1000 * max(timings), 3),
+    }
+
+
+def percentile(timings, fraction):
+    """
+    This function returns the value below which a fraction of the sorted
+    timings fall.
+
+    Parameters:
+        timings (list): The timings, sorted.
+        fraction (float): The fraction, e.g. 0.99.
+
+    Returns:
+        float: The timing at that fraction.
+    """
+    return timings[min(len(timings) - 1, int(fraction * len(timings)))]
+
+
+def bench_backup_search(books=200_000, seconds=3.0):
+    """
+    This function measures the latency of search_books() on one thread
+    while backups run back to back on another, with no backup, with the
+    whole database copied in one step and with the default throttled steps.
+
+    Parameters:
+        books (int): The number of books in the catalogue.
+        seconds (float): How long each case runs for.
+
+    Returns:
+        dict: For each case, the number of searches and backups, and the
+              median and 99th percentile search time in milliseconds.
+    """
+    cases = {
+        'no backup': None,
+        'one step': {'pages': -1, 'sleep': 0},
+        'throttled': {'pages': shelf_track.BACKUP_PAGES,
+                      'sleep': shelf_track.BACKUP_SLEEP},
+    }
+    results = {}
+
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, 'bench.db')
+        build_catalogue(path, books=books)
+        use_database(path, 'concurrent')
+        shelf_track.migrate()
+
+        for case, settings in cases.items():
+            stop = threading.Event()
+            timings = []
+
+            def searcher():
+                inventory = shelf_track.Inventory()
+
+                while not stop.is_set():
+                    start = time.perf_counter()
+                    inventory.search_books(str(random.randrange(books)))
+                    timings.append(time.perf_counter() - start)
+
+            thread = threading.Thread(target=searcher)
+            thread.start()
+            backups = 0
+            end = time.perf_counter() + seconds
+
+            while time.perf_counter() < end:
+                if settings is None:
+                    time.sleep(0.05)
+                    continue
+
+                shelf_track.backup_database(
+                    os.path.join(directory, 'backup.db'), **settings
+                )
+                backups += 1
+
+            stop.set()
+            thread.join()
+            timings.sort()
+
+            results[case] = {
+                'searches': len(timings),
+                'backups': backups,
+                'p50_ms': round(1000 * percentile(timings, 0.5), 3),
+                'p99_ms': round(1000 * percentile(timings, 0.99), 3),
+            }
+
+        shelf_track.close_connections()
+
+    return results
+
+
+# ========== Benchmark Suite ==========
+
+# The catalogue sizes the suite can run at, by name.
+SUITE_SIZES = {'10k': 10_000, '1m': 1_000_000, '10m': 10_000_000}
+
+# The number of rows in each page the suite lists, as in the menu.
+PAGE = 20
+
+# Words the synthetic titles and author names are made of.
+WORDS = (
+    "river night garden shadow winter stone glass silver house road "
+    "storm island letter crown forest dream mirror harbour summer iron "
+    "tale secret golden empire clock raven ocean valley lantern wolf "
+    "orchard voyage ember frost meadow tower compass cellar thorn echo"
+).split()
+FIRST_NAMES = (
+    "Ada Ben Clara David Elena Felix Grace Hugo Iris James Kate Leo Maya "
+    "Noah Olive Paul Quinn Rosa Sam Tara"
+).split()
+COUNTRIES = ("England", "Ireland", "Scotland", "Wales", "France", "Spain",
+             "Chile", "Canada", "India", "Nigeria", "Japan", "Australia")
+
+
+def build_suite_catalogue(path, books, seed=42):
+    """
+    This function creates a synthetic catalogue with the current schema.
+
+    There is one author for every ten books. Books are shared out between
+    authors on a Zipf-like curve, so a few authors have hundreds of books
+    and most have only a few, as in a real bookshop. One book in twenty has
+    a reorder level. The same seed always gives the same catalogue.
+
+    The rows are loaded into the bare tables of the first migration, and
+    the later steps build the indexes over them, which is much faster than
+    updating every index and trigger row by row. The change log starts
+    empty, as after a routine prune.
+
+    Parameters:
+        path (str): The path of the database file to create.
+        books (int): The number of books to insert, from ID 1000.
+        seed (int): The seed of the random number generator.
+    """
+    rng = random.Random(seed)
+    authors = max(10, books // 10)
+
+    use_database(path, 'concurrent')
+    shelf_track.migrate(target=1)
+
+    # Author n is chosen with a weight of 1 / n ** 0.8.
+    total, cumulative = 0.0, []
+
+    for rank in range(1, authors + 1):
+        total += rank ** -0.8
+        cumulative.append(total)
+
+    with shelf_track.transaction() as conn:
+        conn.executemany(
+            'INSERT INTO author (id, name, country) VALUES (?, ?, ?)',
+            (
+                (1000 + index,
+                 f"{rng.choice(FIRST_NAMES)} {rng.choice(WORDS).title()}",
+                 rng.choice(COUNTRIES))
+                for index in range(authors)
+            )
+        )
+
+    for start in range(0, books, 100_000):
+        count = min(100_000, books - start)
+        author_indexes = rng.choices(range(authors), cum_weights=cumulative,
+                                     k=count)
+
+        with shelf_track.transaction() as conn:
+            conn.executemany(
+                'INSERT INTO book (id, title, authorID, qty) '
+                'VALUES (?, ?, ?, ?)',
+                (
+                    (1000 + start + offset,
+                     " ".join(rng.choice(WORDS).title()
+                              for _ in range(rng.randint(1, 4))),
+                     1000 + author_index,
+                     rng.randint(0, 60))
+                    for offset, author_index in enumerate(author_indexes)
+                )
+            )
+
+    shelf_track.migrate(target=7)
+
+    with shelf_track.transaction() as conn:
+        conn.executemany(
+            'UPDATE book SET reorder_level = ? WHERE id = ?',
+            (
+                (rng.randint(5, 30), 1000 + index)
+                for index in sorted(rng.sample(range(books), books // 20))
+            )
+        )
+
+    shelf_track.migrate()
+
+    with shelf_track.transaction() as conn:
+        conn.execute('ANALYZE')
+
+    shelf_track.close_connections()
+
+
+def suite_catalogue(cache_dir, books, seed=42):
+    """
+    This function returns the path of a cached suite catalogue, building it
+    the first time it is asked for or when the schema has changed since.
+
+    Parameters:
+        cache_dir (str): The directory the catalogues are kept in.
+        books (int): The number of books in the catalogue.
+        seed (int): The seed of the random number generator.
+
+    Returns:
+        str: The path of the catalogue.
+    """
+    os.makedirs(cache_dir, exist_ok=True)
+    path = os.path.join(cache_dir, f"catalogue-{books}-{seed}.db")
+    latest = shelf_track.MIGRATIONS[-1].version
+
+    if os.path.exists(path):
+        with sqlite3.connect(path) as conn:
+            if shelf_track.schema_version(conn) == latest:
+                return path
+
+        os.remove(path)
+
+    build_suite_catalogue(path + '.partial', books, seed)
+    os.replace(path + '.partial', path)
+
+    return path
+
+
+def suite_operations(books, rng):
+    """
+    This function returns the operations the suite measures. Each one drives
+    the same non-interactive code path as a menu option or API call.
+
+    Parameters:
+        books (int): The number of books in the catalogue, from ID 1000.
+        rng (random.Random): The random number generator for the inputs.
+
+    Returns:
+        dict: Functions taking an Inventory, by operation name.
+    """
+    def book_id():
+        return rng.randrange(1000, 1000 + books)
+
+    def update_book(inventory):
+        # The "Update book" menu option saves its changes in one unit.
+        with inventory.unit_of_work():
+            target = book_id()
+            inventory.adjust_stock(target, 1)
+            inventory.update_title(
+                target, f"{rng.choice(WORDS).title()} {rng.randrange(100)}"
+            )
+
+    return {
+        'get_book': lambda inventory: inventory.get_book(book_id()),
+        'get_book_details':
+            lambda inventory: inventory.get_book_details(book_id()),
+        'list_books':
+            lambda inventory: inventory.list_books(book_id(), PAGE),
+        'view_details_page':
+            lambda inventory: inventory.list_book_details(book_id(), PAGE),
+        'search':
+            lambda inventory: inventory.search_books(
+                f"{rng.choice(WORDS)} {rng.choice(WORDS)[:3]}"
+            ),
+        'reorder_report':
+            lambda inventory: inventory.reorder_report(book_id(), PAGE),
+        'adjust_stock':
+            lambda inventory: inventory.adjust_stock(book_id(), 1),
+        'enter_book':
+            lambda inventory: inventory.new_book(
+                rng.choice(WORDS).title(), 1000, rng.randint(0, 60)
+            ),
+        'update_book': update_book,
+    }
+
+
+def run_suite(sizes=('10k',), iterations=2000, cache_dir='.bench-cache',
+              seed=42):
+    """
+    This function measures every suite operation at each catalogue size.
+
+    Each size runs on a fresh copy of its cached catalogue, with the lookup
+    cache turned off, so every run starts from the same data and measures
+    the database work. Each operation is warmed up, then timed call by call.
+
+    Parameters:
+        sizes (tuple): Names from SUITE_SIZES.
+        iterations (int): The number of timed calls of each operation.
+        cache_dir (str): Where the built catalogues are kept between runs.
+        seed (int): The seed of the catalogues and of the inputs.
+
+    Returns:
+        dict: The environment and, for each size and operation, the
+              throughput and latency percentiles.
+    """
+    results = {
+        'meta': {
+            'created': time.strftime('%Y-%m-%dT%H:%M:%S'),
+            'python': platform.python_version(),
+            'sqlite': sqlite3.sqlite_version,
+            'platform': platform.platform(),
+            'iterations': iterations,
+            'seed': seed,
+        },
+        'results': {},
+    }
+
+    for size in sizes:
+        books = SUITE_SIZES[size]
+        source = suite_catalogue(cache_dir, books, seed)
+
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'suite.db')
+            shutil.copyfile(source, path)
+            use_database(path, 'concurrent')
+
+            inventory = shelf_track.Inventory(cache_size=0)
+            rng = random.Random(seed)
+            measured = {}
+
+            for name, operation in suite_operations(books, rng).items():
+                for _ in range(min(100, iterations)):
+                    operation(inventory)
+
+                timings = []
+                started = time.perf_counter()
+
+                for _ in range(iterations):
+                    start = time.perf_counter()
+                    operation(inventory)
+                    timings.append(time.perf_counter() - start)
+
+                elapsed = time.perf_counter() - started
+                timings.sort()
+
+                measured[name] = {
+                    'ops_per_second': round(iterations / elapsed, 1),
+                    'p50_ms': round(1000 * percentile(timings, 0.5), 4),
+                    'p90_ms': round(1000 * percentile(timings, 0.9), 4),
+                    'p99_ms': round(1000 * percentile(timings, 0.99), 4),
+                    'max_ms': round(1000 * timings[-1], 4),
+                }
+
+            shelf_track.close_connections()
+
+        results['results'][size] = measured
+
+    return results
+
+
+def compare_results(baseline, current, threshold=10.0):
+    """
+    This function compares two suite results and finds the regressions.
+
+    Parameters:
+        baseline (dict): The results to compare against.
+        current (dict): The new results.
+        threshold (float): The percentage by which the median latency may
+                           rise, or the throughput fall, before it counts
+                           as a regression.
+
+    Returns:
+        tuple: (lines of the comparison table, number of regressions).
+    """
+    lines = [f"{'size':>5} {'operation':<18} {'p50 ms':>18} {'change':>8} "
+             f"{'ops/s':>20} {'change':>8}"]
+    regressions = 0
+
+    for size, operations in current['results'].items():
+        for name, new in operations.items():
+            old = baseline['results'].get(size, {}).get(name)
+
+            if old is None:
+                continue
+
+            latency = 100 * (new['p50_ms'] / old['p50_ms'] - 1)
+            throughput = 100 * (new['ops_per_second']
+                                / old['ops_per_second'] - 1)
+            regressed = latency > threshold or throughput < -threshold
+            regressions += regressed
+
+            lines.append(
+                f"{size:>5} {name:<18} "
+                f"{old['p50_ms']:>8} > {new['p50_ms']:<7} {latency:>+7.1f}% "
+                f"{old['ops_per_second']:>9} > {new['ops_per_second']:<8} "
+                f"{throughput:>+7.1f}%" + ("  REGRESSION" if regressed else "")
+            )
+
+    return lines, regressions
+
+
+# ========== Command Line ==========
+
+def main(argv=None):
+    """
+    This function parses the command line and runs the chosen benchmark.
+
+    Parameters:
+        argv (list): The command line arguments. Defaults to sys.argv.
+
+    Returns:
+        int: The exit status, 1 if "compare" found a regression.
+    """
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    concurrent = commands.add_parser(
+        'concurrent-reads',
+        help="read throughput while writes are going on, per profile"
+    )
+    concurrent.add_argument('--seconds', type=float, default=3.0)
+    concurrent.add_argument('--readers', type=int, default=4)
+    concurrent.add_argument('--books', type=int, default=10_000)
+
+    startup = commands.add_parser(
+        'startup', help="time to get an existing database ready for use"
+    )
+    startup.add_argument('--runs', type=int, default=200)
+
+    import_time = commands.add_parser(
+        'import-time', help="time to import shelf_track in a new interpreter"
+    )
+    import_time.add_argument('--runs', type=int, default=20)
+
+    snapshot = commands.add_parser(
+        'snapshot', help="memory and time of a report, tuples vs snapshot"
+    )
+    snapshot.add_argument('--books', type=int, default=200_000)
+
+    reorder = commands.add_parser(
+        'reorder-report', help="time to build the reorder report"
+    )
+    reorder.add_argument('--books', type=int, default=1_000_000)
+    reorder.add_argument('--runs', type=int, default=20)
+
+    backup_search = commands.add_parser(
+        'backup-search', help="search latency while backups are running"
+    )
+    backup_search.add_argument('--books', type=int, default=200_000)
+    backup_search.add_argument('--seconds', type=float, default=3.0)
+
+    suite = commands.add_parser(
+        'suite', help="every operation at each catalogue size, as JSON"
+    )
+    suite.add_argument('--sizes', nargs='+', choices=SUITE_SIZES,
+                       default=['10k'])
+    suite.add_argument('--iterations', type=int, default=2000)
+    suite.add_argument('--seed', type=int, default=42)
+    suite.add_argument('--cache-dir', default='.bench-cache',
+                       help="where the catalogues are kept between runs")
+    suite.add_argument('--output', help="the JSON file to save results to")
+
+    compare = commands.add_parser(
+        'compare', help="compare two suite results and report regressions"
+    )
+    compare.add_argument('baseline')
+    compare.add_argument('current')
+    compare.add_argument('--threshold', type=float, default=10.0,
+                         help="the change, in percent, that is a regression")
+
+    args = parser.parse_args(argv)
+
+    if args.command == 'concurrent-reads':
+        for profile in shelf_track.STORAGE_PROFILES:
+            result = bench_concurrent_reads(
+                profile, args.seconds, args.readers, args.books
+            )
+            print(f"{profile:>12}: {result}")
+
+    elif args.command == 'startup':
+        print(bench_startup(args.runs))
+
+    elif args.command == 'import-time':
+        print(bench_import_time(args.runs))
+
+    elif args.command == 'snapshot':
+        print(bench_snapshot(args.books))
+
+    elif args.command == 'reorder-report':
+        print(bench_reorder_report(args.books, args.runs))
+
+    elif args.command == 'backup-search':
+        for case, result in bench_backup_search(
+            args.books, args.seconds
+        ).items():
+            print(f"{case:>12}: {result}")
+
+    elif args.command == 'suite':
+        results = run_suite(args.sizes, args.iterations, args.cache_dir,
+                            args.seed)
+
+        for size, operations in results['results'].items():
+            for name, result in operations.items():
+                print(f"{size:>4} {name:>18}: {result}")
+
+        if args.output:
+            with open(args.output, 'w', encoding='utf-8') as file:
+                json.dump(results, file, indent=2)
+
+    elif args.command == 'compare':
+        with open(args.baseline, encoding='utf-8') as file:
+            baseline = json.load(file)
+
+        with open(args.current, encoding='utf-8') as file:
+            current = json.load(file)
+
+        lines, regressions = compare_results(baseline, current,
+                                             args.threshold)
+        print("\n".join(lines))
+        print(f"{regressions} regression(s) beyond {args.threshold}%")
+
+        return 1 if regressions else 0
+
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,253 @@
+# ========== Shelf Track Load Test ==========
+"""
+This module load tests the Shelf Track HTTP server and reports the latency
+of each kind of request.
+
+Each client thread keeps one HTTP/1.1 connection open and sends a mix of
+book lookups, searches, listings and stock adjustments, as a till or web
+shop would. By default there are four times as many clients as server
+workers, so the test shows how requests queue for the worker pool rather
+than giving every client a worker of its own.
+
+Usage:
+    python loadtest.py [--url URL] [--clients N] [--seconds N]
+
+Without --url, a server is started on a throwaway catalogue and stopped
+afterwards.
+"""
+
+# ========== Importing External Modules ==========
+import argparse
+import http.client
+import json
+import os
+import random
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from urllib.parse import urlsplit
+
+import benchmarks
+import shelf_track
+from benchmarks import percentile
+
+
+# ========== Workload ==========
+
+# The number of clients run by default: more than the server has workers.
+DEFAULT_CLIENTS = 4 * shelf_track.SERVER_WORKERS
+
+# The requests each client sends, as (name, weight, request function). Each
+# function takes the number of books and returns (method, path, body).
+WORKLOAD = (
+    ('get_book', 60,
+     lambda books: ('GET', f"/books/{random.randrange(1000, 1000 + books)}",
+                    None)),
+    ('search', 20,
+     lambda books: ('GET', f"/search?q={random.randrange(books)}&limit=10",
+                    None)),
+    ('list_books', 10,
+     lambda books: ('GET', f"/books?after_id="
+                    f"{random.randrange(1000, 1000 + books)}&limit=20",
+                    None)),
+    ('adjust_stock', 10,
+     lambda books: ('POST',
+                    f"/books/{random.randrange(1000, 1000 + books)}/stock",
+                    {'delta': random.choice((-1, 1))})),
+)
+
+
+def run_clients(url, clients=DEFAULT_CLIENTS, seconds=10.0, books=10_000):
+    """
+    This function sends the workload from several client threads at once.
+
+    Parameters:
+        url (str): The base URL of the server.
+        clients (int): The number of client threads.
+        seconds (float): How long the clients run for.
+        books (int): The number of books in the catalogue, from ID 1000.
+
+    Returns:
+        dict: For each kind of request, the count, errors, and the p50 and
+              p99 latency in milliseconds, plus the total requests/second.
+    """
+    address = urlsplit(url)
+    names = [name for name, _, _ in WORKLOAD]
+    weights = [weight for _, weight, _ in WORKLOAD]
+    requests = {name: build for name, _, build in WORKLOAD}
+    timings = {name: [] for name in names}
+    errors = {name: 0 for name in names}
+    lock = threading.Lock()
+    stop = threading.Event()
+
+    def client():
+        conn = http.client.HTTPConnection(address.hostname, address.port)
+        mine = {name: [] for name in names}
+        failed = {name: 0 for name in names}
+
+        while not stop.is_set():
+            name = random.choices(names, weights)[0]
+            method, path, body = requests[name](books)
+            payload = None if body is None else json.dumps(body)
+
+            start = time.perf_counter()
+
+            try:
+                conn.request(method, path, payload,
+                             {'Content-Type': 'application/json'})
+                response = conn.getresponse()
+                response.read()
+
+            # Count a dropped connection as an error, and reconnect.
+            except (OSError, http.client.HTTPException):
+                failed[name] += 1
+                conn.close()
+                continue
+
+            mine[name].append(time.perf_counter() - start)
+
+            # 404s and refused stock changes are expected outcomes.
+            if response.status >= 500:
+                failed[name] += 1
+
+        conn.close()
+
+        with lock:
+            for name in names:
+                timings[name].extend(mine[name])
+                errors[name] += failed[name]
+
+    threads = [threading.Thread(target=client) for _ in range(clients)]
+
+    for thread in threads:
+        thread.start()
+
+    time.sleep(seconds)
+    stop.set()
+
+    for thread in threads:
+        thread.join()
+
+    results = {}
+
+    for name in names:
+        measured = sorted(timings[name])
+
+        if not measured:
+            continue
+
+        results[name] = {
+            'count': len(measured),
+            'errors': errors[name],
+            'p50_ms': round(1000 * percentile(measured, 0.5), 3),
+            'p99_ms': round(1000 * percentile(measured, 0.99), 3),
+        }
+
+    total = sum(len(measured) for measured in timings.values())
+    results['requests_per_second'] = round(total / seconds)
+
+    return results
+
+
+# ========== Server ==========
+
+def free_port():
+    """
+    This function returns a TCP port on the loopback interface that is not
+    in use.
+
+    Returns:
+        int: The port number.
+    """
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def start_server(path, workers):
+    """
+    This function starts "shelf_track.py serve" on a database in a separate
+    process, and waits until it accepts connections.
+
+    Parameters:
+        path (str): The path of the database file.
+        workers (int): The number of server worker threads.
+
+    Returns:
+        tuple: (subprocess.Popen, base URL).
+    """
+    port = free_port()
+    script = os.path.join(
+        os.path.dirname(os.path.abspath(shelf_track.__file__)),
+        'shelf_track.py'
+    )
+    process = subprocess.Popen(
+        [sys.executable, script, '--database', path, '--headless', 'serve',
+         '--port', str(port), '--workers', str(workers)],
+        stdout=subprocess.DEVNULL, stdin=subprocess.DEVNULL,
+    )
+
+    # Wait for the server to start listening.
+    for _ in range(100):
+        try:
+            socket.create_connection(('127.0.0.1', port), timeout=1).close()
+            break
+
+        except OSError:
+            time.sleep(0.1)
+
+    return process, f"http://127.0.0.1:{port}"
+
+
+# ========== Command Line ==========
+
+def main(argv=None):
+    """
+    This function parses the command line and runs the load test.
+
+    Parameters:
+        argv (list): The command line arguments. Defaults to sys.argv.
+    """
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('--url', help="the server to test; by default one "
+                                      "is started on a throwaway catalogue")
+    parser.add_argument('--clients', type=int, default=DEFAULT_CLIENTS)
+    parser.add_argument('--seconds', type=float, default=10.0)
+    parser.add_argument('--books', type=int, default=10_000,
+                        help="the number of books, from ID 1000")
+    parser.add_argument('--workers', type=int,
+                        default=shelf_track.SERVER_WORKERS,
+                        help="server worker threads, without --url")
+    args = parser.parse_args(argv)
+
+    if args.url:
+        results = run_clients(args.url, args.clients, args.seconds,
+                              args.books)
+
+    else:
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'loadtest.db')
+            benchmarks.build_catalogue(path, books=args.books)
+            benchmarks.use_database(path, 'concurrent')
+            shelf_track.migrate()
+            shelf_track.close_connections()
+
+            process, url = start_server(path, args.workers)
+
+            try:
+                results = run_clients(url, args.clients, args.seconds,
+                                      args.books)
+
+            finally:
+                process.terminate()
+                process.wait()
+
+    for name, result in results.items():
+        print(f"{name:>20}: {result}")
+
+
+if __name__ == '__main__':
+    main()
@@ -7,41 +7,846 @@ delete books from the database and search the database for specific books
 """
 
 # ========== Importing External Modules ==========
+#
+# Only light modules are imported here, so importing shelf_track stays cheap.
+# The table renderer (tabulate), the command line parser and the file
+# formats are imported by the functions that use them.
+import atexit
+import itertools
+import os
 import sqlite3
+import sys
+import threading
+import time
 
-from tabulate import tabulate
-
+from collections import OrderedDict
 from contextlib import contextmanager
+from typing import (
+    Callable, Dict, Iterable, Iterator, List, NamedTuple, Optional, Tuple
+)
+
+
+# ========== Connection Settings ==========
+
+# The database file every connection opens unless told otherwise.
+DB_NAME = 'ebookstore.db'
+
+# Each connection keeps every statement in STATEMENTS compiled for reuse,
+# plus this many others, such as pragmas, savepoints and schema checks.
+STATEMENT_CACHE_SPARE = 64
+
+# Storage profiles, applied once when a connection is opened.
+#
+# "default" keeps SQLite's rollback journal, where one writer blocks every
+# reader. "concurrent" switches to WAL journaling so readers keep working
+# while a write is in progress, which suits several terminals sharing one
+# database file.
+STORAGE_PROFILES = {
+    'default': {
+        'journal_mode': 'DELETE',
+        'synchronous': 'FULL',
+        'temp_store': 'MEMORY',
+        'busy_timeout': 5000,
+        'checkpoint_interval': 0,
+    },
+    'concurrent': {
+        'journal_mode': 'WAL',
+        'synchronous': 'NORMAL',
+        'temp_store': 'MEMORY',
+        'mmap_size': 256 * 1024 * 1024,
+        'cache_size': -64 * 1024,
+        'busy_timeout': 5000,
+        'wal_autocheckpoint': 1000,
+        'checkpoint_interval': 500,
+    },
+}
+
+# Settings that are handled by the connection manager, not by PRAGMA.
+_MANAGER_SETTINGS = ('checkpoint_interval',)
+
+# The storage profile used for new connections.
+STORAGE_PROFILE = os.environ.get('SHELF_TRACK_PROFILE', 'concurrent')
+storage_settings = dict(STORAGE_PROFILES[STORAGE_PROFILE])
+
+
+def configure_storage(profile=None, **overrides):
+    """
+    This function selects the storage profile used for new connections and
+    lets individual settings be overridden.
+
+    Connections that are already open keep their settings, so this should be
+    called before the database is first used.
+
+    Parameters:
+        profile (str): The name of a profile in STORAGE_PROFILES. If None,
+                       the current profile is kept.
+        **overrides: Individual settings, e.g. busy_timeout=10000.
+
+    Returns:
+        dict: The settings that new connections will use.
+    """
+    global STORAGE_PROFILE
+
+    if profile is not None:
+        if profile not in STORAGE_PROFILES:
+            raise ValueError(f"Unknown storage profile: {profile}")
+
+        STORAGE_PROFILE = profile
+        storage_settings.clear()
+        storage_settings.update(STORAGE_PROFILES[profile])
+
+    storage_settings.update(overrides)
+
+    return dict(storage_settings)
+
+
+# ========== Connection Manager ==========
+
+class PooledConnection(sqlite3.Connection):
+    """
+    A long-lived SQLite connection that is shared by every db_connection()
+    block running on the same thread.
+
+    Attributes:
+        database (str): The path of the database file.
+        depth (int): The number of db_connection() blocks currently open on
+                     this connection.
+        commit_requested (bool): True if any open block asked for a commit.
+        failed (bool): True if any open block raised an error.
+        on_finish (list): Functions called once the transaction has been
+                          committed or rolled back.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.depth = 0
+        self.commit_requested = False
+        self.failed = False
+        self.database = None
+        self.on_finish = []
+        self.checkpoint_interval = 0
+        self.commits_since_checkpoint = 0
+
+    def close(self):
+        query_metrics.count_connection(opened=False)
+        super().close()
+
+
+# Connections that are currently open, keyed by (thread id, database).
+_connections = {}
+_connections_lock = threading.Lock()
+
+
+def _open_connection(database):
+    """
+    This function opens a new connection to the database and applies the
+    connection pragmas to it. If METRICS_ENABLED is True, the connection
+    times every statement it runs.
+
+    Parameters:
+        database (str): The path of the SQLite database file.
+
+    Returns:
+        PooledConnection: The newly opened connection.
+    """
+    # Only pay for the statement timers when the metrics are wanted.
+    factory = InstrumentedConnection if METRICS_ENABLED else PooledConnection
+    conn = sqlite3.connect(
+        database,
+        factory=factory,
+        cached_statements=len(STATEMENTS) + STATEMENT_CACHE_SPARE,
+        check_same_thread=False,
+    )
+    query_metrics.count_connection(opened=True)
+
+    # Apply the storage pragmas once, so each query does not pay for them.
+    for name, value in storage_settings.items():
+        if name not in _MANAGER_SETTINGS:
+            conn.execute(f"PRAGMA {name} = {value}")
+
+    conn.database = database
+    conn.checkpoint_interval = storage_settings.get('checkpoint_interval', 0)
+
+    return conn
+
+
+def get_connection(database=None):
+    """
+    This function returns the connection owned by the calling thread, opening
+    it the first time the thread asks for it.
+
+    Parameters:
+        database (str): The path of the SQLite database file. Defaults to
+                        DB_NAME.
+
+    Returns:
+        PooledConnection: The connection for the current thread.
+    """
+    key = (threading.get_ident(), database or DB_NAME)
+
+    with _connections_lock:
+        conn = _connections.get(key)
+
+        # Open the connection if this thread does not have one yet.
+        if conn is None:
+            conn = _open_connection(key[1])
+            _connections[key] = conn
+
+    return conn
+
+
+def close_connection(database=None):
+    """
+    This function closes the connection owned by the calling thread, if it
+    has one.
+
+    Parameters:
+        database (str): The path of the SQLite database file. Defaults to
+                        DB_NAME.
+    """
+    key = (threading.get_ident(), database or DB_NAME)
+
+    with _connections_lock:
+        conn = _connections.pop(key, None)
+
+    if conn is not None:
+        conn.close()
+
+
+def close_connections(thread_ids=None):
+    """
+    This function closes every connection opened by the connection manager.
+    It is called automatically when the program exits.
+
+    Parameters:
+        thread_ids (set): If given, only the connections owned by these
+                          threads are closed.
+    """
+    with _connections_lock:
+        keys = [key for key in _connections
+                if thread_ids is None or key[0] in thread_ids]
+        connections = [_connections.pop(key) for key in keys]
+
+    for conn in connections:
+        conn.close()
+
+
+atexit.register(close_connections)
+
+
+def _finish_connection_block(conn):
+    """
+    This function ends the transaction once the outermost block on a
+    connection has finished.
+
+    The changes are committed if a block asked for a commit and no block
+    failed, otherwise any uncommitted changes are rolled back.
+
+    Parameters:
+        conn (PooledConnection): The connection whose blocks have finished.
+    """
+    try:
+        if conn.commit_requested and not conn.failed:
+            try:
+                conn.commit()
+
+            # Never leave a transaction open if the commit fails.
+            except sqlite3.Error:
+                conn.rollback()
+                raise
+
+            _count_commit(conn)
+
+        elif conn.in_transaction:
+            conn.rollback()
+
+    finally:
+        conn.commit_requested = False
+        conn.failed = False
+
+        # Let anything waiting on the transaction know it has finished.
+        callbacks, conn.on_finish = conn.on_finish, []
+
+        for callback in callbacks:
+            callback()
+
+
+@contextmanager
+def _connection_block(commit=False, database=None, immediate=False,
+                      savepoint=False):
+    """
+    The context manager borrows the calling thread's connection for the
+    duration of a block, and raises any errors that occur inside it.
+
+    Blocks may be nested. The transaction is only committed or rolled back
+    when the outermost block finishes, so nested blocks share one
+    transaction. A block opened with savepoint=True is the exception: if it
+    fails, only its own changes are rolled back, and the transaction around
+    it can still be committed.
+
+    Parameters:
+        commit (bool): If True, the changes made in the block are saved.
+        database (str): The path of the SQLite database file. Defaults to
+                        DB_NAME.
+        immediate (bool): If True and no transaction is open, the block
+                          takes the write lock straight away, so it never
+                          has to upgrade a read lock part way through.
+        savepoint (bool): If True, the block's changes are made inside a
+                          savepoint, so they can be rolled back on their own.
+
+    Yields:
+        PooledConnection: The connection for the current thread.
+    """
+    conn = get_connection(database)
+    conn.depth += 1
+    name = None
+
+    try:
+        if immediate and not conn.in_transaction:
+            conn.execute("BEGIN IMMEDIATE")
+
+        if savepoint:
+            name = f"shelf_track_{conn.depth}"
+            failed = conn.failed
+            conn.execute(f"SAVEPOINT {name}")
+
+        yield conn
+
+        if name is not None:
+            conn.execute(f"RELEASE {name}")
+
+        if commit:
+            conn.commit_requested = True
+
+    # Make sure the changes are rolled back if the block fails.
+    except BaseException:
+        # Undo just the savepoint, unless SQLite has already rolled back
+        # the whole transaction.
+        if name is not None and conn.in_transaction:
+            conn.execute(f"ROLLBACK TO {name}")
+            conn.execute(f"RELEASE {name}")
+
+            # The blocks inside the savepoint failed, but it has undone them.
+            conn.failed = failed
+
+        else:
+            conn.failed = True
+
+        raise
+
+    finally:
+        conn.depth -= 1
+
+        # Only the outermost block ends the transaction.
+        if conn.depth == 0:
+            _finish_connection_block(conn)
+
+
+def transaction(database=None):
+    """
+    This function opens a write transaction on the calling thread's
+    connection. The changes are committed when the block finishes, or rolled
+    back if it raises.
+
+    Parameters:
+        database (str): The path of the SQLite database file. Defaults to
+                        DB_NAME.
+
+    Returns:
+        contextmanager: A context manager that yields the connection.
+    """
+    return _connection_block(commit=True, database=database, immediate=True)
+
+
+def savepoint(database=None):
+    """
+    This function opens a savepoint on the calling thread's connection,
+    starting a write transaction first if none is open. If the block raises,
+    only the changes made inside it are rolled back; the transaction around
+    it carries on and may still be committed.
+
+    Parameters:
+        database (str): The path of the SQLite database file. Defaults to
+                        DB_NAME.
+
+    Returns:
+        contextmanager: A context manager that yields the connection.
+    """
+    return _connection_block(
+        commit=True, database=database, immediate=True, savepoint=True
+    )
+
+
+def in_transaction(database=None):
+    """
+    This function tells whether the calling thread has a transaction open,
+    without opening a connection if it does not have one.
+
+    Parameters:
+        database (str): The path of the SQLite database file. Defaults to
+                        DB_NAME.
+
+    Returns:
+        bool: True if a transaction is open on the thread's connection.
+    """
+    conn = _connections.get((threading.get_ident(), database or DB_NAME))
+
+    return conn is not None and conn.in_transaction
+
+
+def _count_commit(conn):
+    """
+    This function counts the commits made on a connection and runs a passive
+    WAL checkpoint every "checkpoint_interval" commits.
+
+    Parameters:
+        conn (PooledConnection): The connection that has just committed.
+    """
+    if not conn.checkpoint_interval:
+        return
+
+    conn.commits_since_checkpoint += 1
+
+    if conn.commits_since_checkpoint >= conn.checkpoint_interval:
+        conn.commits_since_checkpoint = 0
+        checkpoint(conn=conn)
+
+
+def checkpoint(mode='PASSIVE', conn=None):
+    """
+    This function copies the pages in the write-ahead log back into the
+    database file. It does nothing useful unless the database is in WAL mode.
+
+    Parameters:
+        mode (str): The checkpoint mode: PASSIVE, FULL, RESTART or TRUNCATE.
+                    PASSIVE never waits for readers or writers.
+        conn (sqlite3.Connection): The connection to use. Defaults to the
+                                   current thread's connection.
+
+    Returns:
+        tuple: (busy, log pages, checkpointed pages) as reported by SQLite.
+    """
+    if mode.upper() not in ('PASSIVE', 'FULL', 'RESTART', 'TRUNCATE'):
+        raise ValueError(f"Unknown checkpoint mode: {mode}")
+
+    conn = conn or get_connection()
+
+    return conn.execute(f"PRAGMA wal_checkpoint({mode.upper()})").fetchone()
+
+
+# ========== Query Metrics ==========
+
+# If True, new connections time every statement they run. Set
+# SHELF_TRACK_METRICS=1 to turn it on without changing the code.
+METRICS_ENABLED = os.environ.get('SHELF_TRACK_METRICS', '') not in ('', '0')
+
+# Statements that take at least this many milliseconds, including reading
+# their rows, are written to the slow-query log.
+SLOW_QUERY_MS = 100.0
+
+# The upper bounds, in seconds, of the latency histogram buckets.
+LATENCY_BUCKETS = (
+    0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1,
+    0.25, 0.5, 1.0, 2.5,
+)
+
+# The logger that slow statements are written to.
+SLOW_QUERY_LOGGER = 'shelf_track.slow_queries'
+
+
+class StatementStats:
+    """
+    The running totals for one SQL statement.
+
+    Attributes:
+        buckets (list): The number of runs in each LATENCY_BUCKETS bucket,
+                        followed by the number slower than the last bound.
+        count (int): The number of runs.
+        seconds (float): The total time taken by every run.
+        rows (int): The rows read, or changed, by every run.
+        errors (int): The runs that raised an error.
+        slow (int): The runs that reached SLOW_QUERY_MS.
+    """
+
+    __slots__ = ('buckets', 'count', 'seconds', 'rows', 'errors', 'slow')
+
+    def __init__(self):
+        self.buckets = [0] * (len(LATENCY_BUCKETS) + 1)
+        self.count = self.rows = self.errors = self.slow = 0
+        self.seconds = 0.0
+
+
+class QueryMetrics:
+    """
+    Thread-safe latency histograms and counters for the statements run on
+    instrumented connections, and the number of connections opened and
+    closed. render() returns them in the Prometheus text format.
+
+    Statements are told apart by their SQL, with the whitespace collapsed.
+    """
+
+    def __init__(self):
+        self.statements = {}
+        self.connections_opened = 0
+        self.connections_closed = 0
+        self._keys = {}
+        self._lock = threading.Lock()
+
+    def record(self, sql, seconds, rows=0, failed=False):
+        """Add one run of a statement to its totals."""
+        import bisect
+
+        key = self._keys.get(sql)
+
+        if key is None:
+            key = self._keys[sql] = " ".join(sql.split())
+
+        slow = seconds * 1000 >= SLOW_QUERY_MS
+
+        with self._lock:
+            stats = self.statements.get(key)
+
+            if stats is None:
+                stats = self.statements[key] = StatementStats()
+
+            stats.buckets[bisect.bisect_left(LATENCY_BUCKETS, seconds)] += 1
+            stats.count += 1
+            stats.seconds += seconds
+            stats.rows += rows
+            stats.errors += failed
+            stats.slow += slow
+
+        if slow:
+            import logging
+
+            logging.getLogger(SLOW_QUERY_LOGGER).warning(
+                "%.1f ms, %d rows%s: %s", seconds * 1000, rows,
+                ", failed" if failed else "", key
+            )
+
+    def count_connection(self, opened):
+        """Count a connection being opened, or closed if opened is False."""
+        with self._lock:
+            if opened:
+                self.connections_opened += 1
+            else:
+                self.connections_closed += 1
+
+    def reset(self):
+        """Forget every statement and connection counted so far."""
+        with self._lock:
+            self.statements.clear()
+            self.connections_opened = self.connections_closed = 0
+
+    def render(self) -> str:
+        """Return the metrics in the Prometheus text exposition format."""
+        def label(key):
+            escaped = (key.replace('\\', '\\\\').replace('"', '\\"')
+                       .replace('\n', '\\n'))
+            return f'statement="{escaped}"'
+
+        with self._lock:
+            statements = sorted(
+                (key, stats.buckets[:], stats.count, stats.seconds,
+                 stats.rows, stats.errors, stats.slow)
+                for key, stats in self.statements.items()
+            )
+            opened, closed = self.connections_opened, self.connections_closed
+
+        lines = [
+            "# HELP shelf_track_query_duration_seconds Time taken by each "
+            "statement, including reading its rows.",
+            "# TYPE shelf_track_query_duration_seconds histogram",
+        ]
+
+        for key, buckets, count, seconds, _, _, _ in statements:
+            cumulative = 0
+
+            for bound, runs in zip(LATENCY_BUCKETS + ('+Inf',), buckets):
+                cumulative += runs
+                lines.append(
+                    f"shelf_track_query_duration_seconds_bucket"
+                    f"{{{label(key)},le=\"{bound}\"}} {cumulative}"
+                )
+
+            lines.append(f"shelf_track_query_duration_seconds_sum"
+                         f"{{{label(key)}}} {seconds:.6f}")
+            lines.append(f"shelf_track_query_duration_seconds_count"
+                         f"{{{label(key)}}} {count}")
+
+        for name, index, description in (
+            ('query_rows_total', 4, "Rows read or changed by each statement."),
+            ('query_errors_total', 5, "Runs of each statement that failed."),
+            ('slow_queries_total', 6,
+             "Runs of each statement that reached the slow-query threshold."),
+        ):
+            lines.append(f"# HELP shelf_track_{name} {description}")
+            lines.append(f"# TYPE shelf_track_{name} counter")
+            lines.extend(
+                f"shelf_track_{name}{{{label(statement[0])}}} "
+                f"{statement[index]}"
+                for statement in statements
+            )
+
+        for name, value, description in (
+            ('connections_opened_total', opened, "Connections opened."),
+            ('connections_closed_total', closed, "Connections closed."),
+        ):
+            lines.append(f"# HELP shelf_track_{name} {description}")
+            lines.append(f"# TYPE shelf_track_{name} counter")
+            lines.append(f"shelf_track_{name} {value}")
+
+        return "\n".join(lines) + "\n"
+
+
+# The metrics of every instrumented connection.
+query_metrics = QueryMetrics()
+
+
+def configure_metrics(enabled=None, slow_query_ms=None, slow_query_log=None):
+    """
+    This function turns statement timing on or off for new connections and
+    sets up the slow-query log.
+
+    Connections that are already open keep their setting, so this should be
+    called before the database is first used.
+
+    Parameters:
+        enabled (bool): If given, whether new connections are instrumented.
+        slow_query_ms (float): If given, the new slow-query threshold.
+        slow_query_log (str): If given, a file the slow statements are
+                              appended to. Otherwise they go to the
+                              "shelf_track.slow_queries" logger, which
+                              prints to stderr unless logging is configured.
+    """
+    global METRICS_ENABLED, SLOW_QUERY_MS
+
+    if enabled is not None:
+        METRICS_ENABLED = enabled
+
+    if slow_query_ms is not None:
+        SLOW_QUERY_MS = slow_query_ms
+
+    if slow_query_log is not None:
+        import logging
+
+        handler = logging.FileHandler(slow_query_log, encoding='utf-8')
+        handler.setFormatter(logging.Formatter('%(asctime)s %(message)s'))
+        logging.getLogger(SLOW_QUERY_LOGGER).addHandler(handler)
+
+
+def write_metrics(path):
+    """
+    This function writes the metrics to a file in the Prometheus text
+    format, replacing the old file in one step so a collector reading it
+    never sees half a file.
+
+    Parameters:
+        path (str): The file to write, e.g. for node_exporter's textfile
+                    collector.
+    """
+    partial_path = f"{path}.partial"
+
+    with open(partial_path, 'w', encoding='utf-8') as file:
+        file.write(query_metrics.render())
+
+    os.replace(partial_path, path)
+
+
+class TimedCursor(sqlite3.Cursor):
+    """
+    A cursor that records how long each statement takes, from execute()
+    until its last row has been read, and how many rows it returned or
+    changed.
+
+    A statement whose rows are not all read is recorded when the cursor
+    runs its next statement, is closed or is garbage collected.
+    """
+
+    _sql = None
+    _seconds = 0.0
+    _rows = 0
+
+    def execute(self, sql, parameters=()):
+        self._finish()
+        start = time.perf_counter()
+
+        try:
+            super().execute(sql, parameters)
+
+        except sqlite3.Error:
+            query_metrics.record(sql, time.perf_counter() - start,
+                                 failed=True)
+            raise
+
+        self._started(sql, time.perf_counter() - start)
+
+        return self
+
+    def executemany(self, sql, parameters):
+        self._finish()
+        start = time.perf_counter()
+
+        try:
+            super().executemany(sql, parameters)
+
+        except sqlite3.Error:
+            query_metrics.record(sql, time.perf_counter() - start,
+                                 failed=True)
+            raise
+
+        query_metrics.record(sql, time.perf_counter() - start,
+                             max(self.rowcount, 0))
+
+        return self
+
+    def executescript(self, script):
+        self._finish()
+        start = time.perf_counter()
+
+        try:
+            super().executescript(script)
+
+        finally:
+            query_metrics.record(script, time.perf_counter() - start)
+
+        return self
+
+    def fetchone(self):
+        start = time.perf_counter()
+        row = super().fetchone()
+        self._fetched(start, row is not None, row is None)
+
+        return row
+
+    def fetchmany(self, size=None):
+        size = self.arraysize if size is None else size
+        start = time.perf_counter()
+        rows = super().fetchmany(size)
+        self._fetched(start, len(rows), len(rows) < size)
+
+        return rows
+
+    def fetchall(self):
+        start = time.perf_counter()
+        rows = super().fetchall()
+        self._fetched(start, len(rows), True)
+
+        return rows
+
+    def __next__(self):
+        start = time.perf_counter()
+
+        try:
+            row = super().__next__()
+
+        except StopIteration:
+            self._fetched(start, 0, True)
+            raise
+
+        self._fetched(start, 1, False)
+
+        return row
+
+    def close(self):
+        self._finish()
+        super().close()
+
+    def __del__(self):
+        self._finish()
+
+    def _started(self, sql, seconds):
+        """Record a statement that returns no rows, or start timing one."""
+        if self.description is None:
+            query_metrics.record(sql, seconds, max(self.rowcount, 0))
+        else:
+            self._sql, self._seconds, self._rows = sql, seconds, 0
+
+    def _fetched(self, start, rows, done):
+        """Add the time spent reading rows to the current statement."""
+        if self._sql is None:
+            return
+
+        self._seconds += time.perf_counter() - start
+        self._rows += rows
+
+        if done:
+            self._finish()
+
+    def _finish(self):
+        """Record the current statement, if it has not been recorded yet."""
+        if self._sql is not None:
+            sql, self._sql = self._sql, None
+            query_metrics.record(sql, self._seconds, self._rows)
+
+
+class InstrumentedConnection(PooledConnection):
+    """
+    A pooled connection that runs every statement on a TimedCursor, and
+    times its commits and rollbacks too.
+    """
+
+    def cursor(self, factory=TimedCursor):
+        return super().cursor(factory)
+
+    def execute(self, sql, parameters=()):
+        return self.cursor().execute(sql, parameters)
+
+    def executemany(self, sql, parameters):
+        return self.cursor().executemany(sql, parameters)
+
+    def executescript(self, script):
+        return self.cursor().executescript(script)
+
+    def commit(self):
+        start = time.perf_counter()
+
+        try:
+            super().commit()
+
+        except sqlite3.Error:
+            query_metrics.record('COMMIT', time.perf_counter() - start,
+                                 failed=True)
+            raise
+
+        query_metrics.record('COMMIT', time.perf_counter() - start)
+
+    def rollback(self):
+        start = time.perf_counter()
+        super().rollback()
+        query_metrics.record('ROLLBACK', time.perf_counter() - start)
 
 
 # ========== Database Functions ==========
 @contextmanager
-def db_connection(commit=False):
+def db_connection(commit=False, database=None):
     """
     The context manager handles the SQLite database connections.
 
-    This functions opens the connection to the "ebookstore.db" database.
+    This function borrows the calling thread's long-lived connection to the
+    "ebookstore.db" database, instead of opening a new one for every query.
     It then creates a cursor to assist in SQL operations, it also assists in
     commit and error handling.
 
     Parameters:
         commit (bool): If True, the changes that hapeen in the context block
                        is saved to the 'ebookstore.db' database.
+        database (str): The path of the SQLite database file. Defaults to
+                        DB_NAME.
 
     Yields:
         cursor(sqlite3.Cursor): Cursor object that carries our SQLite commands.
     """
     try:
-        # Connect to the database.
-        with sqlite3.connect('ebookstore.db') as conn:
+        with _connection_block(commit=commit, database=database) as conn:
             cursor = conn.cursor()
 
-            # Make the cursor available to use in the context blocks.
-            yield cursor
+            try:
+                # Make the cursor available to use in the context blocks.
+                yield cursor
 
-            # If commit is true, save the changes to the database.
-            if commit:
-                conn.commit()
+            finally:
+                cursor.close()
 
     # Catch and print any database errors that occur.
     except sqlite3.Error as error:
@@ -51,7 +856,8 @@ def db_connection(commit=False):
 def create_table():
     """
     This function will create the book table and author table in the
-    'ebookstore.db', if they do not exist.
+    'ebookstore.db', if they do not exist, and bring the rest of the schema
+    up to date by applying any pending migrations (see MIGRATIONS).
 
     Tables:
         - author(
@@ -63,42 +869,39 @@ def create_table():
             id INTEGER PRIMARY KEY,
             title TEXT,
             authorID INTEGER,
-            qty INTEGER
+            qty INTEGER CHECK (qty >= 0)
         )
-    """
+        - book_search, the full-text index of titles and author names.
+
+    Indexes:
+        - book(authorID), book(title) and author(name).
+
+    Returns:
+        list: The Migration steps that were applied.
+    """
     try:
-        # Open the database connection and commit changes.
-        with db_connection(commit=True) as cursor:
-
-            # Create the book table in the ebookstore database.
-            cursor.execute('''
-                CREATE TABLE IF NOT EXISTS book (
-                    id INTEGER PRIMARY KEY,
-                    title TEXT NOT NULL,
-                    authorID INTEGER NOT NULL,
-                    qty INTEGER NOT NULL
-                )
-            ''')
-
-            # Create the author table in the ebookstore database.
-            cursor.execute('''
-                CREATE TABLE IF NOT EXISTS author (
-                    id INTEGER PRIMARY KEY,
-                    name TEXT NOT NULL,
-                    country TEXT NOT NULL
-                )
-            ''')
+        return migrate()
 
     # Catch and print any database errors that occur.
-    except sqlite3.Error as error:
+    except (sqlite3.Error, MigrationError) as error:
         print(f"There was an error creating the table: {error}")
+        return []
 
 
-def data_sets():
+def data_sets(replace=False, database=None):
     """
     This function will insert the book data into the book table and author
     data into the author table.
+
+    Parameters:
+        replace (bool): If True, seed rows that already exist are overwritten,
+                        including any quantity changes made since. Otherwise
+                        only the missing seed rows are added.
+        database (str): The path of the SQLite database file. Defaults to
+                        DB_NAME.
     """
+    conflict = "REPLACE" if replace else "IGNORE"
+
     # Create a list of the book data.
     book_data = [
         (3001, "A Tale of Two Cities", 1290, 30),
@@ -117,36 +920,4259 @@ def data_sets():
         (5620, "Lewis Carroll", "England")
     ]
 
-    try:
-        # Open the database connection and commit changes.
-        with db_connection(commit=True) as cursor:
+    try:
+        # Open the database connection and commit changes.
+        with db_connection(commit=True, database=database) as cursor:
+
+            # Insert author_data in the author table. The authors go in
+            # first so the search index picks up their names.
+            cursor.executemany(f'''
+                INSERT OR {conflict} INTO author(id, name, country)
+                VALUES(?, ?, ?)
+            ''', author_data)
+
+            # Insert book_data in the book table.
+            cursor.executemany(f'''
+                INSERT OR {conflict} INTO book (id, title, authorID, qty)
+                VALUES(? , ?, ?, ?)
+            ''', book_data)
+
+    # Catch and print any database errors that occur.
+    except sqlite3.Error as error:
+        print(f"There was an error inserting the data: {error}")
+
+
+# ========== Search Index ==========
+
+# The full-text index over book titles and author names. Each row's rowid is
+# the book's id. Prefix indexes make short "tit*" style queries fast.
+SEARCH_INDEX_TABLE = '''
+    CREATE VIRTUAL TABLE book_search USING fts5(
+        title,
+        author,
+        tokenize = 'unicode61 remove_diacritics 2',
+        prefix = '2 3'
+    )
+'''
+
+# The triggers that keep the search index in sync with the book and author
+# tables.
+SEARCH_INDEX_TRIGGERS = (
+    '''
+    CREATE TRIGGER IF NOT EXISTS book_search_insert
+    AFTER INSERT ON book
+    BEGIN
+        DELETE FROM book_search WHERE rowid = new.id;
+        INSERT INTO book_search (rowid, title, author)
+        VALUES (
+            new.id,
+            new.title,
+            COALESCE((SELECT name FROM author WHERE id = new.authorID), '')
+        );
+    END
+    ''',
+    '''
+    CREATE TRIGGER IF NOT EXISTS book_search_update
+    AFTER UPDATE OF id, title, authorID ON book
+    BEGIN
+        DELETE FROM book_search WHERE rowid = old.id;
+        INSERT INTO book_search (rowid, title, author)
+        VALUES (
+            new.id,
+            new.title,
+            COALESCE((SELECT name FROM author WHERE id = new.authorID), '')
+        );
+    END
+    ''',
+    '''
+    CREATE TRIGGER IF NOT EXISTS book_search_delete
+    AFTER DELETE ON book
+    BEGIN
+        DELETE FROM book_search WHERE rowid = old.id;
+    END
+    ''',
+    '''
+    CREATE TRIGGER IF NOT EXISTS author_search_insert
+    AFTER INSERT ON author
+    BEGIN
+        UPDATE book_search
+        SET author = new.name
+        WHERE rowid IN (SELECT id FROM book WHERE authorID = new.id);
+    END
+    ''',
+    '''
+    CREATE TRIGGER IF NOT EXISTS author_search_update
+    AFTER UPDATE OF id, name ON author
+    BEGIN
+        UPDATE book_search
+        SET author = ''
+        WHERE rowid IN (SELECT id FROM book WHERE authorID = old.id);
+        UPDATE book_search
+        SET author = new.name
+        WHERE rowid IN (SELECT id FROM book WHERE authorID = new.id);
+    END
+    ''',
+    '''
+    CREATE TRIGGER IF NOT EXISTS author_search_delete
+    AFTER DELETE ON author
+    BEGIN
+        UPDATE book_search
+        SET author = ''
+        WHERE rowid IN (SELECT id FROM book WHERE authorID = old.id);
+    END
+    ''',
+)
+
+
+def create_search_index(cursor):
+    """
+    This function creates the full-text search index and its triggers, and
+    fills the index from the existing books the first time it is created.
+
+    Parameters:
+        cursor (sqlite3.Cursor): The cursor used to run the statements.
+
+    Returns:
+        bool: False if this build of SQLite does not include FTS5, in which
+              case searches fall back to a slower LIKE scan.
+    """
+    cursor.execute('''
+        SELECT 1 FROM sqlite_master WHERE name = 'book_search'
+    ''')
+
+    if cursor.fetchone() is None:
+        try:
+            cursor.execute(SEARCH_INDEX_TABLE)
+
+        # Carry on without the index if FTS5 is not available.
+        except sqlite3.OperationalError as error:
+            if 'fts5' in str(error):
+                return False
+            raise
+
+        # Index the books that already exist.
+        cursor.execute('''
+            INSERT INTO book_search (rowid, title, author)
+            SELECT book.id, book.title, COALESCE(author.name, '')
+            FROM book
+            LEFT JOIN author
+            ON book.authorID = author.id
+        ''')
+
+    for trigger in SEARCH_INDEX_TRIGGERS:
+        cursor.execute(trigger)
+
+    return True
+
+
+def build_search_query(text):
+    """
+    This function turns the words a user typed into an FTS5 query.
+
+    Words in double quotes are matched as a phrase. Every other word is
+    matched as a prefix, so "lor rin" finds "The Lord of the Rings". All the
+    words and phrases must match.
+
+    Parameters:
+        text (str): The search text entered by the user.
+
+    Returns:
+        str: The FTS5 MATCH expression.
+
+    Raises:
+        ValidationError: If the text contains no words to search for.
+    """
+    terms = []
+
+    # Even-numbered parts are outside quotes, odd-numbered parts are phrases.
+    for index, part in enumerate(str(text).split('"')):
+        if index % 2:
+            if part.strip():
+                terms.append('"{}"'.format(part.strip()))
+            continue
+
+        for word in part.split():
+            terms.append('"{}"*'.format(word))
+
+    if not terms:
+        raise ValidationError("Please enter a title or author to search for.")
+
+    return " AND ".join(terms)
+
+
+# ========== SQL Statements ==========
+
+class Statement(NamedTuple):
+    """
+    A named SQL statement, with sample parameters for planning it.
+
+    Attributes:
+        sql (str): The statement. Every caller passes this same string, so
+                   each connection compiles it once and then reuses it from
+                   its statement cache.
+        sample (tuple): Parameters for EXPLAIN QUERY PLAN.
+        scan_allowed (bool): True if the statement is meant to read a whole
+                             table, so check_query_plans() does not report
+                             it.
+    """
+    sql: str
+    sample: tuple = ()
+    scan_allowed: bool = False
+
+
+# Every query and change the module makes at run time, by name. Schema
+# changes, which run once, are kept with their migration steps. Each
+# statement reads only the columns its caller uses.
+STATEMENTS = {
+    # ===== Books =====
+    'get_book': Statement('''
+        SELECT id, title, authorID, qty FROM book WHERE id = ?
+    ''', (3001,)),
+    'list_books': Statement('''
+        SELECT id, title, authorID, qty
+        FROM book
+        WHERE id > ?
+        ORDER BY id
+        LIMIT ?
+    ''', (0, 20)),
+    'list_book_details': Statement('''
+        SELECT book.id, book.title, book.authorID, book.qty,
+               author.name, author.country
+        FROM book
+        INNER JOIN author
+        ON book.authorID = author.id
+        WHERE book.id > ?
+        ORDER BY book.id
+        LIMIT ?
+    ''', (0, 20)),
+    'reorder_report': Statement('''
+        SELECT book.id, book.title, book.authorID, author.name,
+               book.qty, book.reorder_level
+        FROM book
+        LEFT JOIN author
+        ON book.authorID = author.id
+        WHERE book.qty < book.reorder_level AND book.id > ?
+        ORDER BY book.id
+        LIMIT ?
+    ''', (0, 20)),
+    'insert_book': Statement('''
+        INSERT INTO book (id, title, authorID, qty)
+        VALUES(?, ?, ?, ?)
+    ''', (3001, "A Tale of Two Cities", 1290, 30)),
+    'set_book_title': Statement('''
+        UPDATE book SET title = ? WHERE id = ?
+    ''', ("A Tale of Two Cities", 3001)),
+    'set_book_author': Statement('''
+        UPDATE book SET authorID = ? WHERE id = ?
+    ''', (1290, 3001)),
+    'set_book_qty': Statement('''
+        UPDATE book SET qty = ? WHERE id = ?
+    ''', (1, 3001)),
+    'set_book_reorder_level': Statement('''
+        UPDATE book SET reorder_level = ? WHERE id = ?
+    ''', (5, 3001)),
+    'change_stock': Statement('''
+        UPDATE book
+        SET qty = COALESCE(?, qty) + ?
+        WHERE id = ? AND COALESCE(?, qty) + ? >= 0
+    ''', (None, -1, 3001, None, -1)),
+    'delete_book': Statement('''
+        DELETE FROM book WHERE id = ?
+    ''', (3001,)),
+
+    # ===== Search =====
+    'search_books': Statement('''
+        SELECT book.id, book.title, book_search.author, book.qty,
+               snippet(book_search, -1, ?, ?, '...', 12),
+               bm25(book_search, 10.0, 1.0) AS score
+        FROM book_search
+        INNER JOIN book
+        ON book.id = book_search.rowid
+        WHERE book_search MATCH ?
+        ORDER BY score
+        LIMIT ?
+    ''', ('[', ']', '"tale"*', 20)),
+    # The fallback when SQLite was built without FTS5.
+    'search_books_like': Statement('''
+        SELECT book.id, book.title, author.name, book.qty, book.title, 0
+        FROM book
+        LEFT JOIN author
+        ON book.authorID = author.id
+        WHERE book.title LIKE ? OR author.name LIKE ?
+        ORDER BY book.id
+        LIMIT ?
+    ''', ('%tale%', '%tale%', 20), scan_allowed=True),
+
+    # ===== Authors =====
+    'get_author': Statement('''
+        SELECT id, name, country FROM author WHERE id = ?
+    ''', (1290,)),
+    'upsert_author': Statement('''
+        INSERT INTO author (id, name, country)
+        VALUES(?, ?, ?)
+        ON CONFLICT(id) DO UPDATE
+        SET name = excluded.name, country = excluded.country
+    ''', (1290, "Charles Dickens", "England")),
+
+    # ===== ID allocation =====
+    'next_id': Statement('''
+        SELECT next_id FROM id_allocator WHERE kind = ?
+    ''', ('book',)),
+    # The first ID in use at or after a point, and the first free ID after
+    # the run of used IDs starting there. Both seek on the primary key.
+    'first_used_book_id': Statement('''
+        SELECT MIN(id) FROM book WHERE id >= ?
+    ''', (1000,)),
+    'first_used_author_id': Statement('''
+        SELECT MIN(id) FROM author WHERE id >= ?
+    ''', (1000,)),
+    'end_of_used_book_ids': Statement('''
+        SELECT used.id + 1
+        FROM book AS used
+        WHERE used.id >= ?
+        AND NOT EXISTS (
+            SELECT 1 FROM book WHERE id = used.id + 1
+        )
+        ORDER BY used.id
+        LIMIT 1
+    ''', (3001,)),
+    'end_of_used_author_ids': Statement('''
+        SELECT used.id + 1
+        FROM author AS used
+        WHERE used.id >= ?
+        AND NOT EXISTS (
+            SELECT 1 FROM author WHERE id = used.id + 1
+        )
+        ORDER BY used.id
+        LIMIT 1
+    ''', (1290,)),
+    'save_next_id': Statement('''
+        INSERT INTO id_allocator (kind, next_id)
+        VALUES (?, ?)
+        ON CONFLICT (kind) DO UPDATE SET next_id = excluded.next_id
+    ''', ('book', 1000)),
+
+    # ===== Change log =====
+    'changes_since': Statement('''
+        SELECT seq, table_name, row_id, operation, data, changed_at
+        FROM change_log
+        WHERE seq > ?
+        ORDER BY seq
+        LIMIT ?
+    ''', (0, 1000)),
+    'prune_changes': Statement('''
+        DELETE FROM change_log WHERE seq <= ?
+    ''', (0,)),
+    # sqlite_sequence holds the last seq handed out, even once the entries
+    # themselves have been pruned. It has one row per table, so scanning it
+    # is cheap.
+    'change_log_range': Statement('''
+        SELECT MIN(seq), (
+            SELECT COALESCE(MAX(seq), 0) FROM sqlite_sequence
+            WHERE name = 'change_log'
+        )
+        FROM change_log
+    ''', scan_allowed=True),
+    'changed_rows': Statement('''
+        SELECT DISTINCT table_name, row_id
+        FROM change_log
+        WHERE seq > ?
+    ''', (0,)),
+
+    # ===== Snapshots, imports and exports =====
+    'snapshot_books': Statement('''
+        SELECT id, title, authorID, qty FROM book ORDER BY id
+    ''', scan_allowed=True),
+    'snapshot_authors': Statement('''
+        SELECT id, name, country FROM author
+    ''', scan_allowed=True),
+    # Existing rows are updated, so a supplier feed can be loaded again to
+    # refresh the catalogue.
+    'import_books': Statement('''
+        INSERT INTO book (id, title, authorID, qty)
+        VALUES(?, ?, ?, ?)
+        ON CONFLICT(id) DO UPDATE
+        SET title = excluded.title,
+            authorID = excluded.authorID,
+            qty = excluded.qty
+    ''', (3001, "A Tale of Two Cities", 1290, 30)),
+    'import_authors': Statement('''
+        INSERT INTO author (id, name, country)
+        VALUES(?, ?, ?)
+        ON CONFLICT(id) DO UPDATE
+        SET name = excluded.name, country = excluded.country
+    ''', (1290, "Charles Dickens", "England")),
+    # The columns are those in EXPORT_COLUMNS.
+    'export_books': Statement('''
+        SELECT id, title, authorID, qty, reorder_level
+        FROM book
+        WHERE id > ?
+        ORDER BY id
+        LIMIT ?
+    ''', (0, 5000)),
+    'export_authors': Statement('''
+        SELECT id, name, country
+        FROM author
+        WHERE id > ?
+        ORDER BY id
+        LIMIT ?
+    ''', (0, 5000)),
+}
+
+
+# ========== Query Plan Checks ==========
+
+# The secondary indexes. book(authorID) serves the author join and every
+# per-author lookup, including the search index triggers.
+SECONDARY_INDEXES = (
+    "CREATE INDEX IF NOT EXISTS book_author_idx ON book (authorID)",
+    "CREATE INDEX IF NOT EXISTS book_title_idx ON book (title)",
+    "CREATE INDEX IF NOT EXISTS author_name_idx ON author (name)",
+)
+
+# The partial index behind the reorder report. Its WHERE clause must match
+# the report's exactly for SQLite to use it.
+REORDER_INDEX = '''
+    CREATE INDEX IF NOT EXISTS book_reorder_idx ON book (id)
+    WHERE qty < reorder_level
+'''
+
+# Lookups that are not in STATEMENTS, as the module never runs them itself,
+# but that check_query_plans() plans to make sure each secondary index is
+# still used. The search index triggers find an author's books the same way
+# as books_by_author.
+PLAN_PROBES = {
+    'books_by_author': Statement('''
+        SELECT id FROM book WHERE authorID = ?
+    ''', (1290,)),
+    'books_by_title': Statement('''
+        SELECT id FROM book WHERE title = ?
+    ''', ("A Tale of Two Cities",)),
+    'authors_by_name': Statement('''
+        SELECT id FROM author WHERE name = ?
+    ''', ("Charles Dickens",)),
+}
+
+
+class PlanProblem(NamedTuple):
+    """A full table scan found in the plan of a statement."""
+    name: str
+    detail: str
+
+
+def explain_query_plan(conn, sql, parameters=()):
+    """
+    This function returns the query plan SQLite would use for a statement,
+    without running the statement.
+
+    Parameters:
+        conn (sqlite3.Connection): The connection to plan the statement on.
+        sql (str): The statement to plan.
+        parameters (tuple): Sample parameters for the statement.
+
+    Returns:
+        list: The "detail" text of each step in the plan.
+    """
+    rows = conn.execute(f"EXPLAIN QUERY PLAN {sql}", parameters).fetchall()
+
+    return [row[-1] for row in rows]
+
+
+def is_full_scan(detail):
+    """
+    This function checks whether a step of a query plan reads a whole table.
+
+    Searches of a virtual table, such as an FTS5 MATCH, are not full scans.
+
+    Parameters:
+        detail (str): The "detail" text of one step of a query plan.
+
+    Returns:
+        bool: True if the step scans a whole table or index.
+    """
+    return detail.startswith('SCAN') and 'VIRTUAL TABLE' not in detail
+
+
+def check_query_plans(statements=None, database=None):
+    """
+    This function runs EXPLAIN QUERY PLAN on each statement the module issues
+    and reports every statement that cannot be planned, and every unexpected
+    full table scan.
+
+    Parameters:
+        statements (dict): Statement entries to check, by name. Defaults to
+                           STATEMENTS and PLAN_PROBES.
+        database (str): The path of the SQLite database file. Defaults to
+                        DB_NAME.
+
+    Returns:
+        list: A PlanProblem for each problem that was found.
+    """
+    problems = []
+
+    with _connection_block(database=database) as conn:
+        for name, statement in (statements
+                                or {**STATEMENTS, **PLAN_PROBES}).items():
+            try:
+                plan = explain_query_plan(conn, statement.sql,
+                                          statement.sample)
+
+            # Report statements that cannot be planned, such as a search
+            # when the search index is missing.
+            except sqlite3.OperationalError as error:
+                problems.append(PlanProblem(name, f"Cannot plan: {error}"))
+                continue
+
+            if statement.scan_allowed:
+                continue
+
+            for detail in plan:
+                if is_full_scan(detail):
+                    problems.append(PlanProblem(name, detail))
+
+    return problems
+
+
+def warn_about_query_plans(database=None):
+    """
+    This function prints a warning to stderr for each problem that
+    check_query_plans() finds, so a missing index is reported before the
+    first slow query.
+
+    Parameters:
+        database (str): The path of the SQLite database file. Defaults to
+                        DB_NAME.
+    """
+    for problem in check_query_plans(database=database):
+        print(f"Warning: {problem.name}: {problem.detail}", file=sys.stderr)
+
+
+# ========== Schema Migrations ==========
+
+# The number of rows copied in each transaction when a table is rebuilt.
+REBUILD_BATCH_SIZE = 10_000
+
+
+class MigrationError(Exception):
+    """Raised when a migration step cannot be applied."""
+
+
+class Migration(NamedTuple):
+    """
+    One step in the schema history.
+
+    Attributes:
+        version (int): The schema version once the step has been applied.
+        description (str): What the step changes.
+        apply (function): Makes the change, given the connection.
+        online (bool): If True, the step manages its own transactions, so
+                       it can work in batches while the database is in use,
+                       and records the new version itself. It returns False
+                       if another process applied it first. Otherwise the
+                       whole step runs in one transaction.
+    """
+    version: int
+    description: str
+    apply: Callable[[sqlite3.Connection], None]
+    online: bool = False
+
+
+# The migration steps, in the order they are applied.
+MIGRATIONS = []
+
+
+def migration(version, description, online=False):
+    """
+    This decorator registers a function as the migration step that brings
+    the schema up to "version".
+
+    Parameters:
+        version (int): The schema version once the step has been applied.
+        description (str): What the step changes.
+        online (bool): True if the step manages its own transactions.
+
+    Returns:
+        function: The decorator.
+    """
+    def register(apply):
+        if MIGRATIONS and version != MIGRATIONS[-1].version + 1:
+            raise ValueError(f"Migration {version} is out of order.")
+
+        MIGRATIONS.append(Migration(version, description, apply, online))
+        return apply
+
+    return register
+
+
+def schema_version(conn):
+    """
+    This function returns the schema version stored in the database file.
+
+    Parameters:
+        conn (sqlite3.Connection): The connection to the database.
+
+    Returns:
+        int: The version of the last migration applied, 0 for a new or
+             legacy database.
+    """
+    return conn.execute("PRAGMA user_version").fetchone()[0]
+
+
+def set_schema_version(conn, version):
+    """
+    This function records the schema version in the database file.
+
+    Parameters:
+        conn (sqlite3.Connection): The connection to the database.
+        version (int): The version of the last migration applied.
+    """
+    conn.execute(f"PRAGMA user_version = {int(version)}")
+
+
+def migrate(target=None, database=None):
+    """
+    This function brings the schema up to date by applying, in order, every
+    migration step newer than the database's schema version.
+
+    Each step runs in its own transaction, and the version is re-checked
+    once the write lock is held, so several processes can start at once
+    without applying a step twice.
+
+    Parameters:
+        target (int): The version to stop at. Defaults to the latest.
+        database (str): The path of the SQLite database file. Defaults to
+                        DB_NAME.
+
+    Returns:
+        list: The Migration steps that were applied.
+    """
+    target = MIGRATIONS[-1].version if target is None else target
+    conn = get_connection(database)
+    applied = []
+
+    # Most of the time the schema is already up to date.
+    if schema_version(conn) >= target:
+        return applied
+
+    for step in MIGRATIONS:
+        if step.version > target or step.version <= schema_version(conn):
+            continue
+
+        if step.online:
+            if step.apply(conn) is False:
+                continue
+
+        else:
+            with transaction(database):
+                # Another process may have applied the step already.
+                if step.version <= schema_version(conn):
+                    continue
+
+                step.apply(conn)
+                set_schema_version(conn, step.version)
+
+        applied.append(step)
+
+    return applied
+
+
+def rebuild_table(conn, table, create_sql, columns, version,
+                  batch_size=REBUILD_BATCH_SIZE):
+    """
+    This function rebuilds a table with a new definition, copying the rows
+    across in batches so readers and writers can keep working.
+
+    While the copy runs, triggers on the old table pass every insert, update
+    and delete on to the new table, so changes made part way through are
+    not lost. Once every row has been copied, the new table replaces the old
+    one in a single short transaction. The indexes and triggers of the old
+    table are created again on the new one.
+
+    Parameters:
+        conn (sqlite3.Connection): The connection to the database.
+        table (str): The table to rebuild.
+        create_sql (str): The CREATE TABLE statement for the new definition,
+                          with "{table}" where the table name goes.
+        columns (tuple): The columns copied from the old table. The first
+                         column must be the integer primary key.
+        version (int): The schema version recorded when the table is
+                       swapped in.
+        batch_size (int): The number of rows copied in each transaction.
+
+    Returns:
+        bool: False if the schema was already at "version", so nothing was
+              rebuilt.
+
+    Raises:
+        MigrationError: If another rebuild of the table is in progress.
+    """
+    new_table = f"{table}_rebuild"
+    key = columns[0]
+    column_list = ", ".join(columns)
+    new_values = ", ".join(f"new.{column}" for column in columns)
+
+    # ===== Create the new table and the triggers that keep it in step =====
+    with transaction(conn.database):
+        # Another process may have finished the rebuild already.
+        if schema_version(conn) >= version:
+            return False
+
+        # The copy triggers of a rebuild that is still running, or that was
+        # interrupted, must be dealt with before starting again.
+        if conn.execute('''
+            SELECT 1 FROM sqlite_master WHERE type = 'trigger' AND name = ?
+        ''', (f"{new_table}_insert",)).fetchone():
+            raise MigrationError(
+                f"A rebuild of the {table} table is already in progress. If "
+                f"it was interrupted, drop the {new_table}_insert, "
+                f"{new_table}_update and {new_table}_delete triggers and "
+                "migrate again."
+            )
+
+        conn.execute(f"DROP TABLE IF EXISTS {new_table}")
+        conn.execute(create_sql.format(table=new_table))
+
+        conn.execute(f'''
+            CREATE TRIGGER {new_table}_insert AFTER INSERT ON {table}
+            BEGIN
+                INSERT OR REPLACE INTO {new_table} ({column_list})
+                VALUES ({new_values});
+            END
+        ''')
+        conn.execute(f'''
+            CREATE TRIGGER {new_table}_update AFTER UPDATE ON {table}
+            BEGIN
+                DELETE FROM {new_table} WHERE {key} = old.{key};
+                INSERT OR REPLACE INTO {new_table} ({column_list})
+                VALUES ({new_values});
+            END
+        ''')
+        conn.execute(f'''
+            CREATE TRIGGER {new_table}_delete AFTER DELETE ON {table}
+            BEGIN
+                DELETE FROM {new_table} WHERE {key} = old.{key};
+            END
+        ''')
+
+    # ===== Copy the rows across, one batch per transaction =====
+    last_key, operator = -2 ** 63, '>='
+
+    while True:
+        with transaction(conn.database):
+            rows = conn.execute(f'''
+                SELECT {key} FROM {table}
+                WHERE {key} {operator} ?
+                ORDER BY {key}
+                LIMIT ?
+            ''', (last_key, batch_size)).fetchall()
+
+            if not rows:
+                break
+
+            # Rows the triggers have already written are newer, so keep them.
+            conn.execute(f'''
+                INSERT INTO {new_table} ({column_list})
+                SELECT {column_list} FROM {table}
+                WHERE {key} BETWEEN ? AND ?
+                ON CONFLICT ({key}) DO NOTHING
+            ''', (rows[0][0], rows[-1][0]))
+
+        last_key, operator = rows[-1][0], '>'
+
+    # ===== Swap the new table in =====
+    with transaction(conn.database):
+        # Keep the indexes and triggers, other than the copy triggers, so
+        # they can be created again once the new table is in place.
+        schema = conn.execute('''
+            SELECT type, sql FROM sqlite_master
+            WHERE type IN ('index', 'trigger')
+            AND sql IS NOT NULL
+            AND name NOT LIKE ?
+            AND (type = 'trigger' OR tbl_name = ?)
+        ''', (f"{new_table}_%", table)).fetchall()
+
+        # Triggers on other tables may refer to the old table, so they are
+        # dropped while it is renamed.
+        for (name,) in conn.execute('''
+            SELECT name FROM sqlite_master WHERE type = 'trigger'
+        ''').fetchall():
+            conn.execute(f"DROP TRIGGER {name}")
+
+        conn.execute(f"DROP TABLE {table}")
+        conn.execute(f"ALTER TABLE {new_table} RENAME TO {table}")
+
+        for _, sql in schema:
+            conn.execute(sql)
+
+        set_schema_version(conn, version)
+
+    return True
+
+
+@migration(1, "Create the book and author tables")
+def _create_tables(conn):
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS book (
+            id INTEGER PRIMARY KEY,
+            title TEXT NOT NULL,
+            authorID INTEGER NOT NULL,
+            qty INTEGER NOT NULL
+        )
+    ''')
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS author (
+            id INTEGER PRIMARY KEY,
+            name TEXT NOT NULL,
+            country TEXT NOT NULL
+        )
+    ''')
+
+
+@migration(2, "Index book(authorID), book(title) and author(name)")
+def _create_secondary_indexes(conn):
+    for statement in SECONDARY_INDEXES:
+        conn.execute(statement)
+
+
+@migration(3, "Create the full-text search index")
+def _create_search_index(conn):
+    create_search_index(conn.cursor())
+
+
+@migration(4, "Add a qty >= 0 check to book", online=True)
+def _add_book_constraints(conn):
+    # SQLite cannot add a CHECK constraint to an existing table. The author
+    # of a book is checked by add_book(), set_book_author() and the import
+    # instead of a foreign key, which SQLite only enforces when every
+    # connection turns it on.
+    return rebuild_table(conn, 'book', '''
+        CREATE TABLE {table} (
+            id INTEGER PRIMARY KEY,
+            title TEXT NOT NULL,
+            authorID INTEGER NOT NULL,
+            qty INTEGER NOT NULL CHECK (qty >= 0)
+        )
+    ''', ('id', 'title', 'authorID', 'qty'), version=4)
+
+
+@migration(5, "Create the ID allocator table")
+def _create_id_allocator(conn):
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS id_allocator (
+            kind TEXT PRIMARY KEY,
+            next_id INTEGER NOT NULL
+        )
+    ''')
+
+
+def create_change_log_triggers(conn, table, columns):
+    """
+    This function creates the triggers that record every insert, update and
+    delete on a table in the change log, replacing any that already exist,
+    so they can be re-created when the table gains a column.
+
+    Parameters:
+        conn (sqlite3.Connection): The connection to the database.
+        table (str): 'book' or 'author'.
+        columns (tuple): The columns recorded for each inserted or updated
+                         row. Each migration passes the columns its version
+                         of the table has.
+    """
+    def record(row, operation):
+        if operation == 'delete':
+            data = 'NULL'
+        else:
+            data = "json_object({})".format(", ".join(
+                f"'{column}', {row}.{column}"
+                for column in columns
+            ))
+
+        return f'''
+            INSERT INTO change_log (table_name, row_id, operation, data)
+            VALUES ('{table}', {row}.id, '{operation}', {data});
+        '''
+
+    triggers = (
+        ('insert', 'INSERT', '', record('new', 'insert')),
+        ('update', 'UPDATE', 'WHEN old.id = new.id',
+         record('new', 'update')),
+        # A change of ID is logged as a delete and an insert.
+        ('rekey', 'UPDATE', 'WHEN old.id <> new.id',
+         record('old', 'delete') + record('new', 'insert')),
+        ('delete', 'DELETE', '', record('old', 'delete')),
+    )
+
+    for name, event, condition, body in triggers:
+        conn.execute(f"DROP TRIGGER IF EXISTS {table}_change_log_{name}")
+        conn.execute(f'''
+            CREATE TRIGGER {table}_change_log_{name}
+            AFTER {event} ON {table} {condition}
+            BEGIN {body} END
+        ''')
+
+
+@migration(6, "Record every book and author change in a change log")
+def _create_change_log(conn):
+    # AUTOINCREMENT, so a sequence number is never handed out twice, even
+    # after old entries have been deleted.
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS change_log (
+            seq INTEGER PRIMARY KEY AUTOINCREMENT,
+            table_name TEXT NOT NULL,
+            row_id INTEGER NOT NULL,
+            operation TEXT NOT NULL,
+            data TEXT,
+            changed_at TEXT NOT NULL
+                DEFAULT (strftime('%Y-%m-%dT%H:%M:%fZ', 'now'))
+        )
+    ''')
+
+    create_change_log_triggers(conn, 'book',
+                               ('id', 'title', 'authorID', 'qty'))
+    create_change_log_triggers(conn, 'author', ('id', 'name', 'country'))
+
+
+@migration(7, "Add book.reorder_level and index the books below it")
+def _add_reorder_level(conn):
+    conn.execute('''
+        ALTER TABLE book
+        ADD COLUMN reorder_level INTEGER NOT NULL DEFAULT 0
+        CHECK (reorder_level >= 0)
+    ''')
+
+    # Only the books below their reorder level are in the index, so the
+    # report reads those rows and nothing else.
+    conn.execute(REORDER_INDEX)
+
+    # Record the new column in the change log too.
+    create_change_log_triggers(
+        conn, 'book', ('id', 'title', 'authorID', 'qty', 'reorder_level')
+    )
+
+
+# ========== Display Settings ==========
+
+# The number of books shown, and held in memory, per page of a listing.
+PAGE_SIZE = 20
+
+# If False, the update and delete options go straight to the ID prompt
+# instead of listing the books first.
+LIST_BOOKS_BEFORE_EDIT = True
+
+
+# ========== ID Settings ==========
+
+# The largest ID SQLite can store in an integer primary key.
+MAX_ID = 2 ** 63 - 1
+
+# The smallest and largest ID accepted for each kind of record.
+ID_RANGES = {
+    'book': (1000, MAX_ID),
+    'author': (1000, MAX_ID),
+}
+
+
+def configure_id_range(kind, low, high):
+    """
+    This function sets the range of IDs accepted for books or authors, and
+    the range new IDs are allocated from.
+
+    Parameters:
+        kind (str): 'book' or 'author'.
+        low (int): The smallest ID.
+        high (int): The largest ID.
+    """
+    if kind not in ID_RANGES:
+        raise ValueError(f"Unknown kind of ID: {kind}")
+
+    if not 1 <= low <= high <= MAX_ID:
+        raise ValueError(f"Invalid ID range: {low} to {high}")
+
+    ID_RANGES[kind] = (low, high)
+
+
+# ========== Service Errors ==========
+
+class InventoryError(Exception):
+    """The base class for errors raised by the Inventory service."""
+
+
+class ValidationError(InventoryError, ValueError):
+    """Raised when a value does not pass the inventory's validation rules."""
+
+
+class BookNotFoundError(InventoryError, LookupError):
+    """Raised when a book ID does not exist in the book table."""
+
+
+class AuthorNotFoundError(InventoryError, LookupError):
+    """Raised when an author ID does not exist in the author table."""
+
+
+class DuplicateBookError(InventoryError):
+    """Raised when a book ID is already used by another book."""
+
+
+class InsufficientStockError(InventoryError):
+    """Raised when a stock change would take a quantity below zero."""
+
+
+class IdRangeError(InventoryError):
+    """Raised when there are no IDs left to allocate in an ID range."""
+
+
+# ========== Service Records ==========
+
+class Book(NamedTuple):
+    """A row of the book table."""
+    id: int
+    title: str
+    author_id: int
+    qty: int
+
+
+class Author(NamedTuple):
+    """A row of the author table."""
+    id: int
+    name: str
+    country: str
+
+
+class BookDetails(NamedTuple):
+    """A book joined with the name and country of its author."""
+    id: int
+    title: str
+    author_id: int
+    qty: int
+    author_name: Optional[str]
+    author_country: Optional[str]
+
+
+class ReorderItem(NamedTuple):
+    """A book whose quantity has fallen below its reorder level."""
+    id: int
+    title: str
+    author_id: int
+    author_name: Optional[str]
+    qty: int
+    reorder_level: int
+
+    @property
+    def shortfall(self) -> int:
+        """The number of copies needed to reach the reorder level."""
+        return self.reorder_level - self.qty
+
+
+class Change(NamedTuple):
+    """
+    An entry in the change log. data holds the row's columns after an
+    insert or update, and is None for a delete.
+    """
+    seq: int
+    table: str
+    row_id: int
+    operation: str
+    data: Optional[dict]
+    changed_at: str
+
+
+class SearchResult(NamedTuple):
+    """A book found by a title or author search."""
+    id: int
+    title: str
+    author_name: Optional[str]
+    qty: int
+    snippet: str
+    score: float
+
+
+# ========== Validation Functions ==========
+
+def validate_id(value, label="book"):
+    """
+    This function checks that an ID is a whole number within the ID range
+    of its kind (see ID_RANGES).
+
+    Parameters:
+        value (int or str): The ID to check.
+        label (str): The kind of ID: 'book' or 'author'.
+
+    Returns:
+        int: The ID as an integer.
+
+    Raises:
+        ValidationError: If the ID is not a whole number within the range.
+    """
+    low, high = ID_RANGES[label]
+
+    try:
+        number = int(str(value).strip())
+
+    except ValueError:
+        raise ValidationError(
+            f"Invalid input. The {label} id must be a whole number from "
+            f"{low} to {high}."
+        ) from None
+
+    if not low <= number <= high:
+        raise ValidationError(
+            f"The {label} id must be a whole number from {low} to {high}."
+        )
+
+    return number
+
+
+def validate_new_id(value, label="book"):
+    """
+    This function checks the ID of a new record, which may be left blank so
+    an unused ID is allocated instead.
+
+    Parameters:
+        value (int or str): The ID to check, or a blank value.
+        label (str): The kind of ID: 'book' or 'author'.
+
+    Returns:
+        int: The ID as an integer, or None if it was left blank.
+
+    Raises:
+        ValidationError: If the ID is not a whole number within the range.
+    """
+    if value is None or not str(value).strip():
+        return None
+
+    return validate_id(value, label)
+
+
+def validate_title(value):
+    """
+    This function checks that a book title is not blank.
+
+    Parameters:
+        value (str): The title to check.
+
+    Returns:
+        str: The title without surrounding whitespace.
+
+    Raises:
+        ValidationError: If the title is blank.
+    """
+    title = str(value).strip()
+
+    if not title:
+        raise ValidationError("The title cannot be blank.")
+
+    return title
+
+
+def validate_name(value, label="Author's name"):
+    """
+    This function checks an author's name or country. The value cannot be
+    blank, must start with a letter and cannot consist of numbers.
+
+    Parameters:
+        value (str): The name to check.
+        label (str): The kind of name, used in the error message.
+
+    Returns:
+        str: The name without surrounding whitespace.
+
+    Raises:
+        ValidationError: If the name is not valid.
+    """
+    name = str(value).strip()
+
+    if not name:
+        raise ValidationError("This field cannot be blank.")
+
+    if name.lstrip('-').isdigit():
+        raise ValidationError(f"The {label} cannot consist of numbers.")
+
+    if not name[0].isalpha():
+        raise ValidationError(f"The {label} should start with a letter.")
+
+    return name
+
+
+def validate_qty(value):
+    """
+    This function checks that a quantity is a whole number that is not
+    negative.
+
+    Parameters:
+        value (int or str): The quantity to check.
+
+    Returns:
+        int: The quantity as an integer.
+
+    Raises:
+        ValidationError: If the quantity is not a number or is negative.
+    """
+    try:
+        qty = int(str(value).strip())
+
+    except ValueError:
+        raise ValidationError(
+            "Invalid input. Please enter a positive number."
+        ) from None
+
+    if qty < 0:
+        raise ValidationError("Quantity cannot be negative.")
+
+    return qty
+
+
+def validate_delta(value):
+    """
+    This function checks that a stock change is a whole number. It may be
+    negative, to take stock away.
+
+    Parameters:
+        value (int or str): The change to check, such as 5, "+5" or "-2".
+
+    Returns:
+        int: The change as an integer.
+
+    Raises:
+        ValidationError: If the change is not a whole number.
+    """
+    try:
+        return int(str(value).strip())
+
+    except ValueError:
+        raise ValidationError(
+            "Invalid input. The stock change must be a whole number."
+        ) from None
+
+
+def validate_stock_change(value):
+    """
+    This function reads a quantity entered by the user. A number with a sign,
+    such as "+5" or "-2", is a change to the current quantity; a number
+    without one is the new quantity.
+
+    Parameters:
+        value (str): The quantity or change to check.
+
+    Returns:
+        tuple: (new quantity, None) or (None, change).
+
+    Raises:
+        ValidationError: If the value is not a valid quantity or change.
+    """
+    text = str(value).strip()
+
+    if text[:1] in ("+", "-"):
+        return None, validate_delta(text)
+
+    return validate_qty(text), None
+
+
+# ========== Lookup Cache ==========
+
+# The number of books, and of authors, each Inventory keeps cached.
+CACHE_SIZE = 4096
+
+# How often, in seconds, an Inventory reads the change log to find the books
+# and authors changed by other processes or other Inventory objects. A
+# cached value may be up to this much older than such a change.
+CACHE_CHECK_INTERVAL = 0.05
+
+# Marks a key that is not in the cache, as None is a valid cached value.
+_MISSING = object()
+
+
+class LRUCache:
+    """
+    A bounded, thread-safe mapping that evicts the least recently used entry
+    once it is full, and counts its hits, misses and evictions.
+
+    Attributes:
+        maxsize (int): The largest number of entries kept. 0 disables the
+                       cache.
+        generation (int): Increases every time an entry is invalidated, so a
+                          value loaded before an invalidation is not stored.
+    """
+
+    def __init__(self, maxsize=CACHE_SIZE):
+        self.maxsize = maxsize
+        self.generation = 0
+        self.hits = self.misses = self.evictions = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key, default=_MISSING):
+        """Return the cached value for key, marking it most recently used."""
+        with self._lock:
+            try:
+                value = self._entries[key]
+
+            except KeyError:
+                self.misses += 1
+                return default
+
+            self._entries.move_to_end(key)
+            self.hits += 1
+
+            return value
+
+    def put(self, key, value, generation=None):
+        """
+        Cache a value, evicting the least recently used entry if the cache
+        is full. If "generation" is given and an entry has been invalidated
+        since, the value may be out of date, so it is not stored.
+        """
+        with self._lock:
+            if not self.maxsize:
+                return
+
+            if generation is not None and generation != self.generation:
+                return
+
+            self._entries[key] = value
+            self._entries.move_to_end(key)
+
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def invalidate(self, key):
+        """Remove the cached value for key, if there is one."""
+        with self._lock:
+            self.generation += 1
+            self._entries.pop(key, None)
+
+    def clear(self):
+        """Remove every cached value."""
+        with self._lock:
+            self.generation += 1
+            self._entries.clear()
+
+    def stats(self):
+        """Return the size and the hit, miss and eviction counts."""
+        with self._lock:
+            return {
+                'size': len(self._entries),
+                'maxsize': self.maxsize,
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+            }
+
+
+# ========== ID Allocation ==========
+
+# The number of IDs an IdAllocator reserves at a time.
+ID_BLOCK_SIZE = 1000
+
+
+def allocate_ids(kind='book', count=1, database=None):
+    """
+    This function reserves unused IDs for new books or authors.
+
+    The next free ID of each kind is kept in the id_allocator table and
+    moved on in a short write transaction, so concurrent processes are
+    never handed the same ID. IDs already used in the table, including IDs
+    that were entered by hand, are skipped, so a single large ID entered by
+    hand does not use up the rest of the range.
+
+    Parameters:
+        kind (str): 'book' or 'author'.
+        count (int): The number of IDs to reserve.
+        database (str): The path of the SQLite database file. Defaults to
+                        DB_NAME.
+
+    Returns:
+        list: The reserved IDs, in ascending order.
+
+    Raises:
+        IdRangeError: If the ID range has fewer than "count" IDs left.
+    """
+    low, high = ID_RANGES[kind]
+    ids = []
+
+    with transaction(database) as conn:
+        row = conn.execute(STATEMENTS['next_id'].sql, (kind,)).fetchone()
+        cursor = max(low, row[0] if row else low)
+
+        while len(ids) < count:
+            if cursor > high:
+                raise IdRangeError(
+                    f"There are not enough {kind} IDs left in the range "
+                    f"{low} to {high}."
+                )
+
+            # The first used ID at or after the cursor, found by an index
+            # seek on the primary key.
+            used = conn.execute(
+                STATEMENTS[f'first_used_{kind}_id'].sql, (cursor,)
+            ).fetchone()[0]
+
+            if used != cursor:
+                end = min(high + 1, cursor + count - len(ids),
+                          high + 1 if used is None else used)
+                ids.extend(range(cursor, end))
+                cursor = end
+                continue
+
+            # Skip past the run of used IDs that starts at the cursor.
+            cursor = conn.execute(
+                STATEMENTS[f'end_of_used_{kind}_ids'].sql, (cursor,)
+            ).fetchone()[0]
+
+        conn.execute(STATEMENTS['save_next_id'].sql, (kind, cursor))
+
+    return ids
+
+
+class IdAllocator:
+    """
+    Hands out new IDs to any number of threads, reserving them from the
+    database a block at a time, so a bulk load takes the write lock once per
+    block rather than once per ID. IDs left in a block when the allocator is
+    discarded are never used.
+
+    Attributes:
+        kind (str): 'book' or 'author'.
+        block_size (int): The number of IDs reserved at a time.
+        database (str): The path of the SQLite database file.
+    """
+
+    def __init__(self, kind='book', block_size=ID_BLOCK_SIZE, database=None):
+        self.kind = kind
+        self.block_size = block_size
+        self.database = database
+        self._block = iter(())
+        self._lock = threading.Lock()
+
+    def __call__(self) -> int:
+        """Return the next unused ID."""
+        with self._lock:
+            for new_id in self._block:
+                return new_id
+
+            self._block = iter(
+                allocate_ids(self.kind, self.block_size, self.database)
+            )
+
+            return next(self._block)
+
+
+# ========== Inventory Service ==========
+
+class Inventory:
+    """
+    The non-interactive service API for the bookstore inventory.
+
+    Every method validates its arguments, returns plain values and raises an
+    InventoryError instead of printing, so the inventory can be driven from
+    scripts, imports and servers. The menu is a thin client on top of it.
+
+    Book and author lookups by ID are cached, and a cached lookup does not
+    touch the database. Every write made through the Inventory invalidates
+    exactly the entries it changes, from whichever thread it is made. The
+    entries changed by anything else, such as another process, are found in
+    the change log, which is read at most every CACHE_CHECK_INTERVAL
+    seconds.
+
+    Attributes:
+        database (str): The path of the SQLite database file. None means
+                        DB_NAME.
+    """
+
+    def __init__(
+        self, database: Optional[str] = None, cache_size: int = CACHE_SIZE
+    ):
+        self.database = database
+        self._books = LRUCache(cache_size)
+        self._authors = LRUCache(cache_size)
+        self._change_seq = None
+        self._next_check = 0.0
+        self._check_lock = threading.Lock()
+
+    # ===== Connection helpers =====
+
+    def _read(self):
+        """Borrow the connection for a block of read-only queries."""
+        return _connection_block(database=self.database)
+
+    def _write(self):
+        """Borrow the connection for a write transaction."""
+        return transaction(self.database)
+
+    # ===== Units of work =====
+
+    def unit_of_work(self):
+        """
+        Group several changes into one transaction, which is committed when
+        the block finishes, or rolled back entirely if it raises:
+
+            with inventory.unit_of_work():
+                inventory.upsert_author(1290, "Charles Dickens", "England")
+                inventory.add_book(3001, "A Tale of Two Cities", 1290, 30)
+
+        Every Inventory method called inside the block joins the
+        transaction, so the whole edit is written with a single commit.
+        """
+        return transaction(self.database)
+
+    def savepoint(self):
+        """
+        Open a savepoint inside a unit of work. If the block raises, only
+        the changes made inside it are rolled back.
+        """
+        return savepoint(self.database)
+
+    # ===== Cache helpers =====
+
+    def _lookup(self, cache, key, load):
+        """
+        Return the cached value for key, or load it with load(conn, key) and
+        cache it. Inside a write transaction the value is always read from
+        the database, as the cached copy may be older than the write lock,
+        and it is not cached, as it may never be committed.
+        """
+        self._check_external_writes()
+
+        if not in_transaction(self.database):
+            value = cache.get(key)
+
+            if value is not _MISSING:
+                return value
+
+        with self._read() as conn:
+            generation = cache.generation
+            value = load(conn, key)
+
+            if not conn.in_transaction:
+                cache.put(key, value, generation)
+
+        return value
+
+    def _check_external_writes(self):
+        """
+        Invalidate the cached books and authors that have been changed by
+        anything other than this Inventory, as recorded in the change log.
+        Only one thread checks at a time, at most every
+        CACHE_CHECK_INTERVAL seconds.
+        """
+        now = time.monotonic()
+
+        if now < self._next_check or not self._check_lock.acquire(False):
+            return
+
+        try:
+            self._next_check = now + CACHE_CHECK_INTERVAL
+
+            with self._read() as conn:
+                first, seq = conn.execute(
+                    STATEMENTS['change_log_range'].sql
+                ).fetchone()
+
+                if seq == self._change_seq:
+                    return
+
+                # Start from the current position. Nothing has been cached
+                # yet, as this runs before the first lookup.
+                if self._change_seq is None:
+                    self._change_seq = seq
+                    return
+
+                # Drop everything if the database was replaced, or the
+                # changes since the last check have been pruned.
+                if (seq < self._change_seq or first is None
+                        or first > self._change_seq + 1):
+                    self.clear_cache()
+                    self._change_seq = seq
+                    return
+
+                changes = conn.execute(
+                    STATEMENTS['changed_rows'].sql, (self._change_seq,)
+                ).fetchall()
+
+            # This Inventory's own changes were invalidated when they were
+            # made, so invalidating them again only costs one extra read.
+            for table, row_id in changes:
+                cache = self._books if table == 'book' else self._authors
+                cache.invalidate(row_id)
+
+            self._change_seq = seq
+
+        # Without a change log, which only a database that has not been
+        # migrated lacks, any change may have been missed.
+        except sqlite3.OperationalError:
+            self.clear_cache()
+
+        finally:
+            self._check_lock.release()
+
+    @staticmethod
+    def _invalidate(conn, cache, key):
+        """
+        Remove a changed entry from the cache now, and again once the
+        transaction has finished, in case it was read back in the meantime.
+        """
+        cache.invalidate(key)
+        conn.on_finish.append(lambda: cache.invalidate(key))
+
+    def clear_cache(self) -> None:
+        """Remove every cached book and author."""
+        self._books.clear()
+        self._authors.clear()
+
+    def cache_stats(self) -> dict:
+        """Return the size, hits, misses and evictions of each cache."""
+        return {'books': self._books.stats(), 'authors': self._authors.stats()}
+
+    @staticmethod
+    def _load_book(conn, book_id):
+        row = conn.execute(
+            STATEMENTS['get_book'].sql, (book_id,)
+        ).fetchone()
+
+        return None if row is None else Book(*row)
+
+    @staticmethod
+    def _load_author(conn, author_id):
+        row = conn.execute(
+            STATEMENTS['get_author'].sql, (author_id,)
+        ).fetchone()
+
+        return None if row is None else Author(*row)
+
+    # ===== Books =====
+
+    def get_book(self, book_id: int) -> Book:
+        """
+        Return the book with the given ID.
+
+        Raises:
+            BookNotFoundError: If there is no book with that ID.
+        """
+        book_id = validate_id(book_id)
+        book = self._lookup(self._books, book_id, self._load_book)
+
+        if book is None:
+            raise BookNotFoundError(f"There are no books for id {book_id}")
+
+        return book
+
+    def get_book_details(self, book_id: int) -> BookDetails:
+        """
+        Return the book with the given ID, along with its author's name and
+        country.
+
+        Raises:
+            BookNotFoundError: If there is no book with that ID.
+        """
+        book = self.get_book(book_id)
+        author = self._lookup(self._authors, book.author_id,
+                              self._load_author)
+
+        if author is None:
+            return BookDetails(*book, None, None)
+
+        return BookDetails(*book, author.name, author.country)
+
+    def list_books(
+        self, after_id: int = 0, limit: Optional[int] = None
+    ) -> List[Book]:
+        """
+        Return the books with an ID greater than "after_id", ordered by ID.
+
+        The ID of the last book returned is the "after_id" of the next page,
+        so each page is found with an index seek rather than by skipping
+        rows. If limit is None, every remaining book is returned.
+        """
+        limit = -1 if limit is None else limit
+
+        with self._read() as conn:
+            cursor = conn.execute(
+                STATEMENTS['list_books'].sql, (after_id, limit)
+            )
+
+            return [Book(*row) for row in cursor.fetchall()]
+
+    def list_book_details(
+        self, after_id: int = 0, limit: Optional[int] = None
+    ) -> List[BookDetails]:
+        """
+        Return the books that have an author, with the author's details,
+        paginated in the same way as list_books().
+        """
+        limit = -1 if limit is None else limit
+
+        with self._read() as conn:
+            cursor = conn.execute(
+                STATEMENTS['list_book_details'].sql, (after_id, limit)
+            )
+
+            return [BookDetails(*row) for row in cursor.fetchall()]
+
+    def iter_books(
+        self, page_size: Optional[int] = None
+    ) -> Iterator[List[Book]]:
+        """
+        Yield every book, one page at a time, so only one page is held in
+        memory and the first page is available straight away.
+        """
+        return self._iter_pages(self.list_books, page_size or PAGE_SIZE)
+
+    def iter_book_details(
+        self, page_size: Optional[int] = None
+    ) -> Iterator[List[BookDetails]]:
+        """
+        Yield every book that has an author, with the author's details, one
+        page at a time.
+        """
+        return self._iter_pages(
+            self.list_book_details, page_size or PAGE_SIZE
+        )
+
+    def reorder_report(
+        self, after_id: int = 0, limit: Optional[int] = None
+    ) -> List[ReorderItem]:
+        """
+        Return the books whose quantity is below their reorder level,
+        paginated in the same way as list_books().
+
+        Only the books below their level are in the book_reorder_idx partial
+        index, so the cost follows the length of the report, not the size of
+        the catalogue.
+        """
+        limit = -1 if limit is None else limit
+
+        with self._read() as conn:
+            cursor = conn.execute(
+                STATEMENTS['reorder_report'].sql, (after_id, limit)
+            )
+
+            return [ReorderItem(*row) for row in cursor.fetchall()]
+
+    def iter_reorder_report(
+        self, page_size: Optional[int] = None
+    ) -> Iterator[List[ReorderItem]]:
+        """Yield the reorder report one page at a time."""
+        return self._iter_pages(self.reorder_report, page_size or PAGE_SIZE)
+
+    @staticmethod
+    def _iter_pages(list_page, page_size):
+        """
+        Yield pages from a keyset-paginated list method until it runs out.
+        """
+        if page_size < 1:
+            raise ValueError("The page size must be at least 1.")
+
+        after_id = 0
+
+        while True:
+            page = list_page(after_id, page_size)
+
+            if not page:
+                return
+
+            yield page
+
+            # The last page is the one that is not full.
+            if len(page) < page_size:
+                return
+
+            after_id = page[-1].id
+
+    def search_books(
+        self,
+        text: str,
+        limit: int = 20,
+        highlight: Tuple[str, str] = ('[', ']'),
+    ) -> List[SearchResult]:
+        """
+        Search book titles and author names, best matches first.
+
+        Words are matched as prefixes and words in double quotes as phrases
+        (see build_search_query()). Each result carries a snippet with the
+        matching words wrapped in the highlight markers.
+
+        Raises:
+            ValidationError: If the search text is blank or not valid.
+        """
+        query = build_search_query(text)
+
+        with self._read() as conn:
+            try:
+                rows = conn.execute(
+                    STATEMENTS['search_books'].sql,
+                    (*highlight, query, limit)
+                ).fetchall()
+
+            except sqlite3.OperationalError as error:
+                # Fall back to a LIKE scan if there is no search index.
+                if 'no such table' in str(error):
+                    return self._search_books_like(conn, text, limit)
+
+                raise ValidationError(f"Invalid search: {error}") from None
+
+        return [SearchResult(*row) for row in rows]
+
+    @staticmethod
+    def _search_books_like(conn, text, limit):
+        """Search titles and author names with a full scan, without FTS5."""
+        pattern = f"%{text.strip()}%"
+
+        rows = conn.execute(
+            STATEMENTS['search_books_like'].sql, (pattern, pattern, limit)
+        ).fetchall()
+
+        return [SearchResult(*row) for row in rows]
+
+    def add_book(
+        self, book_id: int, title: str, author_id: int, qty: int
+    ) -> Book:
+        """
+        Add a new book by an author that already exists.
+
+        Raises:
+            AuthorNotFoundError: If the author does not exist.
+            DuplicateBookError: If the book ID is already in use.
+        """
+        book = Book(
+            validate_id(book_id),
+            validate_title(title),
+            validate_id(author_id, "author"),
+            validate_qty(qty),
+        )
+
+        with self._write() as conn:
+            if not self.author_exists(book.author_id):
+                raise AuthorNotFoundError(
+                    f"The author ID {book.author_id} does not exist."
+                )
+
+            self._invalidate(conn, self._books, book.id)
+
+            try:
+                conn.execute(STATEMENTS['insert_book'].sql, book)
+
+            except sqlite3.IntegrityError:
+                raise DuplicateBookError(
+                    f"The book id {book.id} already exists in the database."
+                ) from None
+
+        return book
+
+    def new_book(self, title: str, author_id: int, qty: int) -> Book:
+        """
+        Add a new book under an unused ID, allocated from the book ID range.
+
+        Raises:
+            AuthorNotFoundError: If the author does not exist.
+            IdRangeError: If there are no book IDs left.
+        """
+        with self._write():
+            book_id = allocate_ids('book', database=self.database)[0]
+
+            return self.add_book(book_id, title, author_id, qty)
+
+    def update_qty(self, book_id: int, qty: int) -> Book:
+        """
+        Set the quantity of a book.
+
+        Raises:
+            BookNotFoundError: If there is no book with that ID.
+        """
+        book_id, qty = validate_id(book_id), validate_qty(qty)
+
+        return self._update_book(book_id, 'set_book_qty', qty)
+
+    def adjust_stock(self, book_id: int, delta: int) -> Book:
+        """
+        Add delta (which may be negative) to the quantity of a book.
+
+        The change is made by a single conditional UPDATE, so sales made at
+        the same moment on different connections are all counted, and none
+        of them can take the quantity below zero.
+
+        Raises:
+            BookNotFoundError: If there is no book with that ID.
+            InsufficientStockError: If there is not enough stock.
+        """
+        return self.adjust_stock_many([(book_id, delta)])[0]
+
+    def adjust_stock_many(
+        self, changes: Iterable[Tuple[int, int]]
+    ) -> List[Book]:
+        """
+        Apply several (book ID, delta) stock changes, such as the items of a
+        basket, in one transaction. Either every change is made or, if any
+        of them cannot be, none are.
+
+        Returns:
+            list: The updated books, in the order of the changes.
+
+        Raises:
+            BookNotFoundError: If there is no book with one of the IDs.
+            InsufficientStockError: If there is not enough stock for one of
+                                    the changes.
+        """
+        changes = [
+            (validate_id(book_id), validate_delta(delta))
+            for book_id, delta in changes
+        ]
+
+        with self._write() as conn:
+            for book_id, delta in changes:
+                self._invalidate(conn, self._books, book_id)
+
+                if self._change_stock(conn, book_id, None, delta):
+                    continue
+
+                book = self._load_book(conn, book_id)
+
+                if book is None:
+                    raise BookNotFoundError(
+                        f"There are no books for id {book_id}"
+                    )
+
+                raise InsufficientStockError(
+                    f"Not enough stock of book {book_id}: {book.qty} left, "
+                    f"{-delta} needed."
+                )
+
+            return [self._load_book(conn, book_id) for book_id, _ in changes]
+
+    def set_reorder_level(self, book_id: int, level: int) -> Book:
+        """
+        Set the quantity below which a book appears in the reorder report.
+        A level of 0 leaves the book out of the report.
+
+        Raises:
+            BookNotFoundError: If there is no book with that ID.
+        """
+        book_id, level = validate_id(book_id), validate_qty(level)
+
+        return self._update_book(book_id, 'set_book_reorder_level', level)
+
+    def update_title(self, book_id: int, title: str) -> Book:
+        """
+        Change the title of a book.
+
+        Raises:
+            BookNotFoundError: If there is no book with that ID.
+        """
+        book_id, title = validate_id(book_id), validate_title(title)
+
+        return self._update_book(book_id, 'set_book_title', title)
+
+    def set_book_author(self, book_id: int, author_id: int) -> Book:
+        """
+        Change the author of a book to an author that already exists.
+
+        Raises:
+            BookNotFoundError: If there is no book with that ID.
+            AuthorNotFoundError: If the author does not exist.
+        """
+        book_id = validate_id(book_id)
+        author_id = validate_id(author_id, "author")
+
+        with self._write():
+            if not self.author_exists(author_id):
+                raise AuthorNotFoundError(
+                    f"The author ID {author_id} does not exist."
+                )
+
+            return self._update_book(book_id, 'set_book_author', author_id)
+
+    def _update_book(self, book_id, statement, value):
+        """
+        Set one column of a book with the named statement, and return the
+        updated book.
+        """
+        with self._write() as conn:
+            self._invalidate(conn, self._books, book_id)
+
+            cursor = conn.execute(
+                STATEMENTS[statement].sql, (value, book_id)
+            )
+
+            if cursor.rowcount == 0:
+                raise BookNotFoundError(
+                    f"There are no books for id {book_id}"
+                )
+
+            return self.get_book(book_id)
+
+    def apply_stock_changes(
+        self, changes: Dict[int, List[Tuple[Optional[int], int]]]
+    ) -> Dict[int, List[object]]:
+        """
+        Apply queued stock changes to many books in one transaction.
+
+        Each book's changes are (new qty or None, delta) pairs in the order
+        they were made: a new qty replaces the quantity, a delta is added to
+        it. They are merged into one UPDATE per book. If the merged change
+        would take the quantity below zero, the changes are applied one at a
+        time instead, so only the ones that do not fit are refused.
+
+        Returns:
+            dict: For each book, one result per change: the book's quantity
+                  once the batch was written, or the exception explaining
+                  why the change was refused.
+        """
+        results = {}
+
+        with self._write() as conn:
+            for book_id, book_changes in changes.items():
+                self._invalidate(conn, self._books, book_id)
+
+                new_qty, delta = None, 0
+
+                for qty, change in book_changes:
+                    if qty is not None:
+                        new_qty, delta = qty, 0
+                    delta += change
+
+                if self._change_stock(conn, book_id, new_qty, delta):
+                    qty = self._load_book(conn, book_id).qty
+                    results[book_id] = [qty] * len(book_changes)
+                    continue
+
+                # The merged change did not fit, so apply them one by one.
+                if self._load_book(conn, book_id) is None:
+                    error = BookNotFoundError(
+                        f"There are no books for id {book_id}"
+                    )
+                    results[book_id] = [error] * len(book_changes)
+                    continue
+
+                outcomes = [
+                    self._change_stock(conn, book_id, qty, change)
+                    for qty, change in book_changes
+                ]
+                qty = self._load_book(conn, book_id).qty
+                results[book_id] = [
+                    qty if applied else InsufficientStockError(
+                        f"Not enough stock of book {book_id}."
+                    )
+                    for applied in outcomes
+                ]
+
+        return results
+
+    @staticmethod
+    def _change_stock(conn, book_id, qty, delta):
+        """
+        Set the quantity of a book to qty (or leave it, if qty is None) plus
+        delta, unless that would be negative. Returns True if it was changed.
+        """
+        cursor = conn.execute(
+            STATEMENTS['change_stock'].sql, (qty, delta, book_id, qty, delta)
+        )
+
+        return cursor.rowcount > 0
+
+    def delete_book(self, book_id: int) -> None:
+        """
+        Delete a book.
+
+        Raises:
+            BookNotFoundError: If there is no book with that ID.
+        """
+        book_id = validate_id(book_id)
+
+        with self._write() as conn:
+            self._invalidate(conn, self._books, book_id)
+
+            cursor = conn.execute(STATEMENTS['delete_book'].sql, (book_id,))
+
+            if cursor.rowcount == 0:
+                raise BookNotFoundError(
+                    f"The book with id {book_id} was not found."
+                )
+
+    # ===== Change log =====
+
+    def changes_since(
+        self, cursor: int = 0, limit: int = 1000
+    ) -> List[Change]:
+        """
+        Return the changes made to books and authors after the change with
+        sequence number "cursor", oldest first. Pass the seq of the last
+        change received as the cursor of the next call.
+        """
+        import json
+
+        with self._read() as conn:
+            rows = conn.execute(
+                STATEMENTS['changes_since'].sql, (cursor, limit)
+            ).fetchall()
+
+        return [
+            Change(seq, table, row_id, operation,
+                   None if data is None else json.loads(data), changed_at)
+            for seq, table, row_id, operation, data, changed_at in rows
+        ]
+
+    def iter_changes(
+        self, cursor: int = 0, batch_size: int = 1000
+    ) -> Iterator[Change]:
+        """
+        Yield every change after "cursor", reading them "batch_size" at a
+        time, so a long log is never held in memory.
+        """
+        while True:
+            changes = self.changes_since(cursor, batch_size)
+
+            yield from changes
+
+            if len(changes) < batch_size:
+                return
+
+            cursor = changes[-1].seq
+
+    def prune_changes(self, up_to: int) -> int:
+        """
+        Delete the change log entries up to and including sequence number
+        "up_to", once every consumer has read them.
+
+        Returns:
+            int: The number of entries deleted.
+        """
+        with self._write() as conn:
+            return conn.execute(
+                STATEMENTS['prune_changes'].sql, (up_to,)
+            ).rowcount
+
+    # ===== Authors =====
+
+    def author_exists(self, author_id: int) -> bool:
+        """Return True if the author ID exists in the author table."""
+        author_id = validate_id(author_id, "author")
+
+        return self._lookup(
+            self._authors, author_id, self._load_author
+        ) is not None
+
+    def get_author(self, author_id: int) -> Author:
+        """
+        Return the author with the given ID.
+
+        Raises:
+            AuthorNotFoundError: If there is no author with that ID.
+        """
+        author_id = validate_id(author_id, "author")
+        author = self._lookup(self._authors, author_id, self._load_author)
+
+        if author is None:
+            raise AuthorNotFoundError(
+                f"The author ID {author_id} does not exist."
+            )
+
+        return author
+
+    def upsert_author(self, author_id: int, name: str, country: str) -> Author:
+        """
+        Add an author, or replace the name and country of an existing one.
+        """
+        author = Author(
+            validate_id(author_id, "author"),
+            validate_name(name),
+            validate_name(country, "country name"),
+        )
+
+        with self._write() as conn:
+            self._invalidate(conn, self._authors, author.id)
+
+            conn.execute(STATEMENTS['upsert_author'].sql, author)
+
+        return author
+
+    def update_author(
+        self,
+        author_id: int,
+        name: Optional[str] = None,
+        country: Optional[str] = None,
+    ) -> Author:
+        """
+        Change the name and/or country of an existing author.
+
+        Raises:
+            AuthorNotFoundError: If there is no author with that ID.
+        """
+        author_id = validate_id(author_id, "author")
+
+        with self._write():
+            author = self.get_author(author_id)
+
+            if name is not None:
+                author = author._replace(name=validate_name(name))
+
+            if country is not None:
+                author = author._replace(
+                    country=validate_name(country, "country name")
+                )
+
+            return self.upsert_author(*author)
+
+
+# ========== Asyncio Service ==========
+
+class AsyncInventory:
+    """
+    An asyncio facade over Inventory, for async front ends that must not
+    block their event loop on SQLite.
+
+    Reads run concurrently on a pool of reader threads, each with its own
+    connection. Writes are queued and carried out one at a time by a single
+    writer task, on a thread with its own connection, so they never contend
+    for the write lock. A write that is cancelled while it is still queued
+    is never run. Once a read or write has started on its thread it runs to
+    completion, but a cancelled caller stops waiting for it.
+
+    Use it as an async context manager:
+
+        async with AsyncInventory() as inventory:
+            book = await inventory.get_book(3001)
+
+    Attributes:
+        inventory (Inventory): The synchronous service the calls are run on.
+    """
+
+    def __init__(
+        self,
+        database: Optional[str] = None,
+        readers: int = 4,
+        max_pending_writes: int = 1000,
+        cache_size: int = CACHE_SIZE,
+    ):
+        from concurrent.futures import ThreadPoolExecutor
+
+        self.inventory = Inventory(database, cache_size)
+        self._thread_ids = set()
+        self._readers = ThreadPoolExecutor(
+            readers, 'shelf-track-reader', initializer=self._register_thread
+        )
+        self._writer = ThreadPoolExecutor(
+            1, 'shelf-track-writer', initializer=self._register_thread
+        )
+        self._max_pending_writes = max_pending_writes
+        self._queue = None
+        self._writer_task = None
+
+    def _register_thread(self):
+        """
+        Remember the executor threads, so their connections can be closed.
+        """
+        self._thread_ids.add(threading.get_ident())
+
+    # ===== Lifecycle =====
+
+    async def start(self) -> "AsyncInventory":
+        """Start the writer task. Called by "async with"."""
+        import asyncio
+
+        if self._writer_task is None:
+            self._queue = asyncio.Queue(self._max_pending_writes)
+            self._writer_task = asyncio.get_running_loop().create_task(
+                self._run_writer()
+            )
+
+        return self
+
+    async def aclose(self) -> None:
+        """
+        Finish the queued writes, stop the writer task and the threads, and
+        close the threads' connections.
+        """
+        import asyncio
+
+        if self._writer_task is not None:
+            await self._queue.put((None, None))
+            await self._writer_task
+            self._writer_task = None
+
+        loop = asyncio.get_running_loop()
+
+        for executor in (self._readers, self._writer):
+            await loop.run_in_executor(None, executor.shutdown)
+
+        close_connections(self._thread_ids)
+
+    async def __aenter__(self):
+        return await self.start()
+
+    async def __aexit__(self, *exc_info):
+        await self.aclose()
+
+    # ===== Dispatch =====
+
+    async def _read(self, method, *args):
+        """Run a read on one of the reader threads."""
+        import asyncio
+        import functools
+
+        return await asyncio.get_running_loop().run_in_executor(
+            self._readers, functools.partial(method, *args)
+        )
+
+    async def _write(self, method, *args):
+        """Queue a write for the writer task and wait for its result."""
+        import asyncio
+        import functools
+
+        if self._writer_task is None:
+            raise RuntimeError("AsyncInventory has not been started.")
+
+        result = asyncio.get_running_loop().create_future()
+        await self._queue.put((result, functools.partial(method, *args)))
+
+        return await result
+
+    async def _run_writer(self):
+        """Carry out the queued writes, one at a time, until told to stop."""
+        import asyncio
+
+        loop = asyncio.get_running_loop()
+
+        while True:
+            result, call = await self._queue.get()
+
+            # A call of None is the signal to stop.
+            if call is None:
+                return
+
+            # Skip writes whose caller has stopped waiting.
+            if result.cancelled():
+                continue
+
+            try:
+                value = await loop.run_in_executor(self._writer, call)
+
+            except Exception as error:
+                if not result.done():
+                    result.set_exception(error)
+
+            else:
+                if not result.done():
+                    result.set_result(value)
+
+    # ===== Reads =====
+
+    async def get_book(self, book_id: int) -> Book:
+        """See Inventory.get_book()."""
+        return await self._read(self.inventory.get_book, book_id)
+
+    async def get_book_details(self, book_id: int) -> BookDetails:
+        """See Inventory.get_book_details()."""
+        return await self._read(self.inventory.get_book_details, book_id)
+
+    async def list_books(
+        self, after_id: int = 0, limit: Optional[int] = None
+    ) -> List[Book]:
+        """See Inventory.list_books()."""
+        return await self._read(self.inventory.list_books, after_id, limit)
+
+    async def list_book_details(
+        self, after_id: int = 0, limit: Optional[int] = None
+    ) -> List[BookDetails]:
+        """See Inventory.list_book_details()."""
+        return await self._read(
+            self.inventory.list_book_details, after_id, limit
+        )
+
+    async def search_books(
+        self, text: str, limit: int = 20
+    ) -> List[SearchResult]:
+        """See Inventory.search_books()."""
+        return await self._read(self.inventory.search_books, text, limit)
+
+    async def reorder_report(
+        self, after_id: int = 0, limit: Optional[int] = None
+    ) -> List[ReorderItem]:
+        """See Inventory.reorder_report()."""
+        return await self._read(self.inventory.reorder_report, after_id, limit)
+
+    async def author_exists(self, author_id: int) -> bool:
+        """See Inventory.author_exists()."""
+        return await self._read(self.inventory.author_exists, author_id)
+
+    async def get_author(self, author_id: int) -> Author:
+        """See Inventory.get_author()."""
+        return await self._read(self.inventory.get_author, author_id)
+
+    # ===== Writes =====
+
+    async def add_book(
+        self, book_id: int, title: str, author_id: int, qty: int
+    ) -> Book:
+        """See Inventory.add_book()."""
+        return await self._write(
+            self.inventory.add_book, book_id, title, author_id, qty
+        )
+
+    async def new_book(self, title: str, author_id: int, qty: int) -> Book:
+        """See Inventory.new_book()."""
+        return await self._write(
+            self.inventory.new_book, title, author_id, qty
+        )
+
+    async def update_qty(self, book_id: int, qty: int) -> Book:
+        """See Inventory.update_qty()."""
+        return await self._write(self.inventory.update_qty, book_id, qty)
+
+    async def adjust_stock(self, book_id: int, delta: int) -> Book:
+        """See Inventory.adjust_stock()."""
+        return await self._write(self.inventory.adjust_stock, book_id, delta)
+
+    async def adjust_stock_many(
+        self, changes: Iterable[Tuple[int, int]]
+    ) -> List[Book]:
+        """See Inventory.adjust_stock_many()."""
+        return await self._write(
+            self.inventory.adjust_stock_many, list(changes)
+        )
+
+    async def set_reorder_level(self, book_id: int, level: int) -> Book:
+        """See Inventory.set_reorder_level()."""
+        return await self._write(
+            self.inventory.set_reorder_level, book_id, level
+        )
+
+    async def update_title(self, book_id: int, title: str) -> Book:
+        """See Inventory.update_title()."""
+        return await self._write(self.inventory.update_title, book_id, title)
+
+    async def set_book_author(self, book_id: int, author_id: int) -> Book:
+        """See Inventory.set_book_author()."""
+        return await self._write(
+            self.inventory.set_book_author, book_id, author_id
+        )
+
+    async def delete_book(self, book_id: int) -> None:
+        """See Inventory.delete_book()."""
+        return await self._write(self.inventory.delete_book, book_id)
+
+    async def upsert_author(
+        self, author_id: int, name: str, country: str
+    ) -> Author:
+        """See Inventory.upsert_author()."""
+        return await self._write(
+            self.inventory.upsert_author, author_id, name, country
+        )
+
+    async def update_author(
+        self,
+        author_id: int,
+        name: Optional[str] = None,
+        country: Optional[str] = None,
+    ) -> Author:
+        """See Inventory.update_author()."""
+        return await self._write(
+            self.inventory.update_author, author_id, name, country
+        )
+
+
+# ========== Stock Write Queue ==========
+
+class StockWriteQueue:
+    """
+    Collects stock changes from many callers and writes them in batches, so
+    one commit covers many changes instead of one commit per change.
+
+    Changes to the same book are merged. A batch is written by a single
+    writer thread, in one transaction, once "max_batch" changes are waiting
+    or "max_delay" seconds after the first of them arrived, whichever comes
+    first. Each change returns a Future that is resolved with the book's
+    quantity once its batch has been written, or with the reason the change
+    was refused.
+
+        with StockWriteQueue() as queue:
+            done = queue.adjust(3001, -1)
+            print(done.result())
+
+    Attributes:
+        inventory (Inventory): The inventory the changes are written to.
+        max_batch (int): The number of waiting changes that starts a write.
+        max_delay (float): The longest a change waits before it is written.
+    """
+
+    def __init__(self, inventory=None, max_batch=500, max_delay=0.05):
+        self.inventory = inventory or Inventory()
+        self.max_batch = max_batch
+        self.max_delay = max_delay
+        self._pending = {}
+        self._in_flight = {}
+        self._waiting = 0
+        self._first_at = None
+        self._flush_requested = False
+        self._closed = False
+        self._condition = threading.Condition()
+        self._thread = threading.Thread(
+            target=self._run, name='shelf-track-stock-writer', daemon=True
+        )
+        self._thread.start()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def set_qty(self, book_id: int, qty: int):
+        """
+        Queue a change that sets a book's quantity.
+
+        Returns:
+            concurrent.futures.Future: Resolved with the book's quantity once
+                                       the change has been written.
+        """
+        return self._submit(validate_id(book_id), validate_qty(qty), 0)
+
+    def adjust(self, book_id: int, delta: int):
+        """
+        Queue a change that adds delta (which may be negative) to a book's
+        quantity. The change is refused if the quantity would go below zero.
+
+        Returns:
+            concurrent.futures.Future: Resolved with the book's quantity once
+                                       the change has been written.
+        """
+        return self._submit(validate_id(book_id), None, validate_delta(delta))
+
+    def _submit(self, book_id, qty, delta):
+        """Add a change to the next batch and wake the writer if needed."""
+        from concurrent.futures import Future
+
+        done = Future()
+
+        with self._condition:
+            if self._closed:
+                raise RuntimeError("The stock write queue has been closed.")
+
+            self._pending.setdefault(book_id, []).append((qty, delta, done))
+            self._waiting += 1
+
+            if self._first_at is None:
+                self._first_at = time.monotonic()
+
+            self._condition.notify()
+
+        return done
+
+    def flush(self) -> None:
+        """Write every waiting change now, and wait until it is written."""
+        from concurrent.futures import wait
+
+        with self._condition:
+            waiting = [done
+                       for batch in (self._pending, self._in_flight)
+                       for changes in batch.values()
+                       for _, _, done in changes]
+
+            # A batch already being written needs no flush, and a flag left
+            # set would make the next batch skip its wait for more changes.
+            if self._pending:
+                self._flush_requested = True
+                self._condition.notify()
+
+        wait(waiting)
+
+    def close(self) -> None:
+        """Write every waiting change, then stop the writer thread."""
+        with self._condition:
+            self._closed = True
+            self._condition.notify()
+
+        self._thread.join()
+        close_connections({self._thread.ident})
+
+    def _next_batch(self):
+        """
+        Wait until a batch is due and take it, or return None once the queue
+        has been closed and every change has been written.
+        """
+        with self._condition:
+            while not self._pending and not self._closed:
+                self._condition.wait()
+
+            # Wait for more changes until the batch is full or overdue.
+            while (self._pending and not self._closed
+                   and not self._flush_requested
+                   and self._waiting < self.max_batch):
+                remaining = self._first_at + self.max_delay - time.monotonic()
+
+                if remaining <= 0:
+                    break
+
+                self._condition.wait(remaining)
+
+            if not self._pending:
+                return None
+
+            batch, self._pending = self._pending, {}
+            self._in_flight = batch
+            self._waiting = 0
+            self._first_at = None
+            self._flush_requested = False
+
+            return batch
+
+    def _run(self):
+        """Write batches until the queue is closed."""
+        while True:
+            batch = self._next_batch()
+
+            if batch is None:
+                return
+
+            changes = {
+                book_id: [(qty, delta) for qty, delta, _ in book_changes]
+                for book_id, book_changes in batch.items()
+            }
+
+            try:
+                results = self.inventory.apply_stock_changes(changes)
+
+            # If the batch could not be written, every change in it failed.
+            except Exception as error:
+                for book_changes in batch.values():
+                    for _, _, done in book_changes:
+                        done.set_exception(error)
+                continue
+
+            for book_id, book_changes in batch.items():
+                for (_, _, done), result in zip(book_changes,
+                                                results[book_id]):
+                    if isinstance(result, Exception):
+                        done.set_exception(result)
+                    else:
+                        done.set_result(result)
+
+
+# ========== Analytics Snapshot ==========
+
+# If more than this share of the books changed since the last refresh, the
+# snapshot is loaded again from scratch rather than patched.
+SNAPSHOT_RELOAD_RATIO = 0.1
+
+
+def _load_numpy():
+    """Return the numpy module, or None if it is not installed."""
+    try:
+        import numpy
+
+    except ImportError:
+        return None
+
+    return numpy
+
+
+class InventorySnapshot:
+    """
+    A compact, read-only copy of the book and author tables for reports.
+
+    Each column is held in one buffer instead of one tuple per row: the IDs,
+    author IDs and quantities in array('q') buffers, sorted by book ID, and
+    the titles, names and countries as interned strings. The aggregates use
+    NumPy when it is installed, and plain loops over the buffers otherwise.
+
+    refresh() brings the copy up to date. Only the rows recorded in the
+    change log since the last refresh are read again.
+
+        snapshot = InventorySnapshot()
+        print(snapshot.stock_per_author())
+
+    Attributes:
+        database (str): The path of the SQLite database file.
+        change_seq (int): The last change included in the snapshot.
+    """
+
+    def __init__(self, database: Optional[str] = None, use_numpy=None):
+        from array import array
+
+        self.database = database
+        self.change_seq = -1
+        self._numpy = _load_numpy() if use_numpy is not False else None
+
+        if use_numpy and self._numpy is None:
+            raise ImportError("numpy is not installed.")
+
+        self.book_ids = array('q')
+        self.author_ids = array('q')
+        self.qty = array('q')
+        self.titles = []
+        self.authors = {}
+
+        self.refresh()
+
+    def __len__(self):
+        return len(self.book_ids)
+
+    # ===== Loading =====
+
+    def refresh(self) -> int:
+        """
+        Bring the snapshot up to date with the database.
+
+        Returns:
+            int: The number of books and authors read from the database.
+        """
+        with _connection_block(database=self.database) as conn:
+            # Read the counter first, so a change made while the rows are
+            # being read is picked up again by the next refresh.
+            first, seq = conn.execute(
+                STATEMENTS['change_log_range'].sql
+            ).fetchone()
+
+            if seq == self.change_seq:
+                return 0
+
+            # Reload if the database was replaced, or the changes since the
+            # last refresh have been pruned.
+            if (seq < self.change_seq or first is None
+                    or first > self.change_seq + 1):
+                return self._reload(conn, seq)
+
+            changes = conn.execute(
+                STATEMENTS['changed_rows'].sql, (self.change_seq,)
+            ).fetchall()
+
+            book_ids = [row_id for table, row_id in changes
+                        if table == 'book']
+
+            if (self.change_seq < 0
+                    or len(book_ids) > len(self) * SNAPSHOT_RELOAD_RATIO):
+                return self._reload(conn, seq)
+
+            for book_id in book_ids:
+                self._patch_book(conn, book_id)
+
+            author_ids = [row_id for table, row_id in changes
+                          if table == 'author']
+
+            for author_id in author_ids:
+                self._patch_author(conn, author_id)
+
+            self.change_seq = seq
+
+            return len(changes)
+
+    def _reload(self, conn, seq):
+        """Load every book and author again."""
+        from array import array
+
+        book_ids, author_ids, qty, titles = (
+            array('q'), array('q'), array('q'), []
+        )
+
+        for book_id, title, author_id, book_qty in conn.execute(
+            STATEMENTS['snapshot_books'].sql
+        ):
+            book_ids.append(book_id)
+            author_ids.append(author_id)
+            qty.append(book_qty)
+            titles.append(sys.intern(title))
+
+        self.book_ids, self.author_ids, self.qty = book_ids, author_ids, qty
+        self.titles = titles
+        self.authors = {
+            author_id: Author(author_id, sys.intern(name), sys.intern(country))
+            for author_id, name, country in conn.execute(
+                STATEMENTS['snapshot_authors'].sql
+            )
+        }
+        self.change_seq = seq
+
+        return len(self.book_ids) + len(self.authors)
+
+    def _patch_book(self, conn, book_id):
+        """Read one book again, adding, changing or removing it."""
+        import bisect
+
+        book = Inventory._load_book(conn, book_id)
+        index = bisect.bisect_left(self.book_ids, book_id)
+        present = (index < len(self.book_ids)
+                   and self.book_ids[index] == book_id)
+
+        if book is None:
+            if present:
+                for column in (self.book_ids, self.author_ids, self.qty,
+                               self.titles):
+                    del column[index]
+            return
+
+        if not present:
+            self.book_ids.insert(index, book_id)
+            self.author_ids.insert(index, book.author_id)
+            self.qty.insert(index, book.qty)
+            self.titles.insert(index, sys.intern(book.title))
+            return
+
+        self.author_ids[index] = book.author_id
+        self.qty[index] = book.qty
+        self.titles[index] = sys.intern(book.title)
+
+    def _patch_author(self, conn, author_id):
+        """Read one author again, adding, changing or removing them."""
+        author = Inventory._load_author(conn, author_id)
+
+        if author is None:
+            self.authors.pop(author_id, None)
+        else:
+            self.authors[author_id] = Author(
+                author.id, sys.intern(author.name), sys.intern(author.country)
+            )
+
+    def _column(self, column):
+        """View an array('q') column as a NumPy array, without copying."""
+        return self._numpy.frombuffer(column, dtype=self._numpy.int64)
+
+    # ===== Aggregates =====
+
+    def total_stock(self) -> int:
+        """Return the number of copies of every book, added together."""
+        if self._numpy is not None and len(self):
+            return int(self._column(self.qty).sum())
+
+        return sum(self.qty)
+
+    def stock_per_author(self) -> Dict[int, int]:
+        """Return the total quantity of each author's books, by author ID."""
+        if self._numpy is None or not len(self):
+            totals = {}
+
+            for author_id, qty in zip(self.author_ids, self.qty):
+                totals[author_id] = totals.get(author_id, 0) + qty
+
+            return totals
+
+        numpy = self._numpy
+        author_ids, inverse = numpy.unique(
+            self._column(self.author_ids), return_inverse=True
+        )
+        totals = numpy.zeros(len(author_ids), dtype=numpy.int64)
+        numpy.add.at(totals, inverse, self._column(self.qty))
+
+        return dict(zip(author_ids.tolist(), totals.tolist()))
+
+    def low_stock(self, threshold: int) -> List[Book]:
+        """Return the books with fewer than "threshold" copies, by ID."""
+        if self._numpy is not None and len(self):
+            indexes = self._numpy.flatnonzero(
+                self._column(self.qty) < threshold
+            ).tolist()
+        else:
+            indexes = [index for index, qty in enumerate(self.qty)
+                       if qty < threshold]
+
+        return [
+            Book(self.book_ids[index], self.titles[index],
+                 self.author_ids[index], self.qty[index])
+            for index in indexes
+        ]
+
+    def author_name(self, author_id: int) -> Optional[str]:
+        """Return the name of an author, or None if they do not exist."""
+        author = self.authors.get(author_id)
+
+        return None if author is None else author.name
+
+
+# ========== Bulk Import ==========
+
+# The columns each kind of import file must provide, and the other names
+# those columns may be given in the file.
+IMPORT_COLUMNS = {
+    'books': {
+        'id': ('id', 'book_id', 'bookid'),
+        'title': ('title',),
+        'authorID': ('authorid', 'author_id'),
+        'qty': ('qty', 'quantity'),
+    },
+    'authors': {
+        'id': ('id', 'author_id', 'authorid'),
+        'name': ('name',),
+        'country': ('country',),
+    },
+}
+
+# The STATEMENTS used to write each kind of row.
+IMPORT_STATEMENTS = {
+    'books': 'import_books',
+    'authors': 'import_authors',
+}
+
+# The number of rows written in each import transaction.
+IMPORT_CHUNK_SIZE = 5000
+
+
+class ImportReport(NamedTuple):
+    """The outcome of an import_file() call."""
+    imported: int
+    rejected: int
+    rejects_path: Optional[str]
+
+
+def read_records(path, file_format=None):
+    """
+    This function streams the records in a CSV or JSONL file, one at a time,
+    so the whole file is never held in memory.
+
+    Parameters:
+        path (str): The path of the file to read.
+        file_format (str): 'csv' or 'jsonl'. If None, it is taken from the
+                           file extension.
+
+    Yields:
+        tuple: (line number, record), where record is a dict of the row's
+               fields, or a ValidationError if the line could not be read.
+    """
+    import csv
+    import json
+
+    file_format = file_format or os.path.splitext(path)[1].lstrip('.')
+    file_format = file_format.lower()
+
+    if file_format not in ('csv', 'jsonl', 'ndjson'):
+        raise ValueError(f"Unsupported import format: {file_format}")
+
+    # utf-8-sig drops the byte order mark that Excel writes at the start of
+    # a "CSV UTF-8" file, which would otherwise become part of the first
+    # column's name.
+    with open(path, newline='', encoding='utf-8-sig') as file:
+        if file_format == 'csv':
+            reader = csv.DictReader(file)
+
+            for record in reader:
+                yield reader.line_num, record
+
+            return
+
+        for line_number, line in enumerate(file, start=1):
+            # Skip blank lines between records.
+            if not line.strip():
+                continue
+
+            try:
+                record = json.loads(line)
+
+            except json.JSONDecodeError as error:
+                yield line_number, ValidationError(f"Invalid JSON: {error}")
+                continue
+
+            if not isinstance(record, dict):
+                record = ValidationError("Each line must be a JSON object.")
+
+            yield line_number, record
+
+
+def validate_records(records, kind, author_exists=None):
+    """
+    This function checks each record with the same rules the menu uses: IDs
+    must be within their ID range, titles and names cannot be blank and
+    quantities cannot be negative. A book's ID may be left blank, in which
+    case its row has None for the ID and one is allocated when it is written.
+
+    Parameters:
+        records (iterable): (line number, record) pairs from read_records().
+        kind (str): 'books' or 'authors'.
+        author_exists (function): If given, it is called with each book's
+                                  author ID, and books whose author it
+                                  returns False for are rejected.
+
+    Yields:
+        tuple: (line number, row, error). row is a tuple ready to insert and
+               error is None, or row is the original record and error is the
+               reason it was rejected.
+    """
+    columns = IMPORT_COLUMNS[kind]
+
+    for line_number, record in records:
+        if isinstance(record, ValidationError):
+            yield line_number, None, str(record)
+            continue
+
+        # Look up each column by any of its names, ignoring case.
+        fields = {
+            str(key).strip().lower(): value for key, value in record.items()
+        }
+        values = {}
+
+        for column, names in columns.items():
+            values[column] = next(
+                (fields[name] for name in names if name in fields), None
+            )
+
+        # New books may leave the ID blank, to have one allocated, but a
+        # record with no ID field at all is more likely a mistake.
+        missing = [column for column, value in values.items()
+                   if value is None and (kind, column) != ('books', 'id')]
+
+        if kind == 'books' and not any(name in fields
+                                       for name in columns['id']):
+            missing.insert(0, 'id')
+
+        if missing:
+            yield line_number, record, f"Missing {', '.join(missing)}"
+            continue
+
+        try:
+            if kind == 'books':
+                row = (
+                    validate_new_id(values['id']),
+                    validate_title(values['title']),
+                    validate_id(values['authorID'], "author"),
+                    validate_qty(values['qty']),
+                )
+
+                if author_exists is not None and not author_exists(row[2]):
+                    raise ValidationError(
+                        f"The author ID {row[2]} does not exist."
+                    )
+            else:
+                row = (
+                    validate_id(values['id'], "author"),
+                    validate_name(values['name']),
+                    validate_name(values['country'], "country name"),
+                )
+
+        except ValidationError as error:
+            yield line_number, record, str(error)
+            continue
+
+        yield line_number, row, None
+
+
+def chunked(iterable, size):
+    """
+    This function groups the items of an iterable into lists of at most
+    "size" items, without reading ahead any further than that.
+
+    Parameters:
+        iterable (iterable): The items to group.
+        size (int): The largest number of items in a group.
+
+    Yields:
+        list: The next group of items.
+    """
+    iterator = iter(iterable)
+
+    while True:
+        chunk = list(itertools.islice(iterator, size))
+
+        if not chunk:
+            return
+
+        yield chunk
+
+
+def import_file(path, kind='books', file_format=None,
+                chunk_size=IMPORT_CHUNK_SIZE, rejects_path=None,
+                database=None):
+    """
+    This function streams a CSV or JSONL file of books or authors into the
+    database.
+
+    Valid rows are written in chunked executemany() transactions. Rows that
+    fail validation, or that the database refuses, are written to a rejects
+    file with the line number and the reason. Memory use stays flat however
+    large the file is. A book whose author is not in the author table is
+    rejected, so authors are imported before their books. Books without an
+    ID are given one from blocks of IDs reserved with an IdAllocator, so
+    several imports can run at once.
+
+    Parameters:
+        path (str): The path of the file to import.
+        kind (str): 'books' or 'authors'.
+        file_format (str): 'csv' or 'jsonl'. If None, it is taken from the
+                           file extension.
+        chunk_size (int): The number of rows written in each transaction.
+        rejects_path (str): Where rejected rows are written. Defaults to
+                            the import path with ".rejects.csv" appended.
+        database (str): The path of the SQLite database file. Defaults to
+                        DB_NAME.
+
+    Returns:
+        ImportReport: The number of rows imported and rejected, and the
+                      rejects file if there were any rejected rows.
+    """
+    import csv
+    import json
+
+    if kind not in IMPORT_COLUMNS:
+        raise ValueError(f"Unknown import kind: {kind}")
+
+    rejects_path = rejects_path or f"{path}.rejects.csv"
+    statement = STATEMENTS[IMPORT_STATEMENTS[kind]].sql
+    author_exists = (Inventory(database).author_exists
+                     if kind == 'books' else None)
+    allocate_id = IdAllocator('book', database=database)
+    imported = rejected = 0
+    rejects_file = rejects_writer = None
+
+    def reject(line_number, record, reason):
+        nonlocal rejected, rejects_file, rejects_writer
+
+        # Only create the rejects file once there is something to put in it.
+        if rejects_writer is None:
+            rejects_file = open(rejects_path, 'w', newline='',
+                                encoding='utf-8')
+            rejects_writer = csv.writer(rejects_file)
+            rejects_writer.writerow(['line', 'reason', 'record'])
+
+        rejects_writer.writerow([
+            line_number, reason, json.dumps(record, default=str)
+        ])
+        rejected += 1
+
+    def write_chunk(chunk):
+        nonlocal imported
+
+        try:
+            with transaction(database) as conn:
+                conn.executemany(statement, [row for _, row in chunk])
+
+            imported += len(chunk)
+
+        # If the chunk is refused, write its rows one at a time so only the
+        # rows at fault are rejected.
+        except sqlite3.IntegrityError:
+            for line_number, row in chunk:
+                try:
+                    with transaction(database) as conn:
+                        conn.execute(statement, row)
+
+                    imported += 1
+
+                except sqlite3.IntegrityError as error:
+                    reject(line_number, row, str(error))
+
+    def valid_rows():
+        for line_number, row, error in validate_records(
+            read_records(path, file_format), kind, author_exists
+        ):
+            if error is not None:
+                reject(line_number, row, error)
+                continue
+
+            if row[0] is None:
+                row = (allocate_id(),) + row[1:]
+
+            yield line_number, row
+
+    try:
+        for chunk in chunked(valid_rows(), chunk_size):
+            write_chunk(chunk)
+
+    finally:
+        if rejects_file is not None:
+            rejects_file.close()
+
+    return ImportReport(
+        imported, rejected, rejects_path if rejected else None
+    )
+
+
+# ========== Batch Commands ==========
+
+# The number of commands run_batch() commits in each transaction.
+BATCH_SIZE = 500
+
+
+class BatchCommand(NamedTuple):
+    """
+    A command that may appear in a batch file: the fields it needs, in the
+    order they are given on a plain-text line, the fields that may be left
+    out, and the function that carries it out on an Inventory.
+    """
+    fields: Tuple[str, ...]
+    optional: Tuple[str, ...]
+    run: Callable[..., object]
+
+
+def _batch_add(inventory, title, author_id, qty, id=None):
+    if validate_new_id(id) is None:
+        return inventory.new_book(title, author_id, qty)
+
+    return inventory.add_book(id, title, author_id, qty)
+
+
+# The commands a batch file may contain, by name.
+BATCH_COMMANDS = {
+    'add': BatchCommand(('title', 'author_id', 'qty'), ('id',), _batch_add),
+    'adjust': BatchCommand(
+        ('book_id', 'delta'), (),
+        lambda inventory, book_id, delta:
+            inventory.adjust_stock(book_id, delta)
+    ),
+    'delete': BatchCommand(
+        ('book_id',), (),
+        lambda inventory, book_id: inventory.delete_book(book_id)
+    ),
+    'rename-author': BatchCommand(
+        ('author_id', 'name'), (),
+        lambda inventory, author_id, name:
+            inventory.update_author(author_id, name=name)
+    ),
+}
+
+
+class BatchReport(NamedTuple):
+    """The outcome of a run_batch() call."""
+    applied: int
+    failed: int
+    counts: Dict[str, int]
+    failures: List[Tuple[int, str, str]]
+    seconds: float
+
+
+def parse_batch_line(line):
+    """
+    This function reads one command from a line of a batch file. A line is
+    either a JSON object with a "command" field:
+
+        {"command": "adjust", "book_id": 3001, "delta": -2}
+
+    or the command and its fields in order, quoted as in a shell, with any
+    optional fields given as name=value:
+
+        add "A Tale of Two Cities" 1290 30 id=3001
+        adjust 3001 -2
+        delete 3001
+        rename-author 1290 "Charles Dickens"
+
+    Blank lines and lines starting with "#" hold no command.
+
+    Parameters:
+        line (str): The line to read.
+
+    Returns:
+        tuple: (command name, dict of fields), or None if the line holds no
+               command.
+
+    Raises:
+        ValidationError: If the line is not a valid command.
+    """
+    import shlex
+
+    text = line.strip()
+
+    if not text or text.startswith('#'):
+        return None
+
+    if text.startswith('{'):
+        import json
+
+        try:
+            fields = json.loads(text)
+
+        except json.JSONDecodeError as error:
+            raise ValidationError(f"Invalid JSON: {error}") from None
+
+        if not isinstance(fields, dict):
+            raise ValidationError("Each line must be a JSON object.")
+
+        name = fields.pop('command', None)
+
+    else:
+        try:
+            words = shlex.split(text)
+
+        except ValueError as error:
+            raise ValidationError(f"Unreadable command: {error}") from None
+
+        name, words, fields = words[0], words[1:], {}
+        command = BATCH_COMMANDS.get(name)
+        positional = []
+
+        for word in words:
+            field, _, value = word.partition('=')
+
+            if command is not None and field in command.optional and value:
+                fields[field] = value
+            else:
+                positional.append(word)
+
+        if command is not None:
+            if len(positional) > len(command.fields):
+                raise ValidationError(
+                    f"{name} takes {len(command.fields)} values: "
+                    f"{', '.join(command.fields)}"
+                )
+
+            fields.update(zip(command.fields, positional))
+
+    # A JSON command may be any value, such as a list, not only a name.
+    command = BATCH_COMMANDS.get(name) if isinstance(name, str) else None
+
+    if command is None:
+        raise ValidationError(
+            f"Unknown command: {name}. Use one of "
+            f"{', '.join(BATCH_COMMANDS)}."
+        )
+
+    missing = [field for field in command.fields if field not in fields]
+    unknown = set(fields) - set(command.fields) - set(command.optional)
+
+    if missing:
+        raise ValidationError(f"Missing {', '.join(missing)}")
+
+    if unknown:
+        raise ValidationError(f"Unknown fields: {', '.join(sorted(unknown))}")
+
+    return name, fields
+
+
+def run_batch(lines, batch_size=BATCH_SIZE, stop_on_error=False,
+              inventory=None, database=None):
+    """
+    This function carries out the commands in a batch file, such as an
+    end-of-day reconciliation, without going through the menu's prompts.
+
+    Every "batch_size" commands are committed together in one transaction.
+    Each command runs in its own savepoint, so a command that fails, such
+    as a sale of more copies than are in stock, is rolled back on its own
+    and the rest of the batch carries on.
+
+    Parameters:
+        lines (iterable): The lines of the batch, e.g. an open file or
+                          sys.stdin. See parse_batch_line() for the format.
+        batch_size (int): The number of commands in each transaction.
+        stop_on_error (bool): If True, stop at the first command that fails.
+                              The commands before it are still committed.
+        inventory (Inventory): The service to use. Defaults to a new
+                               Inventory on "database".
+        database (str): The path of the SQLite database file. Defaults to
+                        DB_NAME.
+
+    Returns:
+        BatchReport: The number of commands applied and failed, the number
+                     applied of each kind, the line number, text and reason
+                     of each failure, and the time taken.
+    """
+    if batch_size < 1:
+        raise ValueError("The batch size must be at least 1.")
+
+    inventory = inventory or Inventory(database)
+    start = time.perf_counter()
+    counts = {}
+    failures = []
+
+    def commands():
+        for line_number, line in enumerate(lines, start=1):
+            try:
+                parsed = parse_batch_line(line)
+
+            except ValidationError as error:
+                yield line_number, line.strip(), None, str(error)
+                continue
+
+            if parsed is not None:
+                yield line_number, line.strip(), parsed, None
+
+    for chunk in chunked(commands(), batch_size):
+        with inventory.unit_of_work():
+            for line_number, text, parsed, error in chunk:
+                if parsed is not None:
+                    name, fields = parsed
+
+                    try:
+                        with inventory.savepoint():
+                            BATCH_COMMANDS[name].run(inventory, **fields)
+
+                    except InventoryError as exception:
+                        error = str(exception)
+
+                    else:
+                        counts[name] = counts.get(name, 0) + 1
+                        continue
+
+                failures.append((line_number, text, error))
+
+                if stop_on_error:
+                    break
+
+        if failures and stop_on_error:
+            break
+
+    return BatchReport(
+        sum(counts.values()), len(failures), counts, failures,
+        time.perf_counter() - start
+    )
+
+
+# ========== Backup and Export ==========
+
+# The number of pages the backup copies at a time, and the pause between
+# steps, during which other connections can read and write.
+BACKUP_PAGES = 256
+BACKUP_SLEEP = 0.005
+
+# The columns written by export_table(), in order, as read by the
+# export_books and export_authors STATEMENTS. They use the names the import
+# accepts, so an export can be imported again.
+EXPORT_COLUMNS = {
+    'books': ('id', 'title', 'authorID', 'qty', 'reorder_level'),
+    'authors': ('id', 'name', 'country'),
+}
+
+# The number of rows read, and held in memory, at a time by an export.
+EXPORT_BATCH_SIZE = 5000
+
+
+class BackupReport(NamedTuple):
+    """The outcome of a backup_database() call."""
+    path: str
+    pages: int
+    seconds: float
+
+
+def backup_database(path, pages=BACKUP_PAGES, sleep=BACKUP_SLEEP,
+                    progress=None, database=None):
+    """
+    This function copies the database to a new file with SQLite's online
+    backup API, which gives a consistent copy while the database is in use.
+
+    The copy is made "pages" pages at a time, pausing "sleep" seconds
+    between steps so other connections are not starved. SQLite starts the
+    copy again if another connection writes part way through, so on a busy
+    database larger steps finish sooner. The copy is written to a
+    temporary file next to "path" and moved into place once complete, so
+    "path" never holds a partial backup.
+
+    Parameters:
+        path (str): Where the backup is written.
+        pages (int): The number of pages copied at a time. -1 copies the
+                     whole database in one step.
+        sleep (float): The pause between steps, in seconds.
+        progress (function): Called after each step with (status, remaining,
+                             total), as sqlite3.Connection.backup() does.
+        database (str): The path of the SQLite database file. Defaults to
+                        DB_NAME.
+
+    Returns:
+        BackupReport: The backup file, its size in pages and the time taken.
+    """
+    partial_path = f"{path}.partial"
+    total_pages = 0
+
+    def on_step(status, remaining, total):
+        nonlocal total_pages
+        total_pages = total
+
+        if progress is not None:
+            progress(status, remaining, total)
+
+    start = time.perf_counter()
+    target = sqlite3.connect(partial_path)
+
+    try:
+        with _connection_block(database=database) as conn:
+            conn.backup(target, pages=pages, progress=on_step, sleep=sleep)
+
+    except BaseException:
+        target.close()
+        os.remove(partial_path)
+        raise
+
+    target.close()
+    os.replace(partial_path, path)
+
+    return BackupReport(path, total_pages, time.perf_counter() - start)
+
+
+def export_table(path, kind='books', file_format=None,
+                 batch_size=EXPORT_BATCH_SIZE, database=None):
+    """
+    This function writes every book or author to a CSV, JSONL or Parquet
+    file.
+
+    The rows are read in pages of "batch_size", by ID, with a new read for
+    each page, so memory use stays flat and writers are never held up for
+    the length of the export. Parquet needs the optional pyarrow package.
+
+    Parameters:
+        path (str): The path of the file to write.
+        kind (str): 'books' or 'authors'.
+        file_format (str): 'csv', 'jsonl' or 'parquet'. If None, it is taken
+                           from the file extension.
+        batch_size (int): The number of rows read at a time.
+        database (str): The path of the SQLite database file. Defaults to
+                        DB_NAME.
+
+    Returns:
+        int: The number of rows written.
+    """
+    if kind not in EXPORT_COLUMNS:
+        raise ValueError(f"Unknown export kind: {kind}")
+
+    file_format = file_format or os.path.splitext(path)[1].lstrip('.')
+    file_format = file_format.lower()
+
+    if file_format == 'ndjson':
+        file_format = 'jsonl'
+
+    if file_format not in ('csv', 'jsonl', 'parquet'):
+        raise ValueError(f"Unsupported export format: {file_format}")
+
+    columns = EXPORT_COLUMNS[kind]
+    statement = STATEMENTS[f'export_{kind}'].sql
+
+    def batches():
+        last_id = -2 ** 63
+
+        while True:
+            with _connection_block(database=database) as conn:
+                rows = conn.execute(
+                    statement, (last_id, batch_size)
+                ).fetchall()
+
+            if not rows:
+                return
+
+            yield rows
+
+            last_id = rows[-1][0]
+
+    if file_format == 'parquet':
+        return _export_parquet(path, columns, batches())
+
+    import csv
+    import json
+
+    written = 0
+
+    with open(path, 'w', newline='', encoding='utf-8') as file:
+        if file_format == 'csv':
+            writer = csv.writer(file)
+            writer.writerow(columns)
+
+        for rows in batches():
+            if file_format == 'csv':
+                writer.writerows(rows)
+            else:
+                file.writelines(
+                    json.dumps(dict(zip(columns, row))) + '\n'
+                    for row in rows
+                )
+
+            written += len(rows)
+
+    return written
+
+
+def _export_parquet(path, columns, batches):
+    """Write batches of rows to a Parquet file, one row group per batch."""
+    try:
+        import pyarrow
+        import pyarrow.parquet
+
+    except ImportError:
+        raise RuntimeError(
+            "Parquet export needs pyarrow: pip install pyarrow"
+        ) from None
+
+    writer = None
+    written = 0
+
+    try:
+        for rows in batches:
+            batch = pyarrow.table(
+                {column: list(values)
+                 for column, values in zip(columns, zip(*rows))}
+            )
+
+            if writer is None:
+                writer = pyarrow.parquet.ParquetWriter(path, batch.schema)
+
+            writer.write_table(batch)
+            written += len(rows)
+
+    finally:
+        if writer is not None:
+            writer.close()
+
+    # A Parquet file needs a schema, which is taken from the first batch,
+    # so nothing is written for an empty table.
+    return written
+
+
+# ========== HTTP Server ==========
+
+# The number of worker threads, each with its own SQLite connection, that
+# carry out HTTP requests.
+SERVER_WORKERS = 8
+
+# The largest request body the server accepts, in bytes.
+MAX_REQUEST_BODY = 1 << 20
+
+# How long a kept-alive client connection may sit idle, in seconds, before
+# the server closes it.
+SERVER_IDLE_TIMEOUT = 15
+
+# The HTTP status for each kind of service error.
+ERROR_STATUS = (
+    (ValidationError, 400),
+    (BookNotFoundError, 404),
+    (AuthorNotFoundError, 404),
+    (DuplicateBookError, 409),
+    (InsufficientStockError, 409),
+    (IdRangeError, 409),
+    (InventoryError, 400),
+)
+
+
+class ApiError(Exception):
+    """An error that is sent to the client with its own HTTP status."""
+
+    def __init__(self, status, message):
+        super().__init__(message)
+        self.status = status
+
+
+class ApiResponse(NamedTuple):
+    """The status, extra headers and JSON body of an API response."""
+    status: int
+    body: object = None
+    headers: Tuple[Tuple[str, str], ...] = ()
+
+
+def etag(value):
+    """
+    This function returns a strong ETag for a record, which changes whenever
+    any of its fields change.
+
+    Parameters:
+        value (tuple): The record.
+
+    Returns:
+        str: The quoted entity tag.
+    """
+    import hashlib
+
+    digest = hashlib.blake2b(repr(tuple(value)).encode(), digest_size=12)
+
+    return f'"{digest.hexdigest()}"'
+
+
+class InventoryApi:
+    """
+    The JSON API served by the HTTP server, kept apart from the socket
+    handling so it can be called directly.
+
+        GET    /books?after_id=&limit=    a page of books
+        POST   /books                     add a book (the id may be left out)
+        GET    /books/{id}                a book and its author
+        PATCH  /books/{id}                change title, author_id, qty or
+                                          reorder_level
+        DELETE /books/{id}                delete a book
+        POST   /books/{id}/stock          {"delta": n}: adjust the stock
+        POST   /stock                     {"items": [{"book_id", "delta"}]}:
+                                          adjust several books at once
+        GET    /search?q=&limit=          search titles and authors
+        GET    /reorder?after_id=&limit=  the reorder report
+        GET    /authors/{id}              an author
+        PUT    /authors/{id}              add or replace an author
+        GET    /metrics                   the query metrics, in the
+                                          Prometheus text format
+
+    GET /books/{id} and /authors/{id} return an ETag. A request with a
+    matching If-None-Match header gets 304 Not Modified, and a PATCH or
+    DELETE whose If-Match header does not match gets 412.
+
+    Attributes:
+        inventory (Inventory): The service the requests are carried out on.
+    """
+
+    def __init__(self, inventory=None):
+        import re
+
+        self.inventory = inventory or Inventory()
+        self.routes = [
+            (re.compile(pattern), methods)
+            for pattern, methods in (
+                (r'/books', {'GET': self.list_books,
+                             'POST': self.add_book}),
+                (r'/books/(\d+)', {'GET': self.get_book,
+                                   'PATCH': self.update_book,
+                                   'DELETE': self.delete_book}),
+                (r'/books/(\d+)/stock', {'POST': self.adjust_stock}),
+                (r'/stock', {'POST': self.adjust_stock_many}),
+                (r'/search', {'GET': self.search}),
+                (r'/reorder', {'GET': self.reorder_report}),
+                (r'/authors/(\d+)', {'GET': self.get_author,
+                                     'PUT': self.put_author}),
+                (r'/metrics', {'GET': self.metrics}),
+            )
+        ]
+
+    def handle(self, method, target, headers=None, body=b''):
+        """
+        Carry out one request.
+
+        Parameters:
+            method (str): The HTTP method.
+            target (str): The path and query string.
+            headers (dict): The request headers, with lower-case names.
+            body (bytes): The request body.
+
+        Returns:
+            ApiResponse: The response to send.
+        """
+        from urllib.parse import parse_qs, urlsplit
+
+        url = urlsplit(target)
+        request = {
+            'query': {name: values[-1]
+                      for name, values in parse_qs(url.query).items()},
+            'headers': headers or {},
+            'body': body,
+        }
+
+        try:
+            for pattern, methods in self.routes:
+                match = pattern.fullmatch(url.path.rstrip('/') or '/')
+
+                if match is None:
+                    continue
+
+                if method not in methods:
+                    raise ApiError(405, f"{method} is not allowed here.")
+
+                return methods[method](request, *match.groups())
+
+            raise ApiError(404, f"There is nothing at {url.path}.")
+
+        except ApiError as error:
+            return ApiResponse(error.status, {'error': str(error)})
+
+        except InventoryError as error:
+            status = next(status for kind, status in ERROR_STATUS
+                          if isinstance(error, kind))
+
+            return ApiResponse(status, {'error': str(error)})
+
+    # ===== Request helpers =====
+
+    @staticmethod
+    def _json(request):
+        """Return the JSON object in the request body."""
+        import json
+
+        try:
+            value = json.loads(request['body'] or b'{}')
+
+        except ValueError:
+            raise ApiError(400, "The request body is not valid JSON.")
+
+        if not isinstance(value, dict):
+            raise ApiError(400, "The request body must be a JSON object.")
+
+        return value
+
+    @staticmethod
+    def _page(request):
+        """Return the after_id and limit of a paginated request."""
+        try:
+            after_id = int(request['query'].get('after_id', 0))
+            limit = int(request['query'].get('limit', PAGE_SIZE))
+
+        except ValueError:
+            raise ApiError(400, "after_id and limit must be numbers.")
+
+        if not 1 <= limit <= 1000:
+            raise ApiError(400, "limit must be from 1 to 1000.")
+
+        return after_id, limit
+
+    @staticmethod
+    def _page_response(items, limit):
+        """Return a page of records, with the after_id of the next page."""
+        return ApiResponse(200, {
+            'items': [item._asdict() for item in items],
+            'next_after_id': items[-1].id if len(items) == limit else None,
+        })
+
+    @staticmethod
+    def _record_response(record, request, status=200):
+        """Return a record with its ETag, or 304 if the client has it."""
+        tag = etag(record)
+
+        if request['headers'].get('if-none-match') == tag:
+            return ApiResponse(304, headers=(('ETag', tag),))
+
+        return ApiResponse(status, record._asdict(), (('ETag', tag),))
+
+    def _check_if_match(self, request, book_id):
+        """Refuse a change to a book the client has an old copy of."""
+        expected = request['headers'].get('if-match')
+
+        if expected is not None and expected != '*':
+            if etag(self.inventory.get_book_details(book_id)) != expected:
+                raise ApiError(
+                    412, f"Book {book_id} has changed since it was read."
+                )
+
+    # ===== Books =====
+
+    def list_books(self, request):
+        after_id, limit = self._page(request)
+
+        return self._page_response(
+            self.inventory.list_books(after_id, limit), limit
+        )
+
+    def add_book(self, request):
+        fields = self._json(request)
+
+        try:
+            title = fields['title']
+            author_id = fields['author_id']
+            qty = fields['qty']
+
+        except KeyError as error:
+            raise ApiError(400, f"Missing field: {error.args[0]}")
+
+        with self.inventory.unit_of_work():
+            if fields.get('id') is None:
+                book = self.inventory.new_book(title, author_id, qty)
+            else:
+                book = self.inventory.add_book(
+                    fields['id'], title, author_id, qty
+                )
+
+        return self._record_response(
+            self.inventory.get_book_details(book.id), request, 201
+        )
+
+    def get_book(self, request, book_id):
+        return self._record_response(
+            self.inventory.get_book_details(int(book_id)), request
+        )
+
+    def update_book(self, request, book_id):
+        book_id = int(book_id)
+        fields = self._json(request)
+        setters = {
+            'title': self.inventory.update_title,
+            'author_id': self.inventory.set_book_author,
+            'qty': self.inventory.update_qty,
+            'reorder_level': self.inventory.set_reorder_level,
+        }
+        unknown = set(fields) - set(setters)
+
+        if unknown:
+            raise ApiError(
+                400, f"Unknown fields: {', '.join(sorted(unknown))}"
+            )
+
+        with self.inventory.unit_of_work():
+            self._check_if_match(request, book_id)
+
+            # Check that the book exists even if there is nothing to change.
+            self.inventory.get_book(book_id)
+
+            for field, value in fields.items():
+                setters[field](book_id, value)
+
+        return self._record_response(
+            self.inventory.get_book_details(book_id), request
+        )
+
+    def delete_book(self, request, book_id):
+        book_id = int(book_id)
+
+        with self.inventory.unit_of_work():
+            self._check_if_match(request, book_id)
+            self.inventory.delete_book(book_id)
+
+        return ApiResponse(204)
+
+    def adjust_stock(self, request, book_id):
+        fields = self._json(request)
+
+        if 'delta' not in fields:
+            raise ApiError(400, "Missing field: delta")
+
+        book = self.inventory.adjust_stock(int(book_id), fields['delta'])
+
+        return ApiResponse(200, book._asdict())
+
+    def adjust_stock_many(self, request):
+        items = self._json(request).get('items')
+
+        if not isinstance(items, list) or not all(
+            isinstance(item, dict) and {'book_id', 'delta'} <= set(item)
+            for item in items
+        ):
+            raise ApiError(
+                400, "items must be a list of {book_id, delta} objects."
+            )
+
+        books = self.inventory.adjust_stock_many(
+            (item['book_id'], item['delta']) for item in items
+        )
+
+        return ApiResponse(200, {'items': [book._asdict() for book in books]})
+
+    # ===== Search and reports =====
+
+    def search(self, request):
+        text = request['query'].get('q', '')
+        _, limit = self._page(request)
+
+        if not text.strip():
+            raise ApiError(400, "Missing search text: q")
+
+        return ApiResponse(200, {'items': [
+            result._asdict()
+            for result in self.inventory.search_books(text, limit)
+        ]})
+
+    def reorder_report(self, request):
+        after_id, limit = self._page(request)
+        items = self.inventory.reorder_report(after_id, limit)
+        response = self._page_response(items, limit)
+
+        for item, record in zip(items, response.body['items']):
+            record['shortfall'] = item.shortfall
+
+        return response
+
+    # ===== Authors =====
+
+    def get_author(self, request, author_id):
+        return self._record_response(
+            self.inventory.get_author(int(author_id)), request
+        )
+
+    def put_author(self, request, author_id):
+        fields = self._json(request)
+
+        if not {'name', 'country'} <= set(fields):
+            raise ApiError(400, "name and country are required.")
+
+        author = self.inventory.upsert_author(
+            int(author_id), fields['name'], fields['country']
+        )
+
+        return self._record_response(author, request)
+
+    # ===== Monitoring =====
+
+    def metrics(self, request):
+        return ApiResponse(200, query_metrics.render(), (
+            ('Content-Type', 'text/plain; version=0.0.4; charset=utf-8'),
+        ))
+
+
+def make_server(host='127.0.0.1', port=8080, workers=SERVER_WORKERS,
+                inventory=None):
+    """
+    This function creates an HTTP/1.1 server for the JSON API.
+
+    Each client connection has a thread of its own that reads its requests
+    and writes the responses, but holds no SQLite connection. The requests
+    themselves are handed, one at a time, to a fixed pool of worker
+    threads, each keeping its own SQLite connection for as long as it
+    lives. An idle kept-alive client therefore never holds a worker, and
+    requests beyond the pool size wait their turn.
+
+    Parameters:
+        host (str): The address to listen on.
+        port (int): The port to listen on. 0 picks a free port.
+        workers (int): The number of worker threads, and so of SQLite
+                       connections.
+        inventory (Inventory): The service to serve. Defaults to a new
+                               Inventory on DB_NAME.
+
+    Returns:
+        http.server.HTTPServer: The server. Call serve_forever() to run it
+                                and server_close() to stop it.
+    """
+    import json
+    from concurrent.futures import ThreadPoolExecutor
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+    from socketserver import ThreadingMixIn
+
+    api = InventoryApi(inventory)
+
+    class RequestHandler(BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+        server_version = 'ShelfTrack'
+        timeout = SERVER_IDLE_TIMEOUT
+
+        # The headers and body are written separately, so without this the
+        # body of a kept-alive response waits on the client's delayed ACK.
+        disable_nagle_algorithm = True
+
+        def handle_request(self):
+            try:
+                response = self.server.pool.submit(
+                    api.handle, self.command, self.path, *self.read_request()
+                ).result()
+
+            # The body, if any, has not been read, so the connection cannot
+            # be used for another request.
+            except ApiError as error:
+                response = ApiResponse(error.status, {'error': str(error)},
+                                       (('Connection', 'close'),))
+
+            # Report database failures without closing the connection.
+            except sqlite3.Error as error:
+                response = ApiResponse(503, {'error': str(error)})
+
+            self.send_api_response(response)
+
+        def read_request(self):
+            """Return the request's headers and body."""
+            try:
+                length = int(self.headers.get('Content-Length') or 0)
+
+            except ValueError:
+                raise ApiError(400, "Content-Length must be a whole number.")
+
+            if length < 0:
+                raise ApiError(400, "Content-Length must not be negative.")
+
+            if length > MAX_REQUEST_BODY:
+                raise ApiError(
+                    413, f"The body must be at most {MAX_REQUEST_BODY} bytes."
+                )
+
+            body = self.rfile.read(length) if length else b''
+            headers = {name.lower(): value
+                       for name, value in self.headers.items()}
+
+            return headers, body
+
+        def send_api_response(self, response):
+            """Send the response, with its body as JSON or plain text."""
+            payload = b''
+
+            # A text body, such as the metrics, is sent as it is.
+            if isinstance(response.body, str):
+                payload = response.body.encode()
+
+            elif response.body is not None:
+                payload = json.dumps(response.body).encode()
+
+            self.send_response(response.status)
+
+            for name, value in response.headers:
+                self.send_header(name, value)
+
+            if payload and not any(name == 'Content-Type'
+                                   for name, _ in response.headers):
+                self.send_header('Content-Type', 'application/json')
+
+            self.send_header('Content-Length', str(len(payload)))
+            self.end_headers()
+            self.wfile.write(payload)
+
+        do_GET = do_POST = do_PUT = do_PATCH = do_DELETE = handle_request
+
+        def log_message(self, format, *args):
+            """Keep the request log quiet; errors are sent to the client."""
+
+    class WorkerPoolServer(ThreadingMixIn, HTTPServer):
+        daemon_threads = True
+
+        # Room for many clients connecting at once, as each connection is
+        # accepted straight away rather than when a worker is free.
+        request_queue_size = 128
+
+        def __init__(self, *args, **kwargs):
+            super().__init__(*args, **kwargs)
+            self.worker_ids = set()
+            self.pool = ThreadPoolExecutor(
+                workers, 'shelf-track-http', initializer=self._add_worker
+            )
+
+        def _add_worker(self):
+            self.worker_ids.add(threading.get_ident())
+
+        def server_close(self):
+            super().server_close()
+            self.pool.shutdown(wait=True, cancel_futures=True)
+            close_connections(self.worker_ids)
+
+    return WorkerPoolServer((host, port), RequestHandler)
+
+
+# ========== Prompt Functions ==========
+
+def render_table(rows, headers=()):
+    """
+    This function formats rows as a table for the menu.
+
+    The tabulate package is only imported the first time a table is drawn,
+    so scripts and headless commands never load it.
+
+    Parameters:
+        rows (list): The rows of the table.
+        headers (list): The column headings, if any.
+
+    Returns:
+        str: The formatted table.
+    """
+    from tabulate import tabulate
+
+    return tabulate(rows, headers=headers, tablefmt="fancy_grid")
+
+
+def prompt_valid(message, validate, *args):
+    """
+    This function continuously requests the user to enter an input until it
+    passes the validation function.
+
+    Parameters:
+        message (str): The prompt displayed to the user.
+        validate (function): A validation function that returns the cleaned
+                             value or raises ValidationError.
+        *args: Extra arguments passed to the validation function.
+
+    Returns:
+        The value returned by the validation function.
+    """
+    while True:
+        try:
+            return validate(input(message), *args)
+
+        # Print the reason the input is invalid and ask again.
+        except ValidationError as error:
+            print(error)
+
+
+def prompt_yes_no(message):
+    """
+    This function requests the user to answer a yes or no question.
+
+    Parameters:
+        message (str): The question displayed to the user.
+
+    Returns:
+        bool: True if the user answered 'y', False if they answered 'n'.
+    """
+    while True:
+        answer = input(message).strip().lower()
+
+        if answer in ("y", "n"):
+            return answer == "y"
+
+        # Repeat the prompt if the input is incorrect.
+        print("Please enter 'y' or 'n'")
+
+
+def prompt_new_author(author_id):
+    """
+    This function offers to add an author that does not exist yet, and
+    requests the author's name and country if the user agrees. The author
+    is not saved, so it can be added in the same transaction as the book.
+
+    Parameters:
+        author_id (int): The ID of the missing author.
+
+    Returns:
+        Author: The new author, or None if the user declined.
+    """
+    print(f"The author ID {author_id} does not exist.\n")
+
+    # Check if the user would like to add a new author.
+    if not prompt_yes_no(
+        "Would you like to add the author to the system? (y/n)"
+    ):
+        return None
+
+    name = prompt_valid("Please enter the author's name: \n", validate_name)
+    country = prompt_valid(
+        "Please enter the author's country: \n",
+        validate_name, "country name"
+    )
+
+    return Author(author_id, name, country)
+
+
+def show_pages(pages, show_page):
+    """
+    This function displays a listing one page at a time, and asks the user
+    whether they would like to see the next page.
+
+    The next page is fetched before asking, so the user is never asked about
+    a page that turns out to be empty.
+
+    Parameters:
+        pages (iterable): The pages of records to display.
+        show_page (function): Displays one page of records.
+
+    Returns:
+        bool: True if at least one page was displayed.
+    """
+    pages = iter(pages)
+    page = next(pages, None)
+
+    if page is None:
+        return False
+
+    while page is not None:
+        show_page(page)
+        page = next(pages, None)
+
+        # Stop if the user does not want to see the next page.
+        if page is not None and input(
+            "Press Enter to see more books, or 'q' to stop: "
+        ).strip().lower() == "q":
+            break
+
+    return True
+
+
+def print_books(inventory, heading):
+    """
+    This function displays the books in the inventory in a table, one page
+    at a time.
 
-            # Insert or replace book_data in the book table.
-            cursor.executemany('''
-                INSERT OR REPLACE INTO book (id, title, authorID, qty)
-                VALUES(? , ?, ?, ?)
-            ''', book_data)
+    Parameters:
+        inventory (Inventory): The inventory to list.
+        heading (str): The heading printed above the table.
 
-            # Insert or replace author_data in the author table.
-            cursor.executemany('''
-                INSERT OR REPLACE INTO author(id, name, country)
-                VALUES(?, ?, ?)
-            ''', author_data)
+    Returns:
+        bool: True if there were any books to display.
+    """
+    print(f"\n{heading}:\n")
+    headers = ["Book ID", "Title", "Author", "Quantity"]
 
-    # Catch and print any database errors that occur.
-    except sqlite3.Error as error:
-        print(f"There was an error inserting the data: {error}")
+    return show_pages(
+        inventory.iter_books(),
+        lambda page: print(
+            render_table(page, headers)
+        )
+    )
 
 
 # ========== SYSTEM FUNCTIONS ==========
 
 
-def menu():
+def menu(inventory=None):
     """
     Displays and loops the menu until the user selects a valid input or exits.
 
     When a valid input is selected, the respective function is called.
+
+    Parameters:
+        inventory (Inventory): The inventory the menu works on.
     """
+    inventory = inventory or Inventory()
+
+    actions = {
+        1: enter_book,
+        2: update_book,
+        3: delete,
+        4: search,
+        5: view_details,
+        6: reorder_report,
+    }
+
     # Continuously request the user to enter an input until a valid
     # option is selected.
     while True:
@@ -159,6 +5185,7 @@ def menu():
             "3. Delete book\n"
             "4. Search books\n"
             "5. View details of all books\n"
+            "6. Reorder report\n"
             "0. Exit"
             )
 
@@ -166,361 +5193,149 @@ def menu():
             # Request the user to enter an input and convert to integer.
             menu_input = int(input(
                 "Select one of the options from the menu above.\n"
-                "Please enter the number only (0-5):\n"
+                "Please enter the number only (0-6):\n"
                 )
             )
 
         # Catch non-numeric inputs and print an error message.
         except ValueError:
-            print("Invalid. Please enter a number from 0 - 5")
+            print("Invalid. Please enter a number from 0 - 6")
             continue
 
         # Check if the number is within the range.
-        if menu_input < 0 or menu_input > 5:
-            print("Invalid input. Please enter a number between 0 and 5")
+        if menu_input < 0 or menu_input > 6:
+            print("Invalid input. Please enter a number between 0 and 6")
             continue
 
-        if menu_input == 1:
-            enter_book()
-
-        elif menu_input == 2:
-            update_book()
-
-        elif menu_input == 3:
-            delete()
-
-        elif menu_input == 4:
-            search()
-
-        elif menu_input == 5:
-            view_details()
-
-        elif menu_input == 0:
+        if menu_input == 0:
             print("Goodbye!")
             break
 
-
-def enter_book():
-    """
-    This function allows the user to capture the details of a book, validates
-    the inputs and then inserts the details into the database. If the author
-    does not exist, the user is provided the option to add the author.
-    """
-    # ===== Validate book id =====
-
-    # Continuously request the user to enter an input until the input is valid.
-    while True:
         try:
-            # Request the user to enter a book id and convert it to an integer.
-            book_id = int(input("Please enter the book id:\n"))
-
-            # Check if the input is a 4-digit number.
-            if book_id < 1000 or book_id > 9999:
-                print("Please enter a positive, 4 digit number")
-
-                # If the input is invalid, continue to loop.
-                continue
-            break       # Exit the loop if the input it valid.
-
-        except ValueError:
-            # Print an error message if the input is not a number.
-            print("Invalid input. Please enter a positive, 4 digit number.")
+            actions[menu_input](inventory)
 
-    # ===== Validate title =====
+        # Catch and print any database errors that occur.
+        except sqlite3.Error as error:
+            print(f"The following database error occurred: {error}")
 
-    # Continuously request the user to enter an input until the input is valid.
-    while True:
-        # Request the user to enter a title.
-        title = input("Please enter the title of the book:\n").strip()
 
-        # Check if the input is blank.
-        if not title:
-            print("The title cannot be blank.")
+def enter_book(inventory=None):
+    """
+    This function allows the user to capture the details of a book, validates
+    the inputs and then inserts the details into the database. If the author
+    does not exist, the user is provided the option to add the author, and
+    the author and the book are saved together in one transaction.
 
-            # Continue to loop until the input is not blank.
-            continue
-        break       # Exit the loop if the input is not blank.
+    Parameters:
+        inventory (Inventory): The inventory to add the book to.
+    """
+    inventory = inventory or Inventory()
 
-    # ===== Validate author ID =====
+    book_id = prompt_valid(
+        "Please enter the book id, or leave it blank to assign one:\n",
+        validate_new_id
+    )
+    title = prompt_valid("Please enter the title of the book:\n",
+                         validate_title)
+    author_id = prompt_valid("Please enter the author ID:\n",
+                             validate_id, "author")
 
-    # Continuously request the user to enter an input until the input is valid.
-    while True:
-        try:
-            # Request the user to enter an author id and convert it to an
-            # integer.
-            author_id = int(input("Please enter the author ID:\n"))
+    # Offer to add the author if they do not exist.
+    new_author = None
 
-            # Check if the input is a 4-digit number.
-            if author_id < 1000 or author_id > 9999:
-                print("The author id must be a positive, 4 digit number.")
+    if not inventory.author_exists(author_id):
+        new_author = prompt_new_author(author_id)
 
-                # If the input is invalid, continue to loop.
-                continue
-            break       # Exit the loop if the input it valid.
+        if new_author is None:
+            return
 
-        except ValueError:
-            # Print an error message if the input is not a number.
-            print("Invalid input. Please enter a positive, 4 digit number.")
+    qty = prompt_valid("Please enter the quantity of books:\n", validate_qty)
 
     try:
-        # Open the database connection and create a cursor.
-        with db_connection() as cursor:
-
-            # Check if the author exists in the author table.
-            cursor.execute('''
-                SELECT id
-                FROM author
-                WHERE id = ?
-            ''', (author_id,)
-            )
-
-            # Print message if the author does not exist.
-            if cursor.fetchone() is None:
-                print(f"The author ID {author_id} does not exist.\n")
-
-                while True:
-                    # Check if the user would like to add a new author.
-                    new_auth = input(
-                        "Would you like to add the author to the system? (y/n)"
-                    ).strip().lower()
-
-                    if new_auth == "y":
-                        # Request the user to enter the author's name.
-                        name = input(
-                            "Please enter the author's name: \n"
-                        ).strip()
-
-                        # Check if the input is blank.
-                        if not name:
-                            print("This field cannot be blank.")
-                            continue
-
-                        # Check if the input starts with a letter.
-                        if not name[0].isalpha():
-                            print(
-                                "The Author's name should start with a letter."
-                            )
-                            continue
-
-                        # Check if the input is numeric.
-                        if name.lstrip('-').isdigit():
-                            print(
-                                "The Author's name cannot consist of numbers."
-                            )
-                            continue
-
-                        # Request the user to enter the author's country.
-                        country = input(
-                            "Please enter the author's country: \n"
-                        ).strip()
-
-                        # Check if the input is blank.
-                        if not country:
-                            print("This field cannot be blank.")
-                            continue
-
-                        # Check if the input starts with a letter.
-                        if not country[0].isalpha():
-                            print(
-                                "The Author's name should start with a letter."
-                            )
-                            continue
-
-                        # Check if the input is numeric.
-                        if country.lstrip('-').isdigit():
-                            print(
-                                "The Author's name cannot consist of numbers."
-                            )
-                            continue
-
-                        try:
-                            # Insert the new author into the database.
-                            with db_connection(commit=True) as cursor:
-                                cursor.execute('''
-                                    INSERT INTO author (id, name, country)
-                                    VALUES(?, ?, ?)
-                                ''', (author_id, name, country)
-                                )
-
-                                print("The author was added successfully.")
-                                break       # Exit the create new author loop.
-
-                        except sqlite3.Error as error:
-                            print(f"Error inserting author: {error}")
-                            return      # Exit function if db error occurs.
-
-                    elif new_auth == "n":
-                        # Exit function if user chooses not the add an author.
-                        return
-
-                    # Repeat the prompt if the input is incorrect.
-                    else:
-                        print("Please enter 'y' or 'n'")
-
-    # Catch and print any database errors that occur.
-    except sqlite3.Error as error:
-        print(f"The following database error occurred: {error}")
+        with inventory.unit_of_work():
+            if new_author is not None:
+                inventory.upsert_author(*new_author)
 
-    # ===== Validate quantity =====
+            if book_id is None:
+                book_id = inventory.new_book(title, author_id, qty).id
+            else:
+                inventory.add_book(book_id, title, author_id, qty)
 
-    # Continuously request the user to enter an input until the input is valid.
-    while True:
-        try:
-            # Request the user to enter a quantity and convert to an integer.
-            qty = int(input("Please enter the quantity of books:\n"))
-
-            # Check if the quantity is a negative number.
-            if qty < 0:
-                print("Quantity cannot be negative.")
-                continue        # Continue to loop if the input is negative.
-
-            break       # Exit the loop if the input is valid.
-
-        except ValueError:
-            # Print an error message if the input is a negative number.
-            print("Invalid input. Please enter a positive number")
-
-    # Try to insert the new book into the book table.
-    try:
-        with db_connection(commit=True) as cursor:
-            # Insert the book into the database.
-            cursor.execute('''
-                INSERT INTO book (id, title, authorID, qty)
-                VALUES(?, ?, ?, ?)
-            ''', (book_id, title, author_id, qty))
+        if new_author is not None:
+            print("The author was added successfully.")
 
-            # Print success message.
-            print(f"The book {title} has been added to the database")
+        print(f"The book {title} has been added to the database with the "
+              f"id {book_id}")
 
     # Print error message if the book already exists.
-    except sqlite3.IntegrityError:
-        print(f"The book id {book_id} already exists in the database.")
-
-    # Catch and print any database errors that occur.
-    except sqlite3.Error as error:
-        print(f"The following database error occurred: {error}")
+    except InventoryError as error:
+        print(error)
 
 
-def update_book():
+def update_book(inventory=None):
     """
     This function validates the book ID entered by the user and then allows
     the user to update the quantity, title, author ID, author country and name.
-    """
-    try:
-        with db_connection(commit=True) as cursor:
-            # Fetch all books from the book table.
-            cursor.execute('''
-                SELECT * FROM book
-            ''')
-
-            book_list = cursor.fetchall()
-
-    except sqlite3.Error as error:
-        # Catch and print any database errors that occur.
-        print(f"The following database error occurred: {error}")
-
-    # Display a message if there are no books in the database.
-    if not book_list:
-        print("There are no books currently.")
-        return
 
-    # Display all books that are found, in a table format.
-    print("\nCurrent Books:\n")
-    headers = ["Book ID", "Title", "Author", "Quantity"]
+    The changes are collected first and saved together in one transaction
+    when the user returns to the main menu, so either all of them are saved
+    or, if one of them fails, none are.
 
-    print(tabulate(book_list, headers=headers, tablefmt="fancy_grid"))
+    Parameters:
+        inventory (Inventory): The inventory containing the book.
+    """
+    inventory = inventory or Inventory()
 
-    # ===== Validate book ID =====
+    # Display the books a page at a time, in a table format.
+    if LIST_BOOKS_BEFORE_EDIT:
+        if not print_books(inventory, "Current Books"):
+            # Display a message if there are no books in the database.
+            print("There are no books currently.")
+            return
 
-    # Continuously request the user to enter an input until the input is valid.
+    # Continuously request the user to enter an ID until a book is found.
     while True:
-
-        # Request the user to enter the book id.
-        id_chosen = input(
-            "\nPlease enter the ID of the book you would like to update: \n"
+        book_id = prompt_valid(
+            "\nPlease enter the ID of the book you would like to update: \n",
+            validate_id
         )
 
-        # Check if the input is numeric and has 4 digits.
-        if not id_chosen.isdigit() or len(id_chosen) != 4:
-            print("Invalid input. Please enter a positive 4 digit number")
-            continue
-
         try:
-            with db_connection() as cursor:
-                # Fetch the book selected and the author information.
-                cursor.execute('''
-                    SELECT book.*, author.name, author.country
-                    FROM book
-                    INNER JOIN author
-                    ON book.authorID = author.id
-                    WHERE book.id = ?
-                ''', (id_chosen,)
-                )
-
-                book_chosen = cursor.fetchone()
-
-        except sqlite3.Error as error:
-            # Catch and display errors that occur when retrieving the book.
-            print(f"The following database error occurred: {error}")
-
-            return      # Exit the function if a database error occurs.
-
-        if book_chosen:
+            book_chosen = inventory.get_book_details(book_id)
             break
-        print("There was no book found with that ID. Please try again.")
+
+        except BookNotFoundError:
+            print("There was no book found with that ID. Please try again.")
 
     # Display the details of the selected book and the author, in a table
     # format.
-    if book_chosen is not None:
-        print("\nDetails of the chosen book:")
-
-        details = [
-            ["ID", book_chosen[0]],
-            ["Title", book_chosen[1]],
-            ["Author ID", book_chosen[2]],
-            ["Quantity", book_chosen[3]],
-            ["Author Name", book_chosen[4]],
-            ["Author Country", book_chosen[5]],
-        ]
-
-        print(tabulate(details, tablefmt="fancy_grid"))
-
-    # ===== Validate new quantity =====
-
-    # Continuously request the user to enter an input until the input is valid.
-    while True:
-        try:
-
-            # Request the user to enter a new quantity.
-            update_qty = int(input("Please enter the new quantity:\n"))
-
-            # Chceck that the input is not a negative number.
-            if update_qty < 0:
-                print("Please insert a positive number.")
-                continue
-
-            break       # Exit the loop if the input is valid.
-
-        except ValueError:
-            # Print error message for non-numeric inputs.
-            print("Invalid input. Please enter a positive number.")
+    print("\nDetails of the chosen book:")
+
+    details = [
+        ["ID", book_chosen.id],
+        ["Title", book_chosen.title],
+        ["Author ID", book_chosen.author_id],
+        ["Quantity", book_chosen.qty],
+        ["Author Name", book_chosen.author_name],
+        ["Author Country", book_chosen.author_country],
+    ]
 
-    try:
-        with db_connection(commit=True) as cursor:
-            # Update the details in the database.
-            cursor.execute('''
-                UPDATE book
-                SET qty = ?
-                WHERE id = ?
-            ''', (update_qty, id_chosen))
+    print(render_table(details))
 
-    except sqlite3.Error as error:
-        # Catch and display errors that occur during the update.
-        print(f"The following database error occurred: {error}")
-        return
+    # The changes to save once the user is done.
+    title = book_chosen.title
+    author_id = book_chosen.author_id
+    new_author = None
+    author_changes = {}
+    reorder_level = None
 
-    # Display success message.
-    print("The quantity was successfully added.")
+    # ===== Update quantity =====
+    # A signed number, such as +5 or -2, is added to the current quantity
+    # in a single UPDATE, so sales made elsewhere at the same time are kept.
+    new_qty, delta = prompt_valid(
+        "Please enter the new quantity, or +N / -N to add or remove stock:\n",
+        validate_stock_change
+    )
 
     # Ask the user if they would like to update the title, author or exit.
     while True:
@@ -530,539 +5345,646 @@ def update_book():
             " [a] - The author id\n"
             " [an] - The author's name\n"
             " [ac] - The author's country\n"
-            " [r] - Return to the main menu\n"
+            " [rl] - The reorder level\n"
+            " [r] - Save the changes and return to the main menu\n"
+            " [c] - Cancel the changes and return to the main menu\n"
             "Enter your choice: "
         ).strip().lower()
 
         # ===== Title update =====
         if update_choice == "t":
-
             while True:
+                new_title = prompt_valid(
+                    "Please enter the new title of the book: \n",
+                    validate_title
+                )
 
-                # Request the user to enter the new title of the book.
-                new_title = input(
-                    "Please enter the new title of the book: \n"
-                ).strip()
-
-                # Check if input is blank
-                if not new_title:
-                    print("This field cannot be blank.")
-                    continue        # Continue to loop if the input is blank.
-
-                try:
-                    with db_connection() as cursor:
-                        # Check if the title of the book already exists:
-                        cursor.execute('''
-                            SELECT * FROM book
-                            WHERE title = ? and id = ?
-                        ''', (new_title, id_chosen)
-                        )
-                        title_match = cursor.fetchone()
-
-                # Catch and display errors that occur during the title
-                # validation.
-                except sqlite3.Error as error:
-                    print(f"The following database error occurred: {error}")
-
-                # Display a message and continue to loop if title exists.
-                if title_match:
+                # Continue to loop if the title has not changed.
+                if new_title == title:
                     print(
                         "The title already exists. Please enter a new title."
                     )
                     continue
 
-                try:
-                    with db_connection(commit=True) as cursor:
-                        # Update the title in the database.
-                        cursor.execute('''
-                            UPDATE book
-                            SET title = ?
-                            WHERE ID = ?
-                        ''', (new_title, id_chosen)
-                        )
-
-                # Catch and display errors that occur during the update
-                # process.
-                except sqlite3.Error as error:
-                    print(f"The following database error occurred: {error}")
-
-                # Display a success message to the user.
-                print("The title was successfully updated.")
-                break       # Exit the loop.
+                title = new_title
+                print("The title will be updated.")
+                break
 
         # ===== Author ID update =====
-
         elif update_choice == "a":
-            # Continue to loop until the user enters a valid input.
-            while True:
+            new_author_id = prompt_valid(
+                "Please enter the new authorID: \n", validate_id, "author"
+            )
 
-                # Request the user to enter a new author ID.
-                new_author_input = input("Please enter the new authorID: \n")
+            # Offer to add the author if they do not exist.
+            added = None
 
-                try:
-                    new_author_id = int(new_author_input)
+            if not inventory.author_exists(new_author_id):
+                added = prompt_new_author(new_author_id)
 
-                    # Check that the author id is positive and has 4 digits.
-                    if not 1000 <= new_author_id <= 9999:
-                        print("Please enter a positive 4 digit number.")
+                if added is None:
+                    continue
 
-                    try:
-                        with db_connection() as cursor:
-
-                            # Check if the author exists in the author table.
-                            cursor.execute('''
-                                SELECT id
-                                FROM author
-                                WHERE id = ?
-                            ''', (new_author_id,))
-
-                            # Print message if the author does not exist.
-                            if cursor.fetchone() is None:
-                                print(
-                                    f"The author ID {new_author_id} "
-                                    "does not exist.\n"
-                                )
-
-                                while True:
-                                    # Check if the user would like to add a
-                                    # new author.
-                                    new_auth = input(
-                                        "Would you like to add the author to "
-                                        "the system? (y/n)"
-                                    ).strip().lower()
-
-                                    if new_auth == "n":
-                                        return
-
-                                    elif new_auth == "y":
-                                        # Request user to enter the author's
-                                        # name.
-                                        name = input(
-                                            "Please enter the author's "
-                                            "name: \n"
-                                        ).strip()
-
-                                        # Check if the input is blank.
-                                        if not name:
-                                            print(
-                                                "This field cannot be blank."
-                                            )
-                                            continue
-
-                                        # Check if the input starts with a
-                                        # letter.
-                                        if not name[0].isalpha():
-                                            print(
-                                                "The Author's name should "
-                                                "start with a letter."
-                                            )
-                                            continue
-
-                                        # Check if the input is numeric.
-                                        if name.lstrip('-').isdigit():
-                                            print(
-                                                "The Author's name cannot "
-                                                "consist of numbers."
-                                            )
-                                            continue
-
-                                        # Request the user to enter the
-                                        # author's country.
-                                        country = input(
-                                            "Please enter the author's "
-                                            "country: \n"
-                                        ).strip()
-                                        # Check if the input is blank.
-                                        if not country:
-                                            print(
-                                                "This field cannot be blank."
-                                            )
-                                            continue
-
-                                        # Check if the input starts with a
-                                        # letter.
-                                        if not country[0].isalpha():
-                                            print(
-                                                "The Author's name should "
-                                                "start with a letter."
-                                            )
-                                            continue
-
-                                        # Check if the input is numeric.
-                                        if country.lstrip('-').isdigit():
-                                            print(
-                                                "The Author's name cannot "
-                                                "consist of numbers."
-                                            )
-                                            continue
-                                        try:
-                                            # Insert the new author into the
-                                            # database.
-                                            with db_connection(
-                                                commit=True
-                                            ) as cursor:
-
-                                                cursor.execute(
-                                                    '''
-                                                    INSERT INTO author (
-                                                        id,
-                                                        name,
-                                                        country
-                                                    )
-                                                    VALUES(?, ?, ?)
-                                                    ''',
-                                                    (
-                                                        new_author_id,
-                                                        name,
-                                                        country
-                                                    )
-                                                )
-
-                                                print(
-                                                    "The autor was added "
-                                                    "successfully."
-                                                )
-
-                                                # Exit the create new author
-                                                # loop.
-                                                break
-
-                                        except sqlite3.Error as error:
-                                            print("Error inserting author: "
-                                                  f"{error}")
-
-                                            # Exit function if db error occurs.
-                                            return
-
-                    except sqlite3.Error as error:
-                        print(f"Error inserting author: {error}")
+            author_id, new_author, author_changes = new_author_id, added, {}
+            print("The author ID will be updated.")
 
-                    try:
-                        with db_connection(commit=True) as cursor:
-
-                            # Update the author id in the database
-                            cursor.execute('''
-                                UPDATE book
-                                SET authorID = ?
-                                WHERE id = ?
-                            ''', (new_author_id, id_chosen)
-                            )
-
-                    # Catch and display errors that occur during the update.
-                    except sqlite3.Error as error:
-                        print(
-                            f"The following database error occurred: {error}"
-                        )
-
-                    # Display success message and exit the loop.
-                    print("The author ID has been successfully updated.")
-                    break
+        # ===== Author name and country updates =====
+        elif update_choice in ("an", "ac"):
+            if update_choice == "an":
+                field, value = "name", prompt_valid(
+                    "Please enter a new value for the Author's name: \n",
+                    validate_name
+                )
+            else:
+                field, value = "country", prompt_valid(
+                    "Please enter a new country: \n",
+                    validate_name, "country name"
+                )
 
-                # Catch error and display message for non-numeric inputs.
-                except ValueError:
-                    print("Please enter a 4 digit numeric author ID.")
+            # An author added in this edit is saved with the new value.
+            if new_author is not None:
+                new_author = new_author._replace(**{field: value})
 
-        # ===== Author name update =====
+            elif inventory.author_exists(author_id):
+                author_changes[field] = value
 
-        # Continue to loop until the user enters a valid input.
-        elif update_choice == "an":
-            while True:
-                # Request user to enter a new author name.
-                new_auth_name = input(
-                    "Please enter a new value for the Author's name: \n"
-                ).strip()
-
-                # Check if the input is blank.
-                if not new_auth_name:
-                    print("This field cannot be blank.")
-                    continue
+            else:
+                print(f"The author ID {author_id} does not exist.")
+                continue
 
-                # Check if the input starts with a letter.
-                if not new_auth_name[0].isalpha():
-                    print("The Author's name should start with a letter.")
-                    continue
+            print(f"The author's {field} will be updated.")
 
-                # Check if the input is numeric.
-                if new_auth_name.lstrip('-').isdigit():
-                    print("The Author's name cannot consist of numbers.")
-                    continue
+        # ===== Reorder level update =====
+        elif update_choice == "rl":
+            reorder_level = prompt_valid(
+                "Please enter the quantity below which the book should be "
+                "reordered (0 to never reorder it): \n",
+                validate_qty
+            )
+            print("The reorder level will be updated.")
 
-                try:
-                    with db_connection(commit=True) as cursor:
-                        # Update the author's name in the database.
-                        # book_chosen[2] is authorID
-                        cursor.execute('''
-                            UPDATE author
-                            SET name = ?
-                            WHERE id = ?
-                        ''', (new_auth_name, book_chosen[2]))
-
-                # Catch and display any errors that occur during the update.
-                except sqlite3.Error as error:
-                    print(f"The following database error occurred: {error}")
-
-                # Display success message and exit the loop.
-                print("The author's name has been updated successfully.")
-                break
+        # ===== Save and return to main menu =====
+        elif update_choice == "r":
+            break
 
-        # ===== Author country update =====
+        # ===== Cancel and return to main menu =====
+        elif update_choice == "c":
+            print("The changes were not saved.")
+            return
 
-        elif update_choice == "ac":
-            while True:
-                # Request user to enter a new country
-                new_country = input("Please enter a new country: \n").strip()
+        # ===== Handle invalid inputs =====
+        else:
+            print("Please enter one of the options: 't', 'a', 'an', 'ac', "
+                  "'rl', 'r', 'c'")
 
-                # Check if the input is blank.
-                if not new_country:
-                    print("This field cannot be blank.")
-                    continue
+    # Save every change in one transaction, so a failure leaves the book as
+    # it was.
+    try:
+        with inventory.unit_of_work():
+            if delta is not None:
+                inventory.adjust_stock(book_id, delta)
+            else:
+                inventory.update_qty(book_id, new_qty)
 
-                # Check if the input starts with a letter
-                if not new_country[0].isalpha():
-                    print("The Country should start with a letter.")
-                    continue
+            if title != book_chosen.title:
+                inventory.update_title(book_id, title)
 
-                # Check if the input is numeric.
-                if new_country.lstrip('-').isdigit():
-                    print("The country name cannot consist of numbers.")
-                    continue
+            if new_author is not None:
+                inventory.upsert_author(*new_author)
 
-                try:
-                    with db_connection(commit=True) as cursor:
-                        # Update the country in the database.
-                        cursor.execute('''
-                            UPDATE author
-                            SET country = ?
-                            WHERE id = ?
-                        ''', (new_country, book_chosen[2]))
-
-                # Catch and display any database errors that occur during the
-                # update.
-                except sqlite3.Error as error:
-                    print(f"The following database error occurred: {error}")
-
-                # Print success message and exit the loop.
-                print("The country has been successfully updated.")
-                break
+            if author_id != book_chosen.author_id:
+                inventory.set_book_author(book_id, author_id)
 
-        # ===== Return to main menu =====
-        elif update_choice == "r":
-            break       # Exit the loop and return to main menu.
+            if author_changes:
+                inventory.update_author(author_id, **author_changes)
 
-        # ===== Handle invalid inputs =====
-        else:
-            print("Please enter one of the options: 't', 'a', 'r' ")
+            if reorder_level is not None:
+                inventory.set_reorder_level(book_id, reorder_level)
+
+        print("The book was successfully updated.")
 
+    except InventoryError as error:
+        print(error)
+        print("The changes were not saved.")
 
-def delete():
+
+def delete(inventory=None):
     """
     This function will allow the user to delete a book from the database.
 
     All the current books are displayed to the user. The user is then
     requested to enter the book id they wish to delete. The book ID is
     validated and then the book is deleted.
+
+    Parameters:
+        inventory (Inventory): The inventory containing the book.
     """
-    try:
-        # Fetch all books from the book database.
-        with db_connection() as cursor:
-            cursor.execute('''
-                SELECT * FROM book
-            ''')
-            book_list = cursor.fetchall()
+    inventory = inventory or Inventory()
 
-    # Catch and display any database errors that occur during the
-    # fetch.
-    except sqlite3.Error as error:
-        print(f"The following database error occurred: {error}")
-        return
+    # Display the book list a page at a time, in a table.
+    if LIST_BOOKS_BEFORE_EDIT:
+        if not print_books(inventory, "Book List"):
+            # Print a message if the book list is empty.
+            print("There are no current books to delete.")
+            return
 
-    # Check if the book list is empty and print a message.
-    if not book_list:
-        print("There are no current books to delete.")
-        return
+    # Continuously request the user to enter an id until a book is deleted.
+    while True:
+        id_selected = prompt_valid(
+            "Please enter the ID of the book you would like to delete: \n",
+            validate_id
+        )
+
+        try:
+            inventory.delete_book(id_selected)
+            print(f"The book with id {id_selected} has been deleted.")
+            break
+
+        # If no book is found, display message and loop again.
+        except BookNotFoundError as error:
+            print(error)
 
-    # Display the book list in a table.
-    print("\nBook List:\n")
-    headers = ["Book ID", "Title", "Author", "Quantity"]
 
-    print(tabulate(book_list, headers=headers, tablefmt="fancy_grid"))
+def search(inventory=None):
+    """
+    This function allows the user to search for a book based on the book id,
+    or on words from its title or its author's name.
+
+    If the user enters a number, it is validated as a book ID and the book
+    details are fetched. Otherwise the best matching books are listed.
+
+    Parameters:
+        inventory (Inventory): The inventory to search.
+    """
+    inventory = inventory or Inventory()
 
-    # Continuously request the user to enter an id until the input is valid.
+    # Continuously request the user to enter an input until it is valid.
     while True:
-        id_input = input(
-            "Please enter the ID of the book you would like to delete: \n"
+        search_input = input(
+            "Please enter the ID, title or author of the book you would like "
+            "to search: \n"
         ).strip()
 
         try:
-            id_selected = int(id_input)
+            # Search by ID if the input is numeric.
+            if search_input.isdigit():
+                book_found = inventory.get_book(validate_id(search_input))
+                results = None
 
-            # Check that the book id is positive and has 4 digits.
-            if not 1000 <= id_selected <= 9999:
-                print("Please enter a positive 4 digit number.")
-                continue
+            # Otherwise search the titles and author names.
+            else:
+                results = inventory.search_books(search_input)
 
-            try:
-                with db_connection() as cursor:
-                    # Check if the book is in the database.
-                    cursor.execute('''
-                        SELECT *
-                        FROM book
-                        WHERE id = ?
-                    ''', (id_selected,)
-                    )
+            break
 
-                    book_found = cursor.fetchone()
+        # Print the reason the input is invalid and ask again.
+        except ValidationError as error:
+            print(error)
 
-                # If no book is found, display message and loop again.
-                if not book_found:
-                    print(f"The book with id {id_selected} was not found.")
-                    continue
+        # Display message if no books were found.
+        except BookNotFoundError as error:
+            print(error)
+            return
 
-                # If the book exists, delete it from the database and exit
-                # loop.
-                with db_connection(commit=True) as cursor:
-                    cursor.execute('''
-                        DELETE FROM book
-                        WHERE id = ?
-                    ''', (id_selected,))
+    if results is not None:
+        if not results:
+            print(f"There are no books matching {search_input!r}")
+            return
 
-                    print(f"The book with id {id_selected} has been deleted.")
-                    break
+        # Print the matching books, best match first, in a table.
+        headers = ["Book ID", "Title", "Author", "Quantity", "Match"]
+        rows = [result[:5] for result in results]
 
-            # Catch and display any errors that occur during the deletion.
-            except sqlite3.Error as error:
-                print(f"The following database error occurred: {error}")
-                return
+        print(render_table(rows, headers))
+        return
 
-        # Handle inputs that are not valid integers.
-        except ValueError:
-            print("Invalid input. Please enter a positive 4 digit number.")
+    # Print book details, in a table.
+    details = [
+        ["Book ID", book_found.id],
+        ["Title", book_found.title],
+        ["Author ID", book_found.author_id],
+        ["Quantity", book_found.qty],
+    ]
+
+    print(render_table(details))
 
 
-def search():
+def view_details(inventory=None):
     """
-    This function allows the user to search for a book based on the book id.
+    This function displays a list of the books, in the database, with their
+    details.
 
-    Request the user to enter a valid book ID. The function validates the
-    input and then fetchs the book details.
+    Parameters:
+        inventory (Inventory): The inventory to display.
     """
-    # Continuously request the user to enter an id until the input is valid.
-    while True:
-        search_input = input(
-            "Please enter the ID of the book you would like to search: \n"
-        ).strip()
+    inventory = inventory or Inventory()
 
-        # Check if the input is numeric by trying to convert it into an
-        # integer.
-        try:
-            id_chosen = int(search_input)
+    def print_page(book_details):
+        for book in book_details:
+            print(f"Title: {book.title}\n")
+            print(f"Author's Name: {book.author_name}\n")
+            print(f"Author's Country: {book.author_country}")
+            print("-" * 75)
 
-            # Check that the book id is positive and has 4 digits.
-            if not 1000 <= id_chosen <= 9999:
-                print("Please enter a positive 4 digit number.")
+    # Print the book details, a page at a time.
+    print("\n Details")
+    print("-" * 75)
 
-            # Initialize the variable to None, to store the book if found.
-            book_found = None
+    show_pages(inventory.iter_book_details(), print_page)
 
-            try:
-                with db_connection() as cursor:
 
-                    # Search for the book in the book table.
-                    cursor.execute('''
-                        SELECT * FROM book
-                        WHERE id = ?
-                    ''', (id_chosen,))
+def reorder_report(inventory=None):
+    """
+    This function displays the books whose quantity has fallen below their
+    reorder level, with the number of copies needed, a page at a time.
 
-                    # Fetch the first result.
-                    book_found = cursor.fetchone()
+    Parameters:
+        inventory (Inventory): The inventory to report on.
+    """
+    inventory = inventory or Inventory()
+    headers = ["Book ID", "Title", "Author", "Quantity", "Reorder Level",
+               "Needed"]
 
-                # Print book details, in a table.
-                if book_found:
-                    details = [
-                        ["Book ID", book_found[0]],
-                        ["Title", book_found[1]],
-                        ["Author ID", book_found[2]],
-                        ["Quantity", book_found[3]],
-                    ]
+    print("\nReorder Report:\n")
 
-                    print(tabulate(details, tablefmt="fancy_grid"))
+    if not show_pages(
+        inventory.iter_reorder_report(),
+        lambda page: print(render_table(
+            [[item.id, item.title, item.author_name, item.qty,
+              item.reorder_level, item.shortfall] for item in page],
+            headers
+        ))
+    ):
+        print("No books are below their reorder level.")
 
-                else:
-                    # Display message if no books were found.
-                    print(f"There are no books for id {id_chosen}")
 
-                break
+# ========== System Function ==========
 
-            # Catch and display any database errors that occur during the
-            # search.
-            except sqlite3.Error as error:
-                print(f"The following database error occurred: {error}")
+def prepare_database(seed=False, database=None):
+    """
+    This function gets the database ready for use, doing as little work as
+    possible when it is already set up.
 
-        # Handle non-numeric inputs.
-        except ValueError:
-            print("Invalid input. Please enter a positive 4 digit number.")
+    A single read of the schema version decides whether any migrations are
+    needed. The seed data is only added to a brand new database, or when it
+    is asked for, and it never overwrites existing rows.
 
+    Parameters:
+        seed (bool): If True, add any seed rows that are missing.
+        database (str): The path of the SQLite database file. Defaults to
+                        DB_NAME.
 
-def view_details():
-    """
-    This function displays a list of the books, in the database, with their
-    details.
+    Returns:
+        bool: True if the database was newly created.
     """
-    try:
-        with db_connection() as cursor:
-            # Fetch the book titles, author names, and author countries
-            # using an inner join.
-            cursor.execute('''
-                SELECT book.title, author.name, author.country
-                FROM book
-                INNER JOIN author
-                ON book.authorID = author.id
-            ''')
-            book_details = cursor.fetchall()
+    conn = get_connection(database)
+    created = False
 
-    # Catch and display any database errors that occur during the
-    # fetching process.
-    except sqlite3.Error as error:
-        print(f"The following database error occurred: {error}")
-        return
+    # Bring the schema up to date, if it is not already.
+    if schema_version(conn) < MIGRATIONS[-1].version:
+        was_new = schema_version(conn) == 0 and conn.execute('''
+            SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'book'
+        ''').fetchone() is None
 
-    # Print the book details.
-    print("\n Details")
-    print("-" * 75)
+        migrate(database=database)
+        created = was_new
 
-    for title, name, country in book_details:
-        print(f"Title: {title}\n")
-        print(f"Author's Name: {name}\n")
-        print(f"Author's Country: {country}")
-        print("-" * 75)
+    # Populate a new database with the data sets created.
+    if seed or created:
+        data_sets(database=database)
 
+    return created
 
-# ========== System Function ==========
 
-def run_system():
+def run_system(seed=False):
     """
     This function initializes and runs the functionality of the bookstore
     system.
+
+    Parameters:
+        seed (bool): If True, add any missing seed books and authors before
+                     the menu starts.
     """
     try:
-        # Create the tables, if they do not exist.
-        create_table()
-
-        # Populate the database with the data sets created.
-        data_sets()
+        # Create or upgrade the tables, and seed a new database.
+        prepare_database(seed)
+        warn_about_query_plans()
 
         # Call the main menu to allow th user to perform tasks.
-        menu()
+        menu(Inventory())
 
     # Catch and display any database errors that occur during the
     # set up process.
-    except sqlite3.Error as error:
+    except (sqlite3.Error, MigrationError) as error:
         print(f"The following database error has occurred: {error}")
 
 
+# ========== Command Line ==========
+
+def main(argv=None):
+    """
+    This function parses the command line. With no command the interactive
+    menu is started, otherwise the chosen command is run.
+
+    Parameters:
+        argv (list): The command line arguments. Defaults to sys.argv.
+    """
+    global DB_NAME, PAGE_SIZE, LIST_BOOKS_BEFORE_EDIT
+
+    import argparse
+
+    parser = argparse.ArgumentParser(
+        description="Shelf Track bookstore inventory system."
+    )
+    parser.add_argument('--database', default=DB_NAME,
+                        help="the SQLite database file to use")
+    parser.add_argument('--profile', choices=sorted(STORAGE_PROFILES),
+                        help="the storage profile to use")
+    parser.add_argument('--page-size', type=int, default=PAGE_SIZE,
+                        help="the number of books shown per page")
+    parser.add_argument('--headless', action='store_true',
+                        help="never start the interactive menu or draw "
+                             "tables; a command must be given")
+    parser.add_argument('--seed', action='store_true',
+                        help="add any missing seed books and authors")
+    parser.add_argument('--no-listing', action='store_true',
+                        help="do not list the books before an update or "
+                             "delete")
+    parser.add_argument('--metrics-file',
+                        help="time every statement and write the metrics "
+                             "to this file, in the Prometheus text format, "
+                             "on exit")
+    parser.add_argument('--slow-query-ms', type=float,
+                        help="log statements that take at least this long")
+    parser.add_argument('--slow-query-log',
+                        help="the file slow statements are appended to; "
+                             "stderr by default")
+    commands = parser.add_subparsers(dest='command')
+
+    # ===== import =====
+    import_parser = commands.add_parser(
+        'import', help="load books or authors from a CSV or JSONL file"
+    )
+    import_parser.add_argument('path', help="the file to import")
+    import_parser.add_argument('--kind', choices=sorted(IMPORT_COLUMNS),
+                               default='books')
+    import_parser.add_argument('--format', dest='file_format',
+                               choices=['csv', 'jsonl'],
+                               help="defaults to the file extension")
+    import_parser.add_argument('--chunk-size', type=int,
+                               default=IMPORT_CHUNK_SIZE)
+    import_parser.add_argument('--rejects',
+                               help="where rejected rows are written")
+
+    # ===== export =====
+    export_parser = commands.add_parser(
+        'export', help="write the books or authors to a CSV, JSONL or "
+                       "Parquet file"
+    )
+    export_parser.add_argument('path', help="the file to write")
+    export_parser.add_argument('--kind', choices=sorted(EXPORT_COLUMNS),
+                               default='books')
+    export_parser.add_argument('--format', dest='file_format',
+                               choices=['csv', 'jsonl', 'parquet'],
+                               help="defaults to the file extension")
+    export_parser.add_argument('--batch-size', type=int,
+                               default=EXPORT_BATCH_SIZE)
+
+    # ===== backup =====
+    backup_parser = commands.add_parser(
+        'backup', help="copy the database to a file while it is in use"
+    )
+    backup_parser.add_argument('path', help="the backup file to write")
+    backup_parser.add_argument('--pages', type=int, default=BACKUP_PAGES,
+                               help="pages copied per step; -1 for all")
+    backup_parser.add_argument('--sleep', type=float, default=BACKUP_SLEEP,
+                               help="seconds to pause between steps")
+
+    # ===== search =====
+    search_parser = commands.add_parser(
+        'search', help="search book titles and author names"
+    )
+    search_parser.add_argument('text', help="the words to search for")
+    search_parser.add_argument('--limit', type=int, default=20)
+
+    # ===== reorder =====
+    reorder_parser = commands.add_parser(
+        'reorder', help="list the books below their reorder level"
+    )
+    reorder_parser.add_argument('--format', dest='report_format',
+                                choices=['tsv', 'csv'], default='tsv')
+
+    # ===== changes =====
+    changes_parser = commands.add_parser(
+        'changes', help="print the change log as JSON lines"
+    )
+    changes_parser.add_argument('--since', type=int, default=0,
+                                help="the seq of the last change already "
+                                     "received")
+    changes_parser.add_argument('--limit', type=int,
+                                help="the most changes to print")
+
+    # ===== batch =====
+    batch_parser = commands.add_parser(
+        'batch', help="run add, adjust, delete and rename-author commands "
+                      "from a file"
+    )
+    batch_parser.add_argument('path', nargs='?', default='-',
+                              help="the batch file; - (the default) reads "
+                                   "stdin")
+    batch_parser.add_argument('--batch-size', type=int, default=BATCH_SIZE,
+                              help="the commands committed together")
+    batch_parser.add_argument('--stop-on-error', action='store_true',
+                              help="stop at the first command that fails")
+
+    # ===== serve =====
+    serve_parser = commands.add_parser(
+        'serve', help="serve the inventory as a JSON API over HTTP"
+    )
+    serve_parser.add_argument('--host', default='127.0.0.1')
+    serve_parser.add_argument('--port', type=int, default=8080)
+    serve_parser.add_argument('--workers', type=int, default=SERVER_WORKERS,
+                              help="worker threads, each with its own "
+                                   "database connection")
+
+    # ===== check-plans =====
+    commands.add_parser(
+        'check-plans',
+        help="report statements whose query plan scans a whole table"
+    )
+
+    # ===== migrate =====
+    migrate_parser = commands.add_parser(
+        'migrate', help="bring the database schema up to date"
+    )
+    migrate_parser.add_argument('--to', type=int, dest='target',
+                                help="the schema version to stop at")
+
+    args = parser.parse_args(argv)
+
+    if args.page_size < 1:
+        parser.error("--page-size must be at least 1")
+
+    DB_NAME = args.database
+    PAGE_SIZE = args.page_size
+    LIST_BOOKS_BEFORE_EDIT = not args.no_listing
+
+    if args.profile:
+        configure_storage(args.profile)
+
+    # Time the statements if they are reported anywhere, including by the
+    # server's /metrics endpoint.
+    configure_metrics(
+        enabled=METRICS_ENABLED or bool(args.metrics_file
+                                        or args.slow_query_ms is not None
+                                        or args.slow_query_log
+                                        or args.command == 'serve'),
+        slow_query_ms=args.slow_query_ms,
+        slow_query_log=args.slow_query_log,
+    )
+
+    if args.metrics_file:
+        atexit.register(write_metrics, args.metrics_file)
+
+    if args.command is None:
+        # Never block on input() when run from a script.
+        if args.headless:
+            parser.error("a command is required with --headless")
+
+        run_system(args.seed)
+        return 0
+
+    if args.command == 'migrate':
+        conn = get_connection()
+        print(f"Schema version {schema_version(conn)}.")
+
+        for step in migrate(args.target):
+            print(f"Applied {step.version}: {step.description}")
+
+        print(f"Schema version {schema_version(conn)}.")
+        return 0
+
+    # Create or upgrade the tables, and seed a new database.
+    prepare_database(args.seed)
+
+    # Every command checks the plan of every statement once at startup.
+    # check-plans reports the problems itself, and migrate, above, may stop
+    # at a schema version the statements were not written for.
+    if args.command != 'check-plans':
+        warn_about_query_plans()
+
+    if args.command == 'import':
+        report = import_file(
+            args.path, args.kind, args.file_format, args.chunk_size,
+            args.rejects
+        )
+
+        print(f"Imported {report.imported} {args.kind}, "
+              f"rejected {report.rejected}.")
+
+        if report.rejects_path:
+            print(f"Rejected rows were written to {report.rejects_path}")
+
+    elif args.command == 'export':
+        try:
+            written = export_table(
+                args.path, args.kind, args.file_format, args.batch_size
+            )
+
+        # Parquet needs an optional package.
+        except RuntimeError as error:
+            print(error, file=sys.stderr)
+            return 1
+
+        print(f"Exported {written} {args.kind} to {args.path}")
+
+    elif args.command == 'backup':
+        report = backup_database(args.path, args.pages, args.sleep)
+        print(f"Backed up {report.pages} pages to {report.path} in "
+              f"{report.seconds:.2f}s")
+
+    elif args.command == 'batch':
+        if args.path == '-':
+            report = run_batch(sys.stdin, args.batch_size,
+                               args.stop_on_error)
+        else:
+            with open(args.path, encoding='utf-8') as file:
+                report = run_batch(file, args.batch_size, args.stop_on_error)
+
+        for line_number, text, reason in report.failures:
+            print(f"line {line_number}: {text}\n    {reason}")
+
+        counts = ", ".join(f"{name} {count}"
+                           for name, count in report.counts.items())
+        summary = (f"Applied {report.applied} command(s) in "
+                   f"{report.seconds:.3f}s")
+        print(summary + (f": {counts}." if counts else "."))
+        print(f"{report.failed} command(s) failed.")
+
+        return 1 if report.failed else 0
+
+    elif args.command == 'serve':
+        server = make_server(args.host, args.port, args.workers)
+        host, port = server.server_address[:2]
+        print(f"Serving the inventory on http://{host}:{port}/ "
+              f"with {args.workers} workers. Press Ctrl+C to stop.")
+
+        try:
+            server.serve_forever()
+
+        except KeyboardInterrupt:
+            pass
+
+        finally:
+            server.server_close()
+
+    elif args.command == 'check-plans':
+        problems = check_query_plans()
+
+        for problem in problems:
+            print(f"{problem.name}: {problem.detail}")
+
+        print(f"{len(problems)} plan problem(s) found in "
+              f"{len(STATEMENTS) + len(PLAN_PROBES)} statements.")
+
+        return 1 if problems else 0
+
+    elif args.command == 'search':
+        for result in Inventory().search_books(args.text, args.limit):
+            print(f"{result.id}\t{result.snippet}\t{result.author_name}\t"
+                  f"{result.qty}")
+
+    elif args.command == 'changes':
+        import json
+
+        changes = Inventory().iter_changes(args.since)
+
+        for change in itertools.islice(changes, args.limit):
+            print(json.dumps(change._asdict()))
+
+    elif args.command == 'reorder':
+        import csv
+
+        writer = csv.writer(
+            sys.stdout, lineterminator='\n',
+            delimiter=',' if args.report_format == 'csv' else '\t',
+        )
+        writer.writerow(['id', 'title', 'author', 'qty', 'reorder_level',
+                         'needed'])
+
+        for page in Inventory().iter_reorder_report(1000):
+            writer.writerows(
+                [item.id, item.title, item.author_name, item.qty,
+                 item.reorder_level, item.shortfall] for item in page
+            )
+
+    return 0
+
+
 # ========== Call Functions ==========
 
-run_system()
+if __name__ == '__main__':
+    sys.exit(main())
 
 
 # ========== References ==========
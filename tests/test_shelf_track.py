@@ -0,0 +1,1178 @@
+"""
+Tests for the Shelf Track inventory service. Each test works on its own
+database file, seeded with the five books and authors from data_sets().
+"""
+
+import asyncio
+import csv
+import http.client
+import json
+import os
+import socket
+import sqlite3
+import subprocess
+import sys
+import threading
+import time
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+import shelf_track  # noqa: E402
+
+
+@pytest.fixture
+def database(tmp_path, monkeypatch):
+    """A new, seeded database that is also the default DB_NAME."""
+    path = str(tmp_path / 'ebookstore.db')
+    monkeypatch.setattr(shelf_track, 'DB_NAME', path)
+    shelf_track.create_table()
+    shelf_track.data_sets()
+
+    yield path
+
+    shelf_track.close_connections()
+
+
+@pytest.fixture
+def inventory(database):
+    """An Inventory on the test database."""
+    return shelf_track.Inventory(database)
+
+
+# ========== Inventory Service ==========
+
+def test_add_and_read_a_book(inventory):
+    book = inventory.add_book(4001, "Bleak House", 1290, 3)
+
+    assert book == shelf_track.Book(4001, "Bleak House", 1290, 3)
+    assert inventory.get_book(4001) == book
+    assert inventory.get_book_details(4001) == shelf_track.BookDetails(
+        4001, "Bleak House", 1290, 3, "Charles Dickens", "England"
+    )
+
+
+def test_add_book_refuses_unknown_authors_and_duplicate_ids(inventory):
+    with pytest.raises(shelf_track.AuthorNotFoundError):
+        inventory.add_book(4001, "Bleak House", 4242, 3)
+
+    with pytest.raises(shelf_track.DuplicateBookError):
+        inventory.add_book(3001, "Bleak House", 1290, 3)
+
+    with pytest.raises(shelf_track.ValidationError):
+        inventory.add_book(4001, "   ", 1290, 3)
+
+    with pytest.raises(shelf_track.BookNotFoundError):
+        inventory.get_book(4001)
+
+
+def test_update_and_delete_a_book(inventory):
+    assert inventory.update_qty(3001, 5).qty == 5
+    assert inventory.update_title(3001, "Hard Times").title == "Hard Times"
+    assert inventory.set_book_author(3001, 8937).author_id == 8937
+
+    with pytest.raises(shelf_track.AuthorNotFoundError):
+        inventory.set_book_author(3001, 4242)
+
+    inventory.delete_book(3001)
+
+    with pytest.raises(shelf_track.BookNotFoundError):
+        inventory.get_book(3001)
+
+    with pytest.raises(shelf_track.BookNotFoundError):
+        inventory.delete_book(3001)
+
+
+def test_update_author_keeps_the_fields_not_given(inventory):
+    author = inventory.update_author(1290, name="C. Dickens")
+
+    assert author == shelf_track.Author(1290, "C. Dickens", "England")
+    assert inventory.get_author(1290) == author
+
+    with pytest.raises(shelf_track.AuthorNotFoundError):
+        inventory.update_author(4242, name="Nobody")
+
+
+# ========== Bulk Import ==========
+
+def read_rejects(path):
+    """Return the (line, reason) pairs in a rejects file."""
+    with open(path, newline='', encoding='utf-8') as file:
+        return [(int(row['line']), row['reason'])
+                for row in csv.DictReader(file)]
+
+
+def test_import_csv_with_a_byte_order_mark(database, inventory, tmp_path):
+    path = tmp_path / 'books.csv'
+    path.write_text(
+        "id,title,authorID,qty\n"
+        "3001,A Tale of Two Cities,1290,31\n"
+        "7777,Bleak House,1290,4\n"
+        "7778,,1290,4\n"
+        "7779,Hard Times,1290,-1\n"
+        "7780,Little Dorrit,1290,2\n",
+        encoding='utf-8-sig'
+    )
+
+    report = shelf_track.import_file(str(path), 'books', chunk_size=2,
+                                     database=database)
+
+    assert (report.imported, report.rejected) == (3, 2)
+    assert inventory.get_book(3001).qty == 31
+    assert inventory.get_book(7777) == shelf_track.Book(
+        7777, "Bleak House", 1290, 4
+    )
+    assert inventory.get_book(7780).qty == 2
+    assert [line for line, _ in read_rejects(report.rejects_path)] == [4, 5]
+
+    with pytest.raises(shelf_track.BookNotFoundError):
+        inventory.get_book(7778)
+
+
+def test_import_jsonl_rejects_bad_lines(database, inventory, tmp_path):
+    path = tmp_path / 'authors.jsonl'
+    path.write_text(
+        '{"id": 4001, "name": "Jane Austen", "country": "England"}\n'
+        '\n'
+        '{"id": 4002, "name": "George Eliot"\n'
+        '[4003, "Mary Shelley", "England"]\n'
+        '{"id": 4004, "name": "Emily Bronte"}\n'
+        '{"author_id": 4005, "Name": "Anne Bronte", "country": "England"}\n',
+        encoding='utf-8'
+    )
+    rejects = tmp_path / 'bad.csv'
+
+    report = shelf_track.import_file(str(path), 'authors',
+                                     rejects_path=str(rejects),
+                                     database=database)
+
+    assert report == shelf_track.ImportReport(2, 3, str(rejects))
+    assert inventory.get_author(4001).name == "Jane Austen"
+    assert inventory.get_author(4005).name == "Anne Bronte"
+
+    reasons = read_rejects(rejects)
+    assert [line for line, _ in reasons] == [3, 4, 5]
+    assert reasons[0][1].startswith("Invalid JSON")
+    assert reasons[2][1] == "Missing country"
+
+
+def test_import_reads_records_lazily(tmp_path):
+    path = tmp_path / 'books.jsonl'
+    path.write_text('{"id": 1}\n{"id": 2}\n', encoding='utf-8')
+    records = shelf_track.read_records(str(path))
+
+    assert next(records) == (1, {'id': 1})
+    assert next(records) == (2, {'id': 2})
+
+    with pytest.raises(StopIteration):
+        next(records)
+
+
+# ========== Pagination ==========
+
+def test_list_books_pages_by_id(inventory):
+    first = inventory.list_books(limit=2)
+    second = inventory.list_books(first[-1].id, 2)
+
+    assert [book.id for book in first] == [3001, 3002]
+    assert [book.id for book in second] == [3003, 3004]
+    assert [book.id for book in inventory.list_books(3004)] == [3005]
+    assert inventory.list_books(3005, 2) == []
+
+
+def test_iter_books_is_not_shifted_by_changes_between_pages(inventory):
+    pages = inventory.iter_books(page_size=2)
+
+    assert [book.id for book in next(pages)] == [3001, 3002]
+
+    # Deleting a book already read does not make the next page skip one.
+    inventory.delete_book(3001)
+
+    assert [[book.id for book in page] for page in pages] == \
+        [[3003, 3004], [3005]]
+
+
+def test_iter_book_details_includes_the_authors(inventory):
+    pages = list(inventory.iter_book_details(page_size=4))
+
+    assert [len(page) for page in pages] == [4, 1]
+    assert pages[0][0].author_name == "Charles Dickens"
+    assert pages[1][0].author_country == "England"
+
+
+# ========== Search Index ==========
+
+def search_ids(inventory, text):
+    """Return the IDs of the books a search finds, best match first."""
+    return [result.id for result in inventory.search_books(text)]
+
+
+def test_search_ranks_title_matches_above_author_matches(inventory):
+    inventory.upsert_author(4001, "Lewis Wonderland", "England")
+    inventory.add_book(4001, "Sylvie and Bruno", 4001, 1)
+
+    results = inventory.search_books("wonderland")
+
+    assert [result.id for result in results] == [3005, 4001]
+    assert results[0].snippet == "Alice's Adventures in [Wonderland]"
+    assert results[0].score < results[1].score
+
+
+def test_search_matches_prefixes_and_phrases(inventory):
+    assert search_ids(inventory, "lor rin") == [3004]
+    assert search_ids(inventory, '"tale of" dickens') == [3001]
+    assert search_ids(inventory, '"of tale"') == []
+
+    with pytest.raises(shelf_track.ValidationError):
+        inventory.search_books('  ""  ')
+
+
+def test_search_index_follows_book_and_author_changes(inventory):
+    inventory.update_title(3001, "Great Expectations")
+    inventory.add_book(4001, "Bleak House", 1290, 3)
+
+    assert search_ids(inventory, "tale") == []
+    assert search_ids(inventory, "expectations") == [3001]
+
+    # Renaming an author re-indexes every one of their books.
+    inventory.update_author(1290, name="Boz")
+    assert search_ids(inventory, "boz") == [3001, 4001]
+    assert search_ids(inventory, "dickens") == []
+
+    inventory.set_book_author(4001, 8937)
+    inventory.delete_book(3001)
+    assert search_ids(inventory, "boz") == []
+    assert search_ids(inventory, "rowling bleak") == [4001]
+
+
+# ========== Query Plan Checks ==========
+
+def test_no_statement_scans_a_whole_table(database):
+    assert shelf_track.check_query_plans(database=database) == []
+
+
+def test_a_missing_index_is_reported(database):
+    with shelf_track.transaction(database) as conn:
+        conn.execute("DROP INDEX book_author_idx")
+
+    problems = shelf_track.check_query_plans(database=database)
+
+    assert problems
+    assert all(problem.detail.startswith('SCAN') for problem in problems)
+
+
+# ========== Schema Migrations ==========
+
+def test_legacy_database_is_upgraded_to_the_latest_version(tmp_path):
+    path = str(tmp_path / 'legacy.db')
+
+    # The schema, and data, written by the original create_table().
+    legacy = sqlite3.connect(path)
+    legacy.executescript('''
+        CREATE TABLE book (
+            id INTEGER PRIMARY KEY,
+            title TEXT NOT NULL,
+            authorID INTEGER NOT NULL,
+            qty INTEGER NOT NULL
+        );
+        CREATE TABLE author (
+            id INTEGER PRIMARY KEY,
+            name TEXT NOT NULL,
+            country TEXT NOT NULL
+        );
+        INSERT INTO author VALUES (1290, 'Charles Dickens', 'England');
+        INSERT INTO book VALUES (3001, 'A Tale of Two Cities', 1290, 30);
+    ''')
+    legacy.close()
+
+    try:
+        applied = shelf_track.migrate(database=path)
+        conn = shelf_track.get_connection(path)
+
+        assert [step.version for step in applied] == \
+            [step.version for step in shelf_track.MIGRATIONS]
+        assert shelf_track.schema_version(conn) == \
+            shelf_track.MIGRATIONS[-1].version
+        assert shelf_track.migrate(database=path) == []
+
+        # The existing rows are kept and indexed for search.
+        inventory = shelf_track.Inventory(path)
+        assert inventory.get_book(3001).qty == 30
+        assert search_ids(inventory, 'dickens') == [3001]
+
+        # The check added by the rebuild is enforced.
+        with pytest.raises(sqlite3.IntegrityError):
+            with shelf_track.transaction(path) as write:
+                write.execute("UPDATE book SET qty = -1 WHERE id = 3001")
+
+        assert inventory.get_book(3001).qty == 30
+        assert shelf_track.check_query_plans(database=path) == []
+
+    finally:
+        shelf_track.close_connections()
+
+
+def test_import_rejects_books_by_unknown_authors(database, inventory,
+                                                tmp_path):
+    path = tmp_path / 'books.csv'
+    path.write_text(
+        "id,title,authorID,qty\n"
+        "7777,Bleak House,1290,4\n"
+        "7778,Persuasion,4242,2\n",
+        encoding='utf-8'
+    )
+
+    report = shelf_track.import_file(str(path), 'books', database=database)
+
+    assert (report.imported, report.rejected) == (1, 1)
+    assert read_rejects(report.rejects_path) == \
+        [(3, "The author ID 4242 does not exist.")]
+
+    with pytest.raises(shelf_track.BookNotFoundError):
+        inventory.get_book(7778)
+
+
+# ========== Lookup Cache ==========
+
+def test_cache_hits_do_not_use_the_database(database, monkeypatch):
+    monkeypatch.setattr(shelf_track, 'CACHE_CHECK_INTERVAL', 3600)
+    inventory = shelf_track.Inventory(database)
+    book = inventory.get_book(3001)
+
+    def no_database():
+        raise AssertionError("A cache hit used the database.")
+
+    monkeypatch.setattr(inventory, '_read', no_database)
+
+    assert inventory.get_book(3001) == book
+    assert inventory.cache_stats()['books']['hits'] == 1
+
+
+def test_writes_invalidate_their_own_entries(inventory):
+    inventory.get_book(3001)
+    inventory.get_author(1290)
+
+    inventory.update_qty(3001, 5)
+    inventory.update_author(1290, country="UK")
+
+    assert inventory.get_book(3001).qty == 5
+    assert inventory.get_author(1290).country == "UK"
+
+
+def test_change_by_another_process_is_seen(database, monkeypatch):
+    monkeypatch.setattr(shelf_track, 'CACHE_CHECK_INTERVAL', 0)
+    inventory = shelf_track.Inventory(database)
+
+    assert inventory.get_book(3001).qty == 30
+    assert inventory.get_author(1290).name == "Charles Dickens"
+
+    other = sqlite3.connect(database)
+    other.execute("UPDATE book SET qty = 7 WHERE id = 3001")
+    other.execute("UPDATE author SET name = 'C. Dickens' WHERE id = 1290")
+    other.commit()
+    other.close()
+
+    assert inventory.get_book(3001).qty == 7
+    assert inventory.get_author(1290).name == "C. Dickens"
+
+
+def test_write_through_another_inventory_is_seen(database, monkeypatch):
+    monkeypatch.setattr(shelf_track, 'CACHE_CHECK_INTERVAL', 0)
+    reader = shelf_track.Inventory(database)
+    writer = shelf_track.Inventory(database)
+
+    reader.get_book(3001)
+    reader.get_book(3003)
+
+    thread = threading.Thread(target=writer.delete_book, args=(3001,))
+    thread.start()
+    thread.join()
+
+    with pytest.raises(shelf_track.BookNotFoundError):
+        reader.get_book(3001)
+
+    assert reader.get_book(3003).qty == 25
+
+
+# ========== Startup ==========
+
+def test_prepare_database_only_seeds_a_new_database(tmp_path):
+    path = str(tmp_path / 'other.db')
+
+    try:
+        assert shelf_track.prepare_database(database=path) is True
+
+        inventory = shelf_track.Inventory(path)
+        inventory.delete_book(3001)
+
+        assert shelf_track.prepare_database(database=path) is False
+        assert [book.id for book in inventory.list_books()] == \
+            [3002, 3003, 3004, 3005]
+
+        # Asking for the seed data only adds the rows that are missing.
+        inventory.update_qty(3002, 1)
+        shelf_track.prepare_database(seed=True, database=path)
+        assert inventory.get_book(3001).qty == 30
+        assert inventory.get_book(3002).qty == 1
+
+    finally:
+        shelf_track.close_connections()
+
+
+def test_importing_the_module_does_not_load_tabulate():
+    script = ("import sys, shelf_track; "
+              "print('tabulate' in sys.modules, 'argparse' in sys.modules)")
+    result = subprocess.run(
+        [sys.executable, '-c', script], capture_output=True, text=True,
+        check=True, cwd=os.path.join(os.path.dirname(__file__), '..')
+    )
+
+    assert result.stdout.split() == ['False', 'False']
+
+
+# ========== Async Facade ==========
+
+def test_async_inventory_reads_and_writes(database):
+    async def main():
+        async with shelf_track.AsyncInventory(database) as inventory:
+            await inventory.update_qty(3001, 5)
+            books = await asyncio.gather(
+                *(inventory.get_book(book_id) for book_id in (3001, 3002))
+            )
+
+            with pytest.raises(shelf_track.BookNotFoundError):
+                await inventory.get_book(4001)
+
+            return books
+
+    assert [book.qty for book in asyncio.run(main())] == [5, 40]
+
+
+def test_cancelled_queued_write_is_never_run(database):
+    release = threading.Event()
+
+    async def main():
+        async with shelf_track.AsyncInventory(database) as inventory:
+            # Hold the writer so the next write stays queued.
+            blocker = asyncio.ensure_future(inventory._write(release.wait))
+            queued = asyncio.ensure_future(inventory.update_qty(3001, 5))
+            await asyncio.sleep(0.05)
+
+            queued.cancel()
+            release.set()
+            await blocker
+
+            with pytest.raises(asyncio.CancelledError):
+                await queued
+
+            return await inventory.get_book(3001)
+
+    assert asyncio.run(main()).qty == 30
+
+
+# ========== Stock Adjustments ==========
+
+def test_adjust_stock_refuses_to_go_below_zero(inventory):
+    assert inventory.adjust_stock(3001, -30).qty == 0
+    assert inventory.adjust_stock(3001, 4).qty == 4
+
+    with pytest.raises(shelf_track.InsufficientStockError):
+        inventory.adjust_stock(3001, -5)
+
+    with pytest.raises(shelf_track.BookNotFoundError):
+        inventory.adjust_stock(4242, 1)
+
+    assert inventory.get_book(3001).qty == 4
+
+
+def test_adjust_stock_many_is_all_or_nothing(inventory):
+    books = inventory.adjust_stock_many([(3001, -1), (3002, -2)])
+
+    assert [book.qty for book in books] == [29, 38]
+
+    with pytest.raises(shelf_track.InsufficientStockError):
+        inventory.adjust_stock_many([(3001, -1), (3003, -26)])
+
+    with pytest.raises(shelf_track.BookNotFoundError):
+        inventory.adjust_stock_many([(3001, -1), (4242, 1)])
+
+    assert inventory.get_book(3001).qty == 29
+    assert inventory.get_book(3003).qty == 25
+
+
+# ========== Stock Write Queue ==========
+
+def count_batches(inventory, monkeypatch):
+    """Count the batches written through inventory.apply_stock_changes."""
+    batches = []
+    apply = inventory.apply_stock_changes
+
+    def counted(changes):
+        batches.append(changes)
+        return apply(changes)
+
+    monkeypatch.setattr(inventory, 'apply_stock_changes', counted)
+
+    return batches
+
+
+def test_stock_queue_coalesces_changes_into_one_batch(inventory,
+                                                       monkeypatch):
+    batches = count_batches(inventory, monkeypatch)
+
+    with shelf_track.StockWriteQueue(inventory, max_delay=5) as queue:
+        sales = [queue.adjust(3001, -1) for _ in range(10)]
+        restock = queue.set_qty(3002, 7)
+        queue.flush()
+
+    # Merged changes all see the book's quantity after the batch.
+    assert {done.result() for done in sales} == {20}
+    assert restock.result() == 7
+    assert len(batches) == 1
+    assert inventory.get_book(3001).qty == 20
+
+
+def test_stock_queue_refuses_only_the_failing_change(inventory):
+    with shelf_track.StockWriteQueue(inventory) as queue:
+        first = queue.adjust(3003, -20)
+        refused = queue.adjust(3003, -20)
+        missing = queue.adjust(4242, 1)
+        other = queue.adjust(3004, 1)
+
+    assert first.result() == 5
+    assert other.result() == 38
+
+    with pytest.raises(shelf_track.InsufficientStockError):
+        refused.result()
+
+    with pytest.raises(shelf_track.BookNotFoundError):
+        missing.result()
+
+    assert inventory.get_book(3003).qty == 5
+
+
+def test_flushing_an_empty_stock_queue_keeps_coalescing(inventory,
+                                                         monkeypatch):
+    batches = count_batches(inventory, monkeypatch)
+
+    with shelf_track.StockWriteQueue(inventory, max_delay=0.2) as queue:
+        queue.flush()
+        changes = [queue.adjust(3001, -1)]
+        time.sleep(0.05)
+        changes.append(queue.adjust(3001, -1))
+
+        assert [done.result() for done in changes] == [28, 28]
+
+    assert len(batches) == 1
+
+
+# ========== Units of Work ==========
+
+def test_unit_of_work_rolls_back_every_change(inventory):
+    with pytest.raises(shelf_track.DuplicateBookError):
+        with inventory.unit_of_work():
+            inventory.upsert_author(4001, "Jane Austen", "England")
+            inventory.add_book(4001, "Persuasion", 4001, 2)
+
+            # Rows read inside the transaction are not cached.
+            assert inventory.get_book(4001).title == "Persuasion"
+
+            inventory.add_book(3001, "Emma", 4001, 1)
+
+    assert not inventory.author_exists(4001)
+
+    with pytest.raises(shelf_track.BookNotFoundError):
+        inventory.get_book(4001)
+
+
+def test_savepoint_rollback_keeps_the_outer_changes(inventory):
+    with inventory.unit_of_work():
+        inventory.update_qty(3001, 1)
+
+        with pytest.raises(shelf_track.InsufficientStockError):
+            with inventory.savepoint():
+                inventory.update_qty(3002, 2)
+                inventory.adjust_stock(3003, -100)
+
+        inventory.update_title(3004, "The Fellowship of the Ring")
+
+    assert inventory.get_book(3001).qty == 1
+    assert inventory.get_book(3002).qty == 40
+    assert inventory.get_book(3004).title == "The Fellowship of the Ring"
+
+
+# ========== ID Allocation ==========
+
+def test_allocation_skips_ids_entered_by_hand(inventory, database):
+    inventory.add_book(1001, "Bleak House", 1290, 1)
+    inventory.add_book(1003, "Hard Times", 1290, 1)
+
+    assert shelf_track.allocate_ids('book', 3, database) == [1000, 1002, 1004]
+    assert shelf_track.allocate_ids('book', 1, database) == [1005]
+    assert inventory.new_book("Little Dorrit", 1290, 2).id == 1006
+
+
+def test_a_large_id_entered_by_hand_does_not_use_up_the_range(inventory,
+                                                              database):
+    inventory.add_book(shelf_track.MAX_ID, "The Last Book", 1290, 1)
+
+    assert shelf_track.allocate_ids('book', 2, database) == [1000, 1001]
+
+
+def test_allocation_stops_at_the_end_of_the_range(database, monkeypatch):
+    monkeypatch.setitem(shelf_track.ID_RANGES, 'book', (3000, 3007))
+
+    assert shelf_track.allocate_ids('book', 2, database) == [3000, 3006]
+
+    with pytest.raises(shelf_track.IdRangeError):
+        shelf_track.allocate_ids('book', 2, database)
+
+
+def test_id_allocator_reserves_a_block_at_a_time(database, monkeypatch):
+    blocks = []
+    allocate = shelf_track.allocate_ids
+
+    def counted(*args):
+        blocks.append(args)
+        return allocate(*args)
+
+    monkeypatch.setattr(shelf_track, 'allocate_ids', counted)
+    allocate_id = shelf_track.IdAllocator('book', 4, database)
+
+    assert [allocate_id() for _ in range(6)] == list(range(1000, 1006))
+    assert len(blocks) == 2
+
+    # The rest of the second block is not handed out again.
+    assert allocate(database=database) == [1008]
+
+
+def test_import_allocates_blank_ids_only(database, inventory, tmp_path):
+    books = tmp_path / 'books.csv'
+    books.write_text(
+        "id,title,authorID,qty\n"
+        ",Bleak House,1290,4\n",
+        encoding='utf-8'
+    )
+    no_ids = tmp_path / 'no_ids.csv'
+    no_ids.write_text(
+        "title,authorID,qty\n"
+        "Hard Times,1290,1\n",
+        encoding='utf-8'
+    )
+
+    report = shelf_track.import_file(str(books), 'books', database=database)
+    assert (report.imported, report.rejected) == (1, 0)
+    assert inventory.get_book(1000).title == "Bleak House"
+
+    report = shelf_track.import_file(str(no_ids), 'books', database=database)
+    assert (report.imported, report.rejected) == (0, 1)
+    assert read_rejects(report.rejects_path) == [(2, "Missing id")]
+
+
+# ========== Analytics Snapshot ==========
+
+def snapshot_rows(snapshot):
+    """Return the contents of a snapshot as plain lists."""
+    return (list(snapshot.book_ids), list(snapshot.author_ids),
+            list(snapshot.qty), snapshot.titles, snapshot.authors)
+
+
+def test_snapshot_refresh_patches_only_the_changed_rows(inventory, database,
+                                                        monkeypatch):
+    monkeypatch.setattr(shelf_track, 'SNAPSHOT_RELOAD_RATIO', 1)
+    snapshot = shelf_track.InventorySnapshot(database, use_numpy=False)
+
+    assert snapshot.refresh() == 0
+    assert snapshot.total_stock() == sum(
+        book.qty for book in inventory.list_books()
+    )
+
+    inventory.adjust_stock(3001, -10)
+    inventory.adjust_stock(3001, -10)
+    inventory.delete_book(3002)
+    inventory.add_book(1500, "Bleak House", 1290, 3)
+    inventory.update_author(1290, name="Boz")
+
+    def no_reload(*args):
+        raise AssertionError("The snapshot was reloaded.")
+
+    monkeypatch.setattr(snapshot, '_reload', no_reload)
+
+    assert snapshot.refresh() == 4
+    assert snapshot_rows(snapshot) == snapshot_rows(
+        shelf_track.InventorySnapshot(database, use_numpy=False)
+    )
+    assert snapshot.book_ids[0] == 1500
+    assert snapshot.authors[1290].name == "Boz"
+    assert [book.id for book in snapshot.low_stock(11)] == [1500, 3001]
+
+
+def test_snapshot_reloads_when_many_rows_changed(inventory, database,
+                                                 monkeypatch):
+    monkeypatch.setattr(shelf_track, 'SNAPSHOT_RELOAD_RATIO', 0)
+    snapshot = shelf_track.InventorySnapshot(database, use_numpy=False)
+    reloads = []
+    reload = snapshot._reload
+
+    def counted(conn, seq):
+        reloads.append(seq)
+        return reload(conn, seq)
+
+    monkeypatch.setattr(snapshot, '_reload', counted)
+    inventory.update_qty(3003, 1)
+
+    assert snapshot.refresh() == len(snapshot) + len(snapshot.authors)
+    assert len(reloads) == 1
+    assert snapshot.qty[snapshot.book_ids.index(3003)] == 1
+
+
+# ========== Reorder Report ==========
+
+def test_reorder_report_lists_the_books_below_their_level(inventory):
+    assert inventory.reorder_report() == []
+
+    inventory.set_reorder_level(3001, 31)
+    inventory.set_reorder_level(3003, 10)
+    inventory.set_reorder_level(3005, 20)
+
+    assert [item.id for item in inventory.reorder_report()] == [3001, 3005]
+    assert [item.id for item in inventory.reorder_report(3001, 1)] == [3005]
+
+    inventory.adjust_stock(3001, 5)
+    inventory.adjust_stock(3003, -20)
+
+    report = inventory.reorder_report()
+    assert [item.id for item in report] == [3003, 3005]
+    assert (report[0].author_name, report[0].shortfall) == ("C.S Lewis", 5)
+
+    with pytest.raises(shelf_track.ValidationError):
+        inventory.set_reorder_level(3001, -1)
+
+
+def test_change_log_records_the_reorder_level(inventory, database):
+    inventory.set_reorder_level(3001, 12)
+
+    with shelf_track.transaction(database) as conn:
+        data = conn.execute(
+            "SELECT data FROM change_log ORDER BY seq DESC LIMIT 1"
+        ).fetchone()[0]
+
+    assert json.loads(data)['reorder_level'] == 12
+
+
+# ========== Change Log ==========
+
+def test_change_log_streams_changes_after_a_cursor(inventory):
+    cursor = max(change.seq for change in inventory.iter_changes())
+
+    inventory.update_qty(3001, 5)
+    inventory.add_book(4001, "Bleak House", 1290, 3)
+    inventory.delete_book(3002)
+    inventory.update_author(1290, name="Boz")
+
+    changes = list(inventory.iter_changes(cursor, batch_size=2))
+
+    assert [(change.table, change.row_id, change.operation)
+            for change in changes] == [
+        ('book', 3001, 'update'),
+        ('book', 4001, 'insert'),
+        ('book', 3002, 'delete'),
+        ('author', 1290, 'update'),
+    ]
+    assert changes[0].data['qty'] == 5
+    assert changes[2].data is None
+    assert [change.seq for change in changes] == \
+        list(range(cursor + 1, cursor + 5))
+    assert inventory.changes_since(changes[-1].seq) == []
+
+
+def test_pruned_sequence_numbers_are_not_reused(inventory, database):
+    last = max(change.seq for change in inventory.iter_changes())
+
+    assert inventory.prune_changes(last) == last
+    assert list(inventory.iter_changes()) == []
+
+    snapshot = shelf_track.InventorySnapshot(database, use_numpy=False)
+    inventory.update_qty(3001, 5)
+
+    assert [change.seq for change in inventory.iter_changes()] == [last + 1]
+
+    # A snapshot whose changes were pruned reloads instead of patching.
+    inventory.prune_changes(last + 1)
+    inventory.update_qty(3002, 6)
+
+    assert snapshot.refresh() == len(snapshot) + len(snapshot.authors)
+    assert list(snapshot.qty[:2]) == [5, 6]
+
+
+def test_write_on_another_thread_only_invalidates_its_row(database,
+                                                          monkeypatch):
+    monkeypatch.setattr(shelf_track, 'CACHE_CHECK_INTERVAL', 0)
+    inventory = shelf_track.Inventory(database)
+    book_ids = [3001, 3002, 3003, 3004, 3005]
+
+    for book_id in book_ids:
+        inventory.get_book(book_id)
+
+    thread = threading.Thread(target=inventory.adjust_stock, args=(3002, 5))
+    thread.start()
+    thread.join()
+
+    assert inventory.get_book(3002).qty == 45
+    assert inventory.cache_stats()['books']['size'] == len(book_ids)
+
+    hits = inventory.cache_stats()['books']['hits']
+
+    for book_id in book_ids:
+        inventory.get_book(book_id)
+
+    assert inventory.cache_stats()['books']['hits'] == hits + len(book_ids)
+
+
+# ========== Backup and Export ==========
+
+def test_backup_is_a_consistent_copy(inventory, database, tmp_path):
+    inventory.update_qty(3001, 5)
+    path = str(tmp_path / 'backup.db')
+    steps = []
+
+    report = shelf_track.backup_database(
+        path, pages=1, sleep=0, database=database,
+        progress=lambda *step: steps.append(step)
+    )
+
+    assert report.path == path
+    assert len(steps) == report.pages > 1
+    assert not [name for name in os.listdir(tmp_path)
+                if name.startswith('backup.db') and name != 'backup.db']
+
+    copy = sqlite3.connect(path)
+    rows = copy.execute("SELECT id, qty FROM book ORDER BY id").fetchall()
+    copy.close()
+
+    assert rows == [(book.id, book.qty) for book in inventory.list_books()]
+
+
+@pytest.mark.parametrize('file_format', ['csv', 'jsonl'])
+def test_export_can_be_imported_again(inventory, database, tmp_path,
+                                      file_format):
+    inventory.update_title(3001, "Bleak, \"House\"")
+    authors = str(tmp_path / f'authors.{file_format}')
+    books = str(tmp_path / f'books.{file_format}')
+
+    assert shelf_track.export_table(authors, 'authors', batch_size=2,
+                                    database=database) == 5
+    assert shelf_track.export_table(books, 'books', batch_size=2,
+                                    database=database) == 5
+
+    copy = str(tmp_path / 'copy.db')
+
+    try:
+        shelf_track.prepare_database(database=copy)
+
+        with shelf_track.transaction(copy) as conn:
+            conn.execute("DELETE FROM book")
+            conn.execute("DELETE FROM author")
+
+        for path, kind in ((authors, 'authors'), (books, 'books')):
+            report = shelf_track.import_file(path, kind, database=copy)
+            assert (report.imported, report.rejected) == (5, 0)
+
+        assert shelf_track.Inventory(copy).list_book_details() == \
+            inventory.list_book_details()
+
+    finally:
+        shelf_track.close_connections()
+
+
+# ========== HTTP Server ==========
+
+def test_api_error_responses(database):
+    api = shelf_track.InventoryApi(shelf_track.Inventory(database))
+
+    response = api.handle('GET', '/books/9999')
+    assert response.status == 404
+    assert 'error' in response.body
+
+    assert api.handle('GET', '/nowhere').status == 404
+    assert api.handle('DELETE', '/stock').status == 405
+
+    response = api.handle('POST', '/books/3001/stock', {}, b'{"delta": ')
+    assert response == shelf_track.ApiResponse(
+        400, {'error': "The request body is not valid JSON."}
+    )
+
+    response = api.handle('POST', '/books/3001/stock', {}, b'{"delta": -99}')
+    assert response.status == 409
+
+    response = api.handle('PATCH', '/books/3001', {'if-match': '"stale"'},
+                          b'{"qty": 1}')
+    assert response.status == 412
+    assert shelf_track.Inventory(database).get_book(3001).qty == 30
+
+
+@pytest.fixture
+def server(database):
+    """A running HTTP server on a free port."""
+    server = shelf_track.make_server(
+        port=0, workers=2, inventory=shelf_track.Inventory(database)
+    )
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+
+    yield server.server_address[:2]
+
+    server.shutdown()
+    server.server_close()
+
+
+def send_raw(address, request):
+    """Send a raw request and return the status line and JSON body."""
+    with socket.create_connection(address, timeout=5) as client:
+        client.sendall(request)
+        response = b''
+
+        # The server closes the connection after an unreadable request.
+        while chunk := client.recv(65536):
+            response += chunk
+
+    head, _, body = response.partition(b'\r\n\r\n')
+
+    return head.split(b'\r\n')[0].decode(), json.loads(body)
+
+
+@pytest.mark.parametrize('length, status', [
+    (b'abc', 400),
+    (b'-5', 400),
+    (str(shelf_track.MAX_REQUEST_BODY + 1).encode(), 413),
+])
+def test_bad_content_length_gets_a_json_error(server, length, status):
+    status_line, body = send_raw(
+        server,
+        b'POST /books HTTP/1.1\r\nHost: localhost\r\n'
+        b'Content-Length: ' + length + b'\r\n\r\n'
+    )
+
+    assert status_line.split()[1] == str(status)
+    assert 'Content-Length' in body['error'] or 'bytes' in body['error']
+
+
+def test_server_keeps_serving_after_an_error(server):
+    client = http.client.HTTPConnection(*server, timeout=5)
+
+    client.request('GET', '/books/9999')
+    response = client.getresponse()
+    assert response.status == 404
+    assert response.getheader('Content-Type') == 'application/json'
+    assert 'error' in json.loads(response.read())
+
+    # The same kept-alive connection serves the next request.
+    client.request('GET', '/books/3001')
+    response = client.getresponse()
+    assert response.status == 200
+    assert json.loads(response.read())['id'] == 3001
+
+    client.close()
+
+
+def test_if_match_is_checked_against_the_stored_row(database, monkeypatch):
+    monkeypatch.setattr(shelf_track, 'CACHE_CHECK_INTERVAL', 3600)
+    api = shelf_track.InventoryApi(shelf_track.Inventory(database))
+    tag = dict(api.handle('GET', '/books/3001').headers)['ETag']
+
+    # Another process changes the book, and the cached copy is now stale.
+    other = sqlite3.connect(database)
+    other.execute("UPDATE book SET qty = 7 WHERE id = 3001")
+    other.commit()
+    other.close()
+
+    response = api.handle('PATCH', '/books/3001', {'if-match': tag},
+                          b'{"qty": 1}')
+
+    assert response.status == 412
+    assert api.handle('DELETE', '/books/3001', {'if-match': tag}).status \
+        == 412
+
+
+def test_idle_keep_alive_clients_do_not_hold_the_workers(server):
+    clients = [http.client.HTTPConnection(*server, timeout=5)
+               for _ in range(3)]
+
+    # Each client makes a request and then keeps its connection open.
+    for client in clients:
+        start = time.monotonic()
+        client.request('GET', '/books/3001')
+        response = client.getresponse()
+        response.read()
+
+        assert response.status == 200
+        assert time.monotonic() - start < 1
+
+    for client in clients:
+        client.close()
+
+
+def test_server_close_closes_the_worker_connections(database):
+    server = shelf_track.make_server(
+        port=0, workers=2, inventory=shelf_track.Inventory(database)
+    )
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+
+    client = http.client.HTTPConnection(*server.server_address[:2],
+                                        timeout=5)
+    client.request('GET', '/books/3001')
+    client.getresponse().read()
+    client.close()
+
+    assert server.worker_ids
+    assert any(thread_id in server.worker_ids
+               for thread_id, _ in shelf_track._connections)
+
+    server.shutdown()
+    server.server_close()
+
+    assert not any(thread_id in server.worker_ids
+                   for thread_id, _ in shelf_track._connections)
+
+
+# ========== Benchmark Comparison ==========
+
+def test_compare_results_counts_regressions():
+    import benchmarks
+
+    def suite(p50_ms, ops_per_second):
+        return {'results': {'1000': {
+            'get_book': {'p50_ms': p50_ms, 'ops_per_second': ops_per_second},
+        }}}
+
+    baseline = suite(1.0, 1000)
+
+    assert benchmarks.compare_results(baseline, suite(1.05, 980))[1] == 0
+    assert benchmarks.compare_results(baseline, suite(1.2, 1000))[1] == 1
+    assert benchmarks.compare_results(baseline, suite(1.0, 800))[1] == 1
+
+    lines, regressions = benchmarks.compare_results(
+        baseline, suite(1.2, 1000), threshold=25
+    )
+    assert regressions == 0
+    assert 'REGRESSION' not in '\n'.join(lines)
+
+
+# ========== Query Metrics ==========
+
+@pytest.fixture
+def metrics(database, monkeypatch):
+    """Statement timing turned on for the connections opened from now."""
+    shelf_track.close_connections()
+    monkeypatch.setattr(shelf_track, 'METRICS_ENABLED', True)
+    shelf_track.query_metrics.reset()
+
+    yield shelf_track.query_metrics
+
+    shelf_track.close_connections()
+    shelf_track.query_metrics.reset()
+
+
+def test_metrics_time_each_statement(inventory, metrics, tmp_path):
+    inventory.get_book(3001)
+    inventory.get_book(3002)
+    inventory.get_book(3002)
+
+    text = metrics.render()
+    lookup = ('statement="SELECT id, title, authorID, qty FROM book '
+              'WHERE id = ?"')
+
+    # The second lookup of 3002 is a cache hit.
+    assert f'shelf_track_query_duration_seconds_count{{{lookup}}} 2' in text
+    assert f'shelf_track_query_rows_total{{{lookup}}} 2' in text
+    assert 'le="+Inf"' in text
+
+    inventory.update_qty(3001, 5)
+    text = metrics.render()
+
+    assert 'shelf_track_query_duration_seconds_count{statement="COMMIT"} 1' \
+        in text
+    assert 'shelf_track_connections_opened_total 1' in text
+
+    shelf_track.close_connections()
+    assert 'shelf_track_connections_closed_total 1' in metrics.render()
+
+    path = tmp_path / 'shelf_track.prom'
+    shelf_track.write_metrics(str(path))
+    assert path.read_text(encoding='utf-8') == metrics.render()
+
+
+def test_slow_statements_are_logged(inventory, metrics, monkeypatch, caplog):
+    monkeypatch.setattr(shelf_track, 'SLOW_QUERY_MS', 0)
+
+    with caplog.at_level('WARNING', shelf_track.SLOW_QUERY_LOGGER):
+        inventory.list_books(limit=2)
+
+    assert any('rows: SELECT id, title, authorID, qty FROM book' in message
+               for message in caplog.messages)
+    assert 'shelf_track_slow_queries_total' in metrics.render()
+
+
+# ========== Batch Commands ==========
+
+BATCH = '''\
+# End of day
+adjust 3001 -2
+adjust 3002 -1000
+frobnicate 3001
+{"command": ["adjust"], "book_id": 3001, "delta": -1}
+{"command": "adjust", "book_id": 3003, "delta": 4}
+{"command": "adjust", "book_id": 3003
+delete 9999
+rename-author 1290 "C. Dickens"
+'''
+
+
+def test_batch_reports_failures_and_applies_the_rest(database):
+    report = shelf_track.run_batch(BATCH.splitlines(), batch_size=2)
+    inventory = shelf_track.Inventory(database)
+
+    assert report.applied == 3
+    assert report.counts == {'adjust': 2, 'rename-author': 1}
+    assert [line_number for line_number, _, _ in report.failures] == \
+        [3, 4, 5, 7, 8]
+    assert "Unknown command: frobnicate" in report.failures[1][2]
+    assert "Unknown command: ['adjust']" in report.failures[2][2]
+    assert "Invalid JSON" in report.failures[3][2]
+
+    # The failed sale is rolled back on its own.
+    assert inventory.get_book(3001).qty == 28
+    assert inventory.get_book(3002).qty == 40
+    assert inventory.get_book(3003).qty == 29
+    assert inventory.get_author(1290).name == "C. Dickens"
+
+
+def test_batch_stops_on_error_and_keeps_earlier_commands(database):
+    report = shelf_track.run_batch(BATCH.splitlines(), batch_size=500,
+                                   stop_on_error=True)
+    inventory = shelf_track.Inventory(database)
+
+    assert report.applied == 1
+    assert report.failed == 1
+    assert report.failures[0][0] == 3
+    assert inventory.get_book(3001).qty == 28
+    assert inventory.get_book(3003).qty == 25
+    assert inventory.get_author(1290).name == "Charles Dickens"
+
+
+def test_batch_command_exits_non_zero_on_failure(database, tmp_path,
+                                                 capsys):
+    path = tmp_path / 'eod.txt'
+    path.write_text(BATCH, encoding='utf-8')
+
+    assert shelf_track.main(['--database', database, '--headless', 'batch',
+                             str(path), '--stop-on-error']) == 1
+
+    output = capsys.readouterr().out
+    assert "line 3: adjust 3002 -1000" in output
+    assert "1 command(s) failed." in output
+
+    with pytest.raises(ValueError):
+        shelf_track.run_batch([], batch_size=0)